@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""Notify users when a station gets bikes or free spaces"""
+import time
+import queue
+import logging
+import threading
+
+from .bicimad import Refresher
+from .helpers import to_int, to_float
+
+
+DEFAULT_RATE = 20
+DEFAULT_INTERVAL = 60
+
+#: station attribute watched by each kind of alert
+KINDS = {
+    'bici': 'bikes',
+    'plaza': 'spaces',
+}
+
+log = logging.getLogger('bicimad.alerts')
+
+
+class RateLimitedSender:
+    """Send messages from a background thread at most `rate` per second"""
+
+    def __init__(self, telegram, rate=DEFAULT_RATE, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.telegram = telegram
+        self.interval = 1.0 / rate
+        self.clock = clock
+        self.sleep = sleep
+        self.messages = queue.Queue()
+        self.thread = None
+        self.sent_at = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='alerts-sender')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.messages.put(None)
+        if self.thread is not None:
+            self.thread.join()
+
+    def send_message(self, chat_id, text):
+        self.messages.put((chat_id, text))
+
+    def run(self):
+        while True:
+            message = self.messages.get()
+            if message is None:
+                return
+            self.wait()
+            try:
+                self.telegram.send_message(*message)
+            except Exception:
+                log.exception(u'Could not send alert to %s', message[0])
+
+    def wait(self):
+        if self.sent_at is not None:
+            pending = self.sent_at + self.interval - self.clock()
+            if pending > 0:
+                self.sleep(pending)
+        self.sent_at = self.clock()
+
+
+class Alerts:
+    """Station availability subscriptions
+
+    Subscriptions are indexed by station id and kind, and are removed once
+    notified. On each stations refresh the stations whose bikes or spaces
+    went from zero to some are found first, and only those are looked up.
+    """
+
+    def __init__(self, sender, format=None):
+        self.sender = sender
+        self.format = format
+        #: {station id: {kind: set(chat ids)}}
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, telegram):
+        rate = to_float(config.get('alerts.rate'))
+        sender = RateLimitedSender(
+            telegram, rate=DEFAULT_RATE if rate is None else rate)
+        return cls(sender)
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def subscribe(self, chat_id, station_id, kind='bici'):
+        with self.lock:
+            kinds = self.subscriptions.setdefault(station_id, {})
+            kinds.setdefault(kind, set()).add(chat_id)
+
+    def unsubscribe(self, chat_id, station_id, kind='bici'):
+        with self.lock:
+            kinds = self.subscriptions.get(station_id, {})
+            kinds.get(kind, set()).discard(chat_id)
+            if not kinds.get(kind):
+                kinds.pop(kind, None)
+            if not kinds:
+                self.subscriptions.pop(station_id, None)
+
+    def crossed(self, previous, current):
+        """(station, kind) of subscribed stations that became available"""
+        for after in current.stations:
+            before = previous.ids.get(after.id)
+            if before is None or not after.enabled:
+                continue
+            # disabled stations count as empty, as when subscribing
+            kinds = [kind for kind, attr in sorted(KINDS.items())
+                     if not (before.enabled and getattr(before, attr))
+                     and getattr(after, attr)]
+            if not kinds:
+                continue
+
+            with self.lock:
+                subscribed = set(self.subscriptions.get(after.id, ()))
+            for kind in kinds:
+                if kind in subscribed:
+                    yield after, kind
+
+    def notify(self, previous, current):
+        """Stations listener sending due alerts"""
+        if previous is None or not self.subscriptions:
+            return
+
+        for station, kind in list(self.crossed(previous, current)):
+            with self.lock:
+                kinds = self.subscriptions.get(station.id, {})
+                chats = kinds.pop(kind, set())
+                if not kinds:
+                    self.subscriptions.pop(station.id, None)
+
+            text = self.format(station, kind)
+            for chat_id in chats:
+                self.sender.send_message(chat_id, text)
+
+
+def install(config, telegram, bicimad, alerts=None):
+    """Set up alerts for the given apis
+
+    Reuses the given `alerts` subscriptions, if any, and returns a refresher
+    that fetches stations every `alerts.interval` seconds while there are
+    subscriptions.
+    """
+    # imported here, bot imports this module
+    from .bot import format_alert
+
+    if alerts is None:
+        alerts = Alerts.from_config(config, telegram)
+        alerts.sender.start()
+    alerts.sender.telegram = telegram
+    alerts.format = format_alert
+    bicimad.alerts = alerts
+    bicimad.listeners.append(alerts.notify)
+
+    interval = to_int(config.get('alerts.interval'))
+    return Refresher(bicimad, DEFAULT_INTERVAL if interval is None
+                     else interval, wanted=lambda: len(alerts) > 0)
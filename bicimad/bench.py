@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the station queries and message handling hot paths"""
+import gc
+import json
+import time
+import pkgutil
+import random
+import platform
+import contextlib
+import tracemalloc
+
+from . import bot
+from . import pages
+from . import inline
+from .bot import process_message
+from .telegram import Telegram, Update
+from .bicimad import BiciMad, Stations, DEFAULT_URL, normalize
+
+
+#: stations response shipped with the package
+EXAMPLE = 'data/stations.json'
+DEFAULT_SIZES = (250, 10000, 100000)
+PERCENTILES = (50, 90, 99)
+
+#: max degrees to move synthetic stations away from the originals
+SPREAD = 0.05
+
+#: seconds a search for a misspelled name may take in 9 of 10 cases, with
+#: 100k stations
+FUZZY_SEARCH_LIMIT = 0.1
+
+
+def load_response(path=None):
+    """Stations response in `path`, the bundled example by default"""
+    if path is None:
+        return json.loads(pkgutil.get_data(__package__, EXAMPLE)
+                          .decode('utf-8'))
+    with open(path) as stream:
+        return json.load(stream)
+
+
+SYLLABLES = ('ba', 'ce', 'di', 'fo', 'gu', 'la', 'me', 'ni', 'po', 'ru',
+             'sa', 'te', 'vi', 'zo', 'mar', 'san', 'tor', 'val', 'ler', 'qui')
+
+
+def invented_word(rng):
+    """Made up word, so bigger cities have a bigger vocabulary"""
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def synthetic_city(response, size, seed=0):
+    """Stations response with `size` stations made from the given ones
+
+    Copies of the original stations are scattered around them, with new
+    ids, names with a made up word and random occupancy.
+    """
+    rng = random.Random(seed)
+    originals = response['estaciones']
+    stations = []
+    for number in range(size):
+        station = dict(originals[number % len(originals)])
+        total = int(station['numero_bases'])
+        bikes = rng.randint(0, total)
+        station.update(
+            idestacion=str(number + 1),
+            nombre='{} {}'.format(station['nombre'], invented_word(rng))
+            if number >= len(originals) else station['nombre'],
+            latitud=str(float(station['latitud'])
+                        + rng.uniform(-SPREAD, SPREAD)),
+            longitud=str(float(station['longitud'])
+                         + rng.uniform(-SPREAD, SPREAD)),
+            bicis_enganchadas=str(bikes),
+            bases_libres=str(total - bikes),
+        )
+        stations.append(station)
+    return dict(response, estaciones=stations)
+
+
+def percentile(samples, percent):
+    """Nearest rank percentile of sorted samples"""
+    index = max(0, int(round(percent / 100.0 * len(samples))) - 1)
+    return samples[min(index, len(samples) - 1)]
+
+
+def measure(function, repeat=100, budget=1.0):
+    """Time and allocation stats of calling `function`
+
+    Calls it up to `repeat` times, stopping earlier once `budget` seconds
+    are spent but always at least 3 times.
+    """
+    samples = []
+    started = time.perf_counter()
+    gc.collect()
+    while len(samples) < repeat:
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+        if len(samples) >= 3 and time.perf_counter() - started > budget:
+            break
+
+    tracemalloc.start()
+    try:
+        function()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    samples.sort()
+    stats = dict(('p{}'.format(percent), percentile(samples, percent))
+                 for percent in PERCENTILES)
+    stats.update(
+        count=len(samples),
+        mean=sum(samples) / len(samples),
+        ops_per_s=len(samples) / sum(samples) if sum(samples) else None,
+        alloc_peak_bytes=peak,
+    )
+    return stats
+
+
+def make_updates(response, seed=0):
+    """Location, command and text updates for a city"""
+    station = random.Random(seed).choice(response['estaciones'])
+    message = {
+        'message_id': 1,
+        'from': {'id': 1, 'first_name': 'Bench'},
+        'chat': {'id': 1, 'first_name': 'Bench'},
+        'date': 1439843938,
+    }
+    location = dict(latitude=float(station['latitud']),
+                    longitude=float(station['longitud']))
+    return dict(
+        location={'update_id': 1, 'message': dict(message, location=location)},
+        command={'update_id': 2, 'message': dict(
+            message, text='/bici ' + station['nombre'])},
+        text={'update_id': 3, 'message': dict(message, text='hola')},
+        inline={'update_id': 4, 'inline_query': {
+            'id': '1', 'from': message['from'], 'offset': '',
+            'query': station['nombre'][:3]}},
+    )
+
+
+def misspell(rng, name):
+    """Name with a letter replaced, as users type them"""
+    letters = [index for index, char in enumerate(name) if char.isalpha()]
+    if not letters:
+        return name
+    index = rng.choice(letters)
+    return name[:index] + 'x' + name[index + 1:]
+
+
+def static_bicimad(stations):
+    """BiciMad api that always answers with the given stations"""
+    bicimad = BiciMad(DEFAULT_URL, None, None, None, ttl=float('inf'))
+    bicimad.snapshot = stations
+    bicimad.fetched_at = bicimad.clock()
+    return bicimad
+
+
+@contextlib.contextmanager
+def fresh_cursors():
+    """Keep result pages in a new store instead of the bot one"""
+    kept = bot.cursors
+    bot.cursors = pages.Cursors()
+    try:
+        yield
+    finally:
+        bot.cursors = kept
+
+
+def benchmarks(response, seed=0):
+    """Named benchmark functions for a city"""
+    rng = random.Random(seed)
+    stations = Stations.from_response(response)
+    names = [s['nombre'] for s in response['estaciones']]
+    ids = [s.id for s in stations.stations]
+    center = stations.stations[0].position
+    updates = make_updates(response, seed)
+
+    def position():
+        return (center[0] + rng.uniform(-SPREAD, SPREAD),
+                center[1] + rng.uniform(-SPREAD, SPREAD))
+
+    nearby = stations.by_distance(position())
+    telegram = Telegram('http://localhost', 'bench')
+    bicimad = static_bicimad(stations)
+
+    def process(update):
+        # every run starts clean, as the first query of a user
+        def run():
+            with telegram.capture(), fresh_cursors():
+                process_message(Update.from_response(update), telegram,
+                                bicimad, {},
+                                inline_answers=inline.AnswerCache())
+        return run
+
+    return [
+        ('by_distance', lambda: stations.by_distance(position())),
+        ('by_search', lambda: stations.by_search(rng.choice(names))),
+        ('by_fuzzy_search',
+         lambda: stations.by_search(misspell(rng, rng.choice(names)))),
+        ('by_id', lambda: stations.by_id(rng.choice(ids))),
+        ('by_route', lambda: stations.by_route(position(), position())),
+        ('with_some_use', lambda: stations.with_some_use(nearby)),
+        ('normalize', lambda: normalize(rng.choice(names))),
+        ('update_from_response',
+         lambda: Update.from_response(updates['command'])),
+        ('process_location', process(updates['location'])),
+        ('process_command', process(updates['command'])),
+        ('process_text', process(updates['text'])),
+        ('process_inline', process(updates['inline'])),
+    ]
+
+
+def run(response, sizes=DEFAULT_SIZES, repeat=100, budget=1.0, only=None,
+        seed=0, progress=None):
+    """Run all benchmarks for every city size
+
+    :param only: names of the benchmarks to run, all of them by default
+    :param progress: called with (size, name) before each benchmark
+    :returns: json serializable report
+    """
+    results = {}
+    for size in sizes:
+        city = synthetic_city(response, size, seed)
+        results[str(size)] = sizes_results = {}
+        for name, function in benchmarks(city, seed):
+            if only and name not in only:
+                continue
+            if progress is not None:
+                progress(size, name)
+            sizes_results[name] = measure(function, repeat, budget)
+
+    return dict(
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        created=int(time.time()),
+        repeat=repeat,
+        budget=budget,
+        results=results,
+    )
@@ -1,17 +1,35 @@
 # -*- coding: utf-8 -*-
 import re
+import copy
+import bisect
+import itertools
+import math
+import time
+import heapq
+import logging
 import operator
+import threading
 import unidecode
 
 import requests
 from geopy.distance import vincenty
 
-from .helpers import urljoin
+from .helpers import urljoin, to_int
+from .metrics import timed
 
 
 DEFAULT_HOST = u'helena.bonopark.es:16080'
 DEFAULT_URL = u'http://' + DEFAULT_HOST
 ENDPOINT = u'/app/app/functions/get_all_estaciones_new.php'
+DEFAULT_TTL = 30
+DEFAULT_NEIGHBOURS = 5
+#: meters per degree of latitude
+LATITUDE_METERS = 111195.0
+
+#: numbers telling snapshots apart
+_versions = itertools.count(1)
+
+log = logging.getLogger('bicimad.bicimad')
 
 
 def geo_distance(pos1, pos2):
@@ -19,6 +37,7 @@ def geo_distance(pos1, pos2):
     return vincenty(pos1, pos2).m
 
 
+@timed('fetch')
 def get_locations(base_url, dni, id_auth, id_security):
     url = urljoin(base_url, ENDPOINT)
     headers = {u'User-Agent': u'Apache-HttpClient/UNAVAILABLE (java 1.4)'}
@@ -57,10 +76,16 @@ class Station:
         self.position = float(self.latitud), float(self.longitud)
         self.address = self.direccion if \
             self.direccion != 'NO OPERATIVA' else self.nombre
+        #: {name: text} rendered for the bot, shared with copies
+        self.fragments = {}
 
     def distance_to(self, position):
         return geo_distance(self.position, position)
 
+    def state(self):
+        """What rendered fragments depend on"""
+        return self.enabled, self.bikes, self.spaces, self.address
+
     def __str__(self):
         return '{} ({})'.format(self.address, self.id)
 
@@ -83,21 +108,33 @@ def with_spaces(stations):
     return (s for s in stations if s.spaces)
 
 
-def distance(position):
-    """Ordered by distance to a point
+def distance(position, max=None):
+    """Ordered by distance to a point, only the nearest `max` if given
 
-    Adds a `distance` property to each station relative to `position`.
+    Distances are computed without touching the stations, and only the ones
+    returned are copied with a `distance` property relative to `position`,
+    so a snapshot can be queried from several threads.
 
     :param position: (lat, long)
     """
     def calculate_distances(stations):
-        for station in stations:
-            station.distance = station.distance_to(position)
-            yield station
+        pairs = ((station.distance_to(position), station)
+                 for station in stations)
+        key = operator.itemgetter(0)
+        pairs = sorted(pairs, key=key) if max is None \
+            else heapq.nsmallest(max, pairs, key=key)
+        return [with_distance(station, meters) for meters, station in pairs]
 
     return calculate_distances
 
 
+def with_distance(station, meters):
+    """Copy of a station with its `distance`"""
+    station = copy.copy(station)
+    station.distance = meters
+    return station
+
+
 def make_getter(*fields):
     """Build getter that always returns a tuple of values
 
@@ -161,6 +198,13 @@ def sort(field):
     return filter
 
 
+def smallest(field, count):
+    """Sorted first `count` stations, without sorting all of them"""
+    def filter(stations):
+        return heapq.nsmallest(count, stations, key=operator.attrgetter(field))
+    return filter
+
+
 def query(*filters):
     def filter_all(stations):
         for filter in filters:
@@ -170,14 +214,198 @@ def query(*filters):
     return filter_all
 
 
+class NeighbourGraph:
+    """Nearest stations to each station
+
+    Distances are approximated projecting positions to a plane, which is
+    precise enough at city scale and much cheaper than geodesics.
+
+    :param positions: ((station id, (lat, long)), ...)
+    """
+
+    def __init__(self, positions, count=DEFAULT_NEIGHBOURS):
+        self.positions = positions
+        self.count = count
+        #: {station id: [(distance, station id)], closest first}
+        self.nearest = {}
+
+        if not positions:
+            return
+        scale = math.cos(math.radians(positions[0][1][0]))
+        points = [(id, lat * LATITUDE_METERS, long * LATITUDE_METERS * scale)
+                  for id, (lat, long) in positions]
+        for id, y, x in points:
+            self.nearest[id] = heapq.nsmallest(count, (
+                (math.hypot(y - other_y, x - other_x), other)
+                for other, other_y, other_x in points if other != id))
+
+
+def bigrams(word):
+    """Letter pairs of a word, marking its start and end"""
+    word = '$' + word + '$'
+    return set(word[i:i + 2] for i in range(len(word) - 1))
+
+
+def levenshtein(first, second, limit):
+    """Edit distance of two strings, or `limit` + 1 if it is greater"""
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+
+    previous = list(range(len(second) + 1))
+    for i, char in enumerate(first, 1):
+        current = [i]
+        for j, other in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char != other)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+
+def max_typos(word):
+    """Edits allowed to a search word of the given length"""
+    return 0 if len(word) < 4 else 1 if len(word) < 5 else 2
+
+
+class SearchIndex:
+    """Words in station names and addresses, for typo tolerant search
+
+    Words are looked up by their bigrams and length, so only those of a
+    close length sharing enough bigrams with a search word are compared,
+    and all words appear once no matter how many stations have them.
+    Stations are referred to by their position in `names`.
+
+    :param names: ((name, address), ...) of the stations
+    """
+
+    def __init__(self, names):
+        self.names = names
+        self.keys = tuple(normalize(' '.join(name)) for name in names)
+        #: {word: set(station positions)}
+        self.words = {}
+        for number, key in enumerate(self.keys):
+            for word in key.split():
+                self.words.setdefault(word, set()).add(number)
+        #: {(bigram, word length): [word]}
+        self.bigrams = {}
+        #: {word length: [word]}
+        self.lengths = {}
+        for word in self.words:
+            self.lengths.setdefault(len(word), []).append(word)
+            for bigram in bigrams(word):
+                self.bigrams.setdefault((bigram, len(word)), []).append(word)
+        #: every word, sorted for prefix lookups
+        self.vocabulary = sorted(self.words)
+
+    def matching(self, query, max=5):
+        """Positions of the stations containing the query, sorted"""
+        query = normalize(query)
+        found = [number for number, key in enumerate(self.keys)
+                 if query in key]
+        found.sort(key=self.keys.__getitem__)
+        return found[:max] if max is not None else found
+
+    def prefixed(self, prefix):
+        """Positions of the stations with a word starting with `prefix`"""
+        found = set()
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        for word in itertools.islice(self.vocabulary, start, None):
+            if not word.startswith(prefix):
+                break
+            found.update(self.words[word])
+        return found
+
+    def completing(self, query, max=5):
+        """Positions of the stations with every word in a query still being
+        typed, so its last word may be incomplete, sorted"""
+        words = normalize(query).split()
+        if not words:
+            return []
+
+        found = self.prefixed(words[-1])
+        for word in words[:-1]:
+            if not found:
+                break
+            found &= self.words.get(word, set())
+        return heapq.nsmallest(max or len(found), found,
+                               key=self.keys.__getitem__)
+
+    def similar(self, word):
+        """{word: edit distance} of the indexed words close to `word`"""
+        limit = max_typos(word)
+        if word in self.words and not limit:
+            return {word: 0}
+
+        grams = bigrams(word)
+        # each edit changes the length by one at most
+        lengths = range(len(word) - limit, len(word) + limit + 1)
+        # and loses two of the bigrams of the word at most
+        needed = len(grams) - 2 * limit
+        if needed > 0:
+            shared = {}
+            for length in lengths:
+                for bigram in grams:
+                    for candidate in self.bigrams.get((bigram, length), ()):
+                        shared[candidate] = shared.get(candidate, 0) + 1
+            candidates = [candidate for candidate, count in shared.items()
+                          if count >= needed]
+        else:
+            candidates = [candidate for length in lengths
+                          for candidate in self.lengths.get(length, ())]
+
+        distances = {}
+        for candidate in candidates:
+            distance = levenshtein(word, candidate, limit)
+            if distance <= limit:
+                distances[candidate] = distance
+        return distances
+
+    def search(self, query, max=5):
+        """Positions of the stations with every search word or a close one,
+        fewest typos first"""
+        words = [word for word in normalize(query).split() if len(word) > 2]
+        if not words:
+            return []
+
+        scores = None
+        for word in words:
+            typos = {}
+            for similar, distance in self.similar(word).items():
+                for number in self.words[similar]:
+                    if distance < typos.get(number, distance + 1):
+                        typos[number] = distance
+            if scores is None:
+                scores = typos
+            else:
+                scores = dict((number, score + typos[number])
+                              for number, score in scores.items()
+                              if number in typos)
+            if not scores:
+                return []
+
+        return heapq.nsmallest(max or len(scores), scores, key=lambda number:
+                               (scores[number], self.keys[number]))
+
+
 class Stations:
-    def __init__(self, stations):
-        self.stations = map(Station, stations)
+    def __init__(self, stations, forecaster=None):
+        self.stations = list(map(Station, stations))
+        self.ids = dict((station.id, station) for station in self.stations)
+        #: :class:`forecast.Forecaster` used by :meth:`forecast`
+        self.forecaster = forecaster
+        #: :class:`NeighbourGraph`, built on first use
+        self.graph = None
+        #: :class:`SearchIndex`, built on first search
+        self.search_index = None
+        #: unique for each snapshot, to cache answers made from it
+        self.version = next(_versions)
 
     @classmethod
     def from_response(cls, response):
         return cls(response['estaciones'])
 
+    @timed('query')
     def query(self, *filters, **kwargs):
         max = kwargs.get('max')
         stations = kwargs.get('stations', self.stations)
@@ -185,14 +413,115 @@ class Stations:
         return list(result)[:max] if max is not None else result
 
     def by_id(self, id):
-        return self.query(find('id', id))
+        return self.ids.get(id)
+
+    def positions(self):
+        return tuple((station.id, station.position)
+                     for station in self.stations)
+
+    def names(self):
+        return tuple((station.nombre, station.address)
+                     for station in self.stations)
+
+    def inherit(self, previous):
+        """Reuse the neighbour graph and search index of an older snapshot
 
+        Only if they were built and no station moved, appeared, went away or
+        was renamed. Rendered fragments are kept for stations that didn't
+        change.
+        """
+        if previous is None:
+            return
+
+        for station in self.stations:
+            before = previous.ids.get(station.id)
+            if before is not None and before.state() == station.state():
+                station.fragments = before.fragments
+
+        graph = previous.graph
+        if graph is not None and graph.positions == self.positions():
+            self.graph = graph
+
+        search_index = previous.search_index
+        if search_index is not None and search_index.names == self.names():
+            self.search_index = search_index
+
+    def neighbours(self, station):
+        """Nearest other stations with their `distance`, closest first"""
+        graph = self.graph
+        if graph is None:
+            graph = self.graph = NeighbourGraph(self.positions())
+
+        nearby = []
+        for meters, id in graph.nearest.get(station.id, ()):
+            other = self.ids.get(id)
+            if other is not None:
+                nearby.append(with_distance(other, meters))
+        return nearby
+
+    def forecast(self, station, minutes):
+        """Probable availability of the station in some minutes
+
+        :returns: :class:`forecast.Prediction` or None when not forecasting
+        """
+        if self.forecaster is None:
+            return None
+        return self.forecaster.predict(station.id, station.bikes,
+                                       station.spaces, minutes)
+
+    def get_search_index(self):
+        search_index = self.search_index
+        if search_index is None:
+            search_index = self.search_index = SearchIndex(self.names())
+        return search_index
+
+    @timed('query')
     def by_search(self, query, max=5):
-        return self.query(index('nombre', 'address'),
-                          search(query), sort('index'), max=max)
+        """Stations whose name or address contain the query
+
+        Allows some typos when none does.
+        """
+        numbers = self.get_search_index().matching(query, max)
+        if not numbers:
+            return self.by_fuzzy_search(query, max)
+        return [self.stations[number] for number in numbers]
+
+    @timed('query')
+    def by_prefix(self, query, max=5):
+        """Stations with every word in a query being typed
+
+        Allows some typos when none has them.
+        """
+        numbers = self.get_search_index().completing(query, max)
+        if not numbers:
+            return self.by_fuzzy_search(query, max)
+        return [self.stations[number] for number in numbers]
+
+    @timed('fuzzy_search')
+    def by_fuzzy_search(self, query, max=5):
+        """Stations with every word in the query, or one with some typos"""
+        return [self.stations[number]
+                for number in self.get_search_index().search(query, max)]
 
     def by_distance(self, position, max=5):
-        return self.query(distance(position), sort('distance'), max=max)
+        return self.query(distance(position, max))
+
+    def by_route(self, origin, destination, max=3, candidates=10):
+        """Best stations to pick up a bike near origin and leave it near
+        destination
+
+        Only the nearest `candidates` to each point are paired.
+
+        :returns: (walking distance, pickup, dropoff) list, shortest first
+        """
+        pickups = self.with_bikes(
+            self.by_distance(origin, max=candidates), max=candidates)
+        dropoffs = self.with_spaces(
+            self.by_distance(destination, max=candidates), max=candidates)
+        routes = [(pickup.distance + dropoff.distance, pickup, dropoff)
+                  for pickup in pickups for dropoff in dropoffs
+                  if pickup.id != dropoff.id]
+        return heapq.nsmallest(max, routes, key=operator.itemgetter(0))
 
     def with_bikes(self, stations, max=5):
         return self.query(enabled, with_bikes, stations=stations, max=max)
@@ -225,22 +554,100 @@ _NORMALIZE_RE = re.compile(r"""
 
 
 class BiciMad:
-    def __init__(self, url, user, auth, security):
+    def __init__(self, url, user, auth, security, ttl=None,
+                 clock=time.monotonic):
         self.url = url
         self.user = user
         self.auth = auth
         self.security = security
+        #: seconds to reuse fetched stations before asking again
+        self.ttl = DEFAULT_TTL if ttl is None else ttl
+        self.clock = clock
+        self.snapshot = None
+        self.fetched_at = None
+        self.lock = threading.Lock()
+        #: called with (previous, new) stations after each refresh
+        self.listeners = []
+        #: station availability subscriptions, see :mod:`bicimad.alerts`
+        self.alerts = None
+        #: occupancy changes, see :mod:`bicimad.history`
+        self.history = None
+        #: station flows model, see :mod:`bicimad.forecast`
+        self.forecaster = None
 
     @classmethod
     def from_config(cls, config):
-        return cls(DEFAULT_URL,
+        return cls(config.get('bicimad.url') or DEFAULT_URL,
                    config.get('bicimad.user'),
                    config.get('bicimad.auth'),
-                   config.get('bicimad.security'))
+                   config.get('bicimad.security'),
+                   ttl=to_int(config.get('bicimad.ttl')))
 
     @property
     def stations(self):
-        return Stations.from_response(self.get_locations())
+        if self.expired:
+            with self.lock:
+                # another thread may have just refreshed it
+                if self.expired:
+                    self.refresh()
+        return self.snapshot
+
+    @property
+    def expired(self):
+        return self.snapshot is None \
+            or self.clock() - self.fetched_at >= self.ttl
+
+    def refresh(self):
+        """Fetch a new stations snapshot"""
+        previous = self.snapshot
+        self.snapshot = Stations.from_response(self.get_locations())
+        self.snapshot.forecaster = self.forecaster
+        self.snapshot.inherit(previous)
+        self.fetched_at = self.clock()
+
+        for listener in self.listeners:
+            try:
+                listener(previous, self.snapshot)
+            except Exception:
+                log.exception(u'Stations listener %r failed', listener)
+
+        return self.snapshot
 
     def get_locations(self):
         return get_locations(self.url, self.user, self.auth, self.security)
+
+
+class Refresher:
+    """Refresh stations from a background thread
+
+    :param interval: seconds between refreshes
+    :param wanted: called before each refresh, skips it when false
+    """
+
+    def __init__(self, bicimad, interval, wanted=None):
+        self.bicimad = bicimad
+        self.interval = interval
+        self.wanted = wanted
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='refresher')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if self.wanted is not None and not self.wanted():
+                continue
+            try:
+                with self.bicimad.lock:
+                    self.bicimad.refresh()
+            except Exception:
+                log.exception(u'Could not refresh stations')
@@ -1,9 +1,38 @@
+import copy
 import logging
 import functools
 
+from . import live
+from . import pages
+from . import inline
+from . import gazetteer
+from .logs import correlate
+from .alerts import KINDS
+from .metrics import timed, registry
+from .helpers import to_int
+from .bicimad import normalize
+from .ratelimit import category
+
 
 log = logging.getLogger('bicimad.telegram')
 
+#: Default live location sessions
+live_sessions = live.LiveSessions()
+
+#: Results being paged through
+cursors = pages.Cursors()
+
+#: Default inline query answers
+inline_answers = inline.AnswerCache()
+
+inline_cached = registry.counter(
+    'bicimad_inline_queries_total',
+    'Inline queries by whether the answer was cached or computed')
+
+live_edits = registry.counter(
+    'bicimad_live_location_updates_total',
+    'Live location updates by whether the reply had to be edited')
+
 
 def coroutine(function):
     """Coroutine decorator"""
@@ -36,6 +65,27 @@ def conversation(start):
             update = yield
 
 
+def fragment(function):
+    """Keep the text rendered for a station while it doesn't change
+
+    Texts are kept in the station `fragments`, which newer snapshots reuse
+    for the stations whose availability stays the same.
+    """
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(station):
+        fragments = getattr(station, 'fragments', None)
+        if fragments is None:
+            return function(station)
+        text = fragments.get(name)
+        if text is None:
+            text = fragments[name] = function(station)
+        return text
+
+    return wrapper
+
+
 def _format_base(station, attr, bordername, format):
     if not station.enabled:
         return 'Estación no disponible en {!r}'.format(station)
@@ -53,6 +103,8 @@ def plural(singular, count, suffix='s', plural=None):
     return singular + suffix if plural is None else plural
 
 
+@timed('render')
+@fragment
 def format_bikes(station):
     def format(station):
         return '{n} {name} en {station!r}'.format(
@@ -62,6 +114,8 @@ def format_bikes(station):
     return _format_base(station, 'bikes', 'vacía', format)
 
 
+@timed('render')
+@fragment
 def format_spaces(station):
     def format(station):
         return '{n} {name} en {station!r}'.format(
@@ -71,6 +125,8 @@ def format_spaces(station):
     return _format_base(station, 'spaces', 'a tope', format)
 
 
+@timed('render')
+@fragment
 def format_station(station):
     if not station.enabled:
         return 'Estación no disponible en {!r}'.format(station)
@@ -81,15 +137,22 @@ def format_station(station):
                 station=station)
 
 
-def format_station_area(station):
+@fragment
+def format_area_parts(station):
+    """Text before and after the distance to a station"""
     if not station.enabled:
-        return 'Estación no disponible a {}m en {!r}'.format(
-            int(station.distance), station)
+        return 'Estación no disponible a ', 'm en {!r}'.format(station)
 
-    return '- {bikes} {bike} y {spaces} {space} a {m}m\n  en {station!r}'\
-        .format(bikes=station.bikes, bike=plural('bici', station.bikes),
-                spaces=station.spaces, space=plural('plaza', station.spaces),
-                m=int(station.distance), station=station)
+    return '- {bikes} {bike} y {spaces} {space} a '.format(
+        bikes=station.bikes, bike=plural('bici', station.bikes),
+        spaces=station.spaces, space=plural('plaza', station.spaces)), \
+        'm\n  en {!r}'.format(station)
+
+
+@timed('render')
+def format_station_area(station):
+    before, after = format_area_parts(station)
+    return before + str(int(station.distance)) + after
 
 
 @coroutine
@@ -130,15 +193,26 @@ def make_search_command(name, format, queryname):
             update = yield
             arguments = getattr(update, 'text', '')
 
+        keyboard = None
         if arguments.isdigit():
             response = make_id_query_response(int(arguments), bicimad, format)
+            station = bicimad.stations.by_id(int(arguments))
+            if station is not None:
+                response += format_alternatives(station, bicimad, queryname)
         elif update.type == 'location':
-            response = make_location_response(update, bicimad, queryname)
+            response, keyboard = make_location_response(
+                update, bicimad, queryname)
         else:
-            response = make_query_response(
-                arguments, bicimad, format, queryname)
+            response = None
+            # street and number, as in 'Alcalá 49'
+            if any(char.isdigit() for char in arguments):
+                response = make_address_response(
+                    arguments, bicimad, queryname)
+            if response is None:
+                response, keyboard = make_query_response(
+                    arguments, bicimad, format, queryname, update.chat_id)
 
-        telegram.send_message(update.chat_id, response)
+        telegram.send_message(update.chat_id, response, keyboard=keyboard)
 
     return function
 
@@ -156,39 +230,148 @@ def make_id_query_response(sid, bicimad, format):
     return response
 
 
-def make_query_response(arguments, bicimad, format, queryname):
-    stations = bicimad.stations.by_search(arguments)
+def format_alternatives(station, bicimad, queryname, max=3):
+    """Nearby stations to try when `station` is of no use"""
+    stations = bicimad.stations
+    nearby = stations.neighbours(station)
+    if not nearby or getattr(stations, queryname)([station]):
+        return ''
+
+    good = getattr(stations, queryname)(nearby, max=max)
+    if not good:
+        return ''
+
+    return '\n\nPrueba en estas, que están cerca:\n\n'\
+        + '\n'.join(map(format_station_area, good))
+
+
+def make_address_response(arguments, bicimad, queryname):
+    """Stations near a street address, None if the street is unknown"""
+    located = gazetteer.locate(arguments)
+    if located is None:
+        return None
+
+    street, number, position = located
+    log.info(u'Located %r as %s %s at %r', arguments, street, number,
+             position)
+    stations = bicimad.stations.by_distance(position)
+    return 'Cerca de {}{}:\n\n{}'.format(
+        street.name, '' if number is None else ' {}'.format(number),
+        format_location_response(stations, bicimad, queryname))
+
+
+def make_query_response(arguments, bicimad, format, queryname,
+                        chat_id=None):
+    """Text of the stations matching a search and keyboard to page them"""
+    stations = bicimad.stations.by_search(arguments, max=pages.MAX_RESULTS)
 
     if not stations:
-        response = 'Uhh no me suena esa dirección para '\
+        response = make_address_response(arguments, bicimad, queryname) \
+            or 'Uhh no me suena esa dirección para '\
             'ninguna estación. Afina un poco más.'
-    else:
-        response = ''
+        return response, None
+
+    stations, keyboard = paginate(stations, chat_id, queryname)
+    return format_query_response(stations, bicimad, format, queryname), \
+        keyboard
 
-        good, bad = divide_stations(bicimad, stations, queryname)
 
-        # Valid search results
-        if good:
-            response += 'Pues puede que sea alguna de estas:\n\n'\
-                + '\n'.join(map(format, good))
+def format_query_response(stations, bicimad, format, queryname):
+    response = ''
+    good, bad = divide_stations(bicimad, stations, queryname)
+
+    # Valid search results
+    if good:
+        response += 'Pues puede que sea alguna de estas:\n\n'\
+            + '\n'.join(map(format, good))
+
+    # separator
+    if good and bad:
+        response += '\n\n'
 
-        # separator
-        if good and bad:
-            response += '\n\n'
+    # Valid search results but empty or unavailable
+    if bad:
+        response += 'Estas me salen pero no creo '\
+            'que te sirvan de mucho:\n\n'\
+            + '\n'.join(map(format, bad))
 
-        # Valid search results but empty or unavailable
-        if bad:
-            response += 'Estas me salen pero no creo '\
-                'que te sirvan de mucho:\n\n'\
-                + '\n'.join(map(format, bad))
+    if not good:
+        response += format_alternatives(stations[0], bicimad, queryname)
 
     return response
 
 
+def paginate(stations, chat_id, queryname, located=False):
+    """First page of results and the keyboard to see the rest"""
+    if chat_id is None:
+        return stations[:pages.PAGE_SIZE], None
+
+    cursor = pages.Cursor.from_stations(stations, queryname, located)
+    return stations[:pages.PAGE_SIZE], pages.keyboard(
+        cursors.add(chat_id, cursor), cursor)
+
+
+def format_page(cursor, bicimad):
+    """Current page of a cursor with the latest stations"""
+    stations = bicimad.stations
+    page = []
+    for id, distance in cursor.page():
+        station = stations.by_id(id)
+        if station is None:
+            continue
+        if distance is not None:
+            station = copy.copy(station)
+            station.distance = distance
+        page.append(station)
+
+    if not page:
+        return 'Estas estaciones ya no están, vuelve a buscar.'
+    if cursor.located:
+        return format_location_response(page, bicimad, cursor.queryname)
+    return format_query_response(page, bicimad, FORMATS[cursor.queryname],
+                                 cursor.queryname)
+
+
+def process_callback(update, telegram, bicimad):
+    """Show the next page of results or refresh the current one"""
+    action, token = pages.parse_data(update.data)
+    cursor = cursors.get(update.chat_id, token) \
+        if action in (pages.MORE, pages.REFRESH) else None
+    if cursor is None or update.message is None:
+        telegram.answer_callback_query(
+            update.callback_id, 'Esta búsqueda ya no está, vuelve a buscar')
+        return
+
+    if action == pages.MORE:
+        cursor.next()
+    text = format_page(cursor, bicimad)
+    keyboard = pages.keyboard(token, cursor)
+
+    # Telegram rejects edits leaving the message as it is
+    shown = update.message.get('reply_markup', {}).get('inline_keyboard')
+    if text.strip() == update.message.get('text', '').strip() \
+            and keyboard == shown:
+        telegram.answer_callback_query(
+            update.callback_id, 'No hay más estaciones'
+            if action == pages.MORE else 'Sin cambios')
+        return
+
+    telegram.edit_message_text(update.chat_id, update.message_id, text,
+                               keyboard=keyboard)
+    telegram.answer_callback_query(update.callback_id)
+
+
 command_bici = make_search_command('bici', format_bikes, 'with_bikes')
 command_plaza = make_search_command('plaza', format_spaces, 'with_spaces')
 command_estacion = make_search_command('estacion', format_station, 'with_some_use')
 
+#: station format for the results of each query
+FORMATS = {
+    'with_bikes': format_bikes,
+    'with_spaces': format_spaces,
+    'with_some_use': format_station,
+}
+
 
 @coroutine
 def command_help(telegram, bicimad):
@@ -198,11 +381,195 @@ def command_help(telegram, bicimad):
         '* Puedes buscar una estación buscando por nombre '\
         'por ej: "/bici atocha"\n'\
         '* Es mucho más rápido darle a "compartir posición" y te '\
-        'diré todas las que tienes alrededor.\n\n'\
+        'diré todas las que tienes alrededor.\n'\
+        '* Si una estación está vacía, te aviso cuando tenga bicis '\
+        'con "/avisame 42"\n'\
+        '* Te digo cómo estará una estación en un rato con '\
+        '"/prevision 42"\n'\
+        '* Y con "/ruta sol" te digo dónde coger y dejar la bici\n\n'\
         'Vamos poco a poco añadiendo más posibilidades :)'
     telegram.send_message(update.chat_id, response)
 
 
+def format_alert(station, kind):
+    format = format_bikes if kind == 'bici' else format_spaces
+    return '¡Aviso! Ya hay {} en {!r}:\n\n{}'.format(
+        'bicis' if kind == 'bici' else 'plazas libres', station,
+        format(station))
+
+
+def parse_alert(arguments):
+    """(kind, station id) from "42" or "plaza 42" """
+    words = arguments.split()
+    kind = 'bici'
+    if words and words[0] in KINDS:
+        kind = words.pop(0)
+    return kind, to_int(' '.join(words))
+
+
+def make_alert_response(chat_id, arguments, bicimad):
+    alerts = getattr(bicimad, 'alerts', None)
+    if alerts is None:
+        return 'Ahora mismo no puedo avisarte, prueba más tarde.'
+
+    kind, sid = parse_alert(arguments)
+    if sid is None:
+        return 'Necesito el número de la estación, por ej: '\
+            '"/avisame 42" o "/avisame plaza 42".'
+
+    station = bicimad.stations.by_id(sid)
+    if station is None:
+        return 'Mmmm, no hay ninguna estación con id {}.'.format(sid)
+
+    if station.enabled and getattr(station, KINDS[kind]):
+        format = format_bikes if kind == 'bici' else format_spaces
+        return 'No hace falta, ya hay:\n\n{}'.format(format(station))
+
+    alerts.subscribe(chat_id, sid, kind)
+    return 'Vale, te aviso cuando haya {} en {!r}.'.format(
+        'bicis' if kind == 'bici' else 'plazas libres', station)
+
+
+@coroutine
+def command_avisame(telegram, bicimad):
+    update = yield
+    arguments = update.arguments
+
+    if not arguments:
+        response = 'Dime el número de la estación y te aviso cuando '\
+            'haya bicis, o "plaza" y el número para plazas libres.'
+        telegram.send_message(update.chat_id, response,
+                              force_reply=True, selective=True)
+        update = yield
+        arguments = getattr(update, 'text', '')
+
+    response = make_alert_response(update.chat_id, arguments, bicimad)
+    telegram.send_message(update.chat_id, response)
+
+
+def find_place(text, bicimad):
+    """Position of a place given by text, None if unknown
+
+    Street addresses are tried first, then station names.
+    """
+    located = gazetteer.locate(text)
+    if located is not None:
+        return located[2]
+
+    stations = bicimad.stations.by_search(text, max=1)
+    return stations[0].position if stations else None
+
+
+def format_route(routes):
+    if not routes:
+        return 'No encuentro estaciones con bicis cerca del origen y '\
+            'plazas cerca del destino.'
+
+    walk, pickup, dropoff = routes[0]
+    response = 'Coge la bici a {}m en {!r} ({} {}) y déjala a {}m del '\
+        'destino en {!r} ({} {}). Andarás unos {}m en total.'.format(
+            int(pickup.distance), pickup, pickup.bikes,
+            plural('bici', pickup.bikes), int(dropoff.distance), dropoff,
+            dropoff.spaces, plural('plaza', dropoff.spaces), int(walk))
+
+    if len(routes) > 1:
+        response += '\n\nTambién puedes ir:\n\n' + '\n'.join(
+            '- de {!r} a {!r}, andando {}m'.format(pickup, dropoff, int(walk))
+            for walk, pickup, dropoff in routes[1:])
+
+    return response
+
+
+@coroutine
+def command_ruta(telegram, bicimad):
+    update = yield
+    destination = None
+    if update.arguments:
+        destination = find_place(update.arguments, bicimad)
+        if destination is None:
+            telegram.send_message(update.chat_id, 'Uhh no me suena ese '
+                                  'destino. Afina un poco más.')
+            return
+
+    telegram.send_message(update.chat_id, 'Comparte tu posición y te busco '
+                          'una bici cerca.', force_reply=True, selective=True)
+    update = yield
+    if update.type != 'location':
+        telegram.send_message(update.chat_id, 'Necesito tu posición para '
+                              'buscar la ruta, prueba otra vez con /ruta.')
+        return
+    origin = update.location
+
+    if destination is None:
+        telegram.send_message(update.chat_id, '¿A dónde vas? Dime una '
+                              'dirección o comparte la posición del destino.',
+                              force_reply=True, selective=True)
+        update = yield
+        if update.type == 'location':
+            destination = update.location
+        else:
+            destination = find_place(getattr(update, 'text', ''), bicimad)
+        if destination is None:
+            telegram.send_message(update.chat_id, 'Uhh no me suena ese '
+                                  'destino. Afina un poco más.')
+            return
+
+    routes = bicimad.stations.by_route(origin, destination)
+    telegram.send_message(update.chat_id, format_route(routes))
+
+
+#: minutes ahead shown by /prevision
+FORECAST_MINUTES = (10, 20, 30)
+
+
+def format_prediction(prediction):
+    return '- en {} min: {:.0%} de que haya bicis y {:.0%} plazas'.format(
+        prediction.minutes, prediction.bikes, prediction.spaces)
+
+
+def make_forecast_response(arguments, bicimad):
+    sid = to_int(arguments)
+    if sid is None:
+        return 'Necesito el número de la estación, por ej: "/prevision 42".'
+
+    stations = bicimad.stations
+    station = stations.by_id(sid)
+    if station is None:
+        return 'Mmmm, no hay ninguna estación con id {}.'.format(sid)
+
+    if not station.enabled:
+        return 'Estación no disponible en {!r}'.format(station)
+
+    predictions = [stations.forecast(station, minutes)
+                   for minutes in FORECAST_MINUTES]
+    if predictions[0] is None:
+        return 'Ahora mismo no puedo hacer previsiones, prueba más tarde.'
+
+    response = 'Ahora hay {}\n\n{}'.format(
+        format_station(station).lstrip('- '),
+        '\n'.join(map(format_prediction, predictions)))
+    if not all(prediction.observations for prediction in predictions):
+        response += '\n\nAún tengo pocos datos de esta estación a esta hora.'
+    return response
+
+
+@coroutine
+def command_prevision(telegram, bicimad):
+    update = yield
+    arguments = update.arguments
+
+    if not arguments:
+        response = 'Dime el número de la estación y te digo cómo '\
+            'estará en un rato.'
+        telegram.send_message(update.chat_id, response,
+                              force_reply=True, selective=True)
+        update = yield
+        arguments = getattr(update, 'text', '')
+
+    response = make_forecast_response(arguments, bicimad)
+    telegram.send_message(update.chat_id, response)
+
+
 @coroutine
 def command_unknown(telegram, bicimad):
     update = yield
@@ -216,6 +583,9 @@ command_handlers = dict(
     plaza=command_plaza,
     help=command_help,
     estacion=command_estacion,
+    avisame=command_avisame,
+    prevision=command_prevision,
+    ruta=command_ruta,
 )
 
 
@@ -243,7 +613,14 @@ def make_location_response(update, bicimad, queryname):
     log.info(u'%r Got location from %r: lat: %f long: %f',
         update, update.sender, lat, long)
 
-    stations = bicimad.stations.by_distance(update.location)
+    stations = bicimad.stations.by_distance(update.location,
+                                            max=pages.MAX_RESULTS)
+    stations, keyboard = paginate(stations, update.chat_id, queryname,
+                                  located=True)
+    return format_location_response(stations, bicimad, queryname), keyboard
+
+
+def format_location_response(stations, bicimad, queryname):
     good, bad = divide_stations(bicimad, stations, queryname)
 
     message = ''
@@ -262,30 +639,144 @@ def make_location_response(update, bicimad, queryname):
 
 
 @coroutine
-def process_location_message(telegram, bicimad):
+def process_location_message(telegram, bicimad, live_sessions=None):
     update = yield
-    message = make_location_response(update, bicimad, 'with_some_use')
-    telegram.send_message(update.chat_id, message, reply_to=update.message_id)
+    if not update.live_period or live_sessions is None:
+        message, keyboard = make_location_response(
+            update, bicimad, 'with_some_use')
+        telegram.send_message(update.chat_id, message,
+                              reply_to=update.message_id, keyboard=keyboard)
+        return
+
+    log.info(u'%r Got live location from %r for %ds',
+             update, update.sender, update.live_period)
+    stations = bicimad.stations.by_distance(update.location)
+    message = format_location_response(stations, bicimad, 'with_some_use')
+    response = telegram.send_message(update.chat_id, message,
+                                     reply_to=update.message_id)
 
+    reply = live.reply_id(response)
+    if reply is not None:
+        live_sessions.start(update, reply, live.signature(stations))
 
-def process_message(update, telegram, bicimad, conversations={}):
-    """Process a new update"""
 
-    # Get or create conversation
-    convers = conversations.get(update.sender.id)
-    if convers is None:
-        log.info('Starting conversation with %r', update.sender)
-        convers = conversation(
-            lambda update: start_conversation(update, telegram, bicimad))
-        conversations[update.sender.id] = convers
+def process_live_location(update, telegram, bicimad, live_sessions):
+    """Edit the reply to a live location when nearby stations change
 
-    # next conversation step
-    if not send(convers, update):
-        del conversations[update.sender.id]
-        log.error('Finished conversation %r', update.sender.id)
+    Nearby stations are compared with the ones last sent, so the reply is
+    only edited when stations or their bikes and spaces change and not on
+    every position update.
+    """
+    session = live_sessions.get(update)
+    if session is None:
+        log.debug(u'%r Ignoring edit of unknown live location', update)
+        return
 
+    if not update.live_period:
+        log.info(u'%r Live location stopped by %r', update, update.sender)
+        live_sessions.stop(update)
+        return
 
-def start_conversation(update, telegram, bicimad):
+    stations = bicimad.stations.by_distance(update.location)
+    current = live.signature(stations)
+    if current == session.signature:
+        live_edits.inc(result='unchanged')
+        return
+
+    message = format_location_response(stations, bicimad, 'with_some_use')
+    telegram.edit_message_text(update.chat_id, session.reply_id, message)
+    session.signature = current
+    live_edits.inc(result='edited')
+
+
+@timed('inline')
+def process_inline_query(update, telegram, bicimad, answers=None):
+    """Answer stations matching the query, cached per snapshot"""
+    query = ' '.join(normalize(update.query).split())
+    if not query:
+        telegram.answer_inline_query(update.query_id, [])
+        return
+
+    stations = bicimad.stations
+    results = answers.get(stations.version, query) \
+        if answers is not None else None
+    inline_cached.inc(result='computed' if results is None else 'cached')
+    if results is None:
+        results = [inline.article(station, format_station(station))
+                   for station in stations.by_prefix(
+                       query, max=inline.MAX_RESULTS)]
+        if answers is not None:
+            answers.put(stations.version, query, results)
+
+    telegram.answer_inline_query(update.query_id, results,
+                                 cache_time=inline.DEFAULT_TTL)
+
+
+def slow_down(update, telegram, warn):
+    """Tell the user to slow down, in the cheapest possible way"""
+    log.info(u'%r Throttled update from %r', update, update.sender)
+    if update.type == 'callback':
+        telegram.answer_callback_query(update.callback_id,
+                                       'Más despacio, por favor')
+    elif warn and update.chat_id is not None \
+            and update.kind == 'message':
+        telegram.send_message(update.chat_id, 'Uff, más despacio. Dame '
+                              'unos segundos y vuelve a preguntar.')
+
+
+@timed('dispatch')
+def process_message(update, telegram, bicimad, conversations={},
+                    live_sessions=live_sessions,
+                    inline_answers=inline_answers, throttle=None):
+    """Process a new update
+
+    :param throttle: :class:`ratelimit.Throttle` applied to each sender
+    """
+    with correlate(update.id):
+        if throttle is not None and update.sender is not None:
+            allowed, warn = throttle.take(update.sender.id, category(update))
+            if not allowed:
+                slow_down(update, telegram, warn)
+                return
+
+        if update.kind == 'edited_message' and update.type == 'location':
+            process_live_location(update, telegram, bicimad, live_sessions)
+            return
+
+        if update.type == 'inline':
+            process_inline_query(update, telegram, bicimad, inline_answers)
+            return
+
+        if update.type == 'callback':
+            process_callback(update, telegram, bicimad)
+            return
+
+        if update.kind != 'message' or update.sender is None:
+            log.info(u'%r Ignoring %s update', update, update.kind)
+            return
+
+        if update.type == 'unknown':
+            # a photo, sticker... doesn't start or interrupt conversations
+            log.info(u'%r Unmanaged message from %r: %s',
+                     update, update.sender, update.message)
+            telegram.send_message(update.chat_id, u'No te pillo')
+            return
+
+        # Get or create conversation
+        convers = conversations.get(update.sender.id)
+        if convers is None:
+            log.info('Starting conversation with %r', update.sender)
+            convers = conversation(lambda update: start_conversation(
+                update, telegram, bicimad, live_sessions))
+            conversations[update.sender.id] = convers
+
+        # next conversation step
+        if not send(convers, update):
+            del conversations[update.sender.id]
+            log.error('Finished conversation %r', update.sender.id)
+
+
+def start_conversation(update, telegram, bicimad, live_sessions=None):
     """starts conversation type from first update message"""
     if update.type == 'text':
         return process_text_message(telegram, bicimad)
@@ -293,10 +784,5 @@ def start_conversation(update, telegram, bicimad):
     elif update.type == 'command':
         return process_command_message(telegram, bicimad)
 
-    elif update.type == 'location':
-        return process_location_message(telegram, bicimad)
-
     else:
-        log.info(u'(update: %d chat: %d) Unmanaged message from %r: %s',
-                update.id, update.chat_id, update.sender, update.message)
-        telegram.send_message(update.chat_id, u'No te pillo')
+        return process_location_message(telegram, bicimad, live_sessions)
@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
 import os
 import json
+import time
 import logging
 
 import click
 from bottle import ConfigDict
 
+from . import logs
 from . import bicimad
 from . import telegram
+from .offset import OffsetLog
+from .poller import Poller
 
 log = logging.getLogger('bicimad.cli')
 output_format = '%(asctime)s %(name)s %(levelname)-8s %(message)s'
@@ -19,9 +23,14 @@ def get_verbosity_level(index):
     return verbosity_levels[max(0, min(2, index))]
 
 
-def setup_logging(verbosity):
+def setup_logging(verbosity, json_format=False, sample=()):
     level = get_verbosity_level(verbosity)
-    logging.basicConfig(level=level, format=output_format)
+    try:
+        rates = logs.parse_rates(sample)
+    except ValueError as exc:
+        error(str(exc))
+    handler = logs.make_handler(json_format, rates, output_format)
+    logging.basicConfig(level=level, handlers=[handler])
 
 
 def error(message):
@@ -35,17 +44,191 @@ def cli():
 
 
 @cli.command()
-def start():
-    """Start server"""
+@click.option('-c', '--config', type=click.Path(dir_okay=False, exists=True))
+@click.option('-h', '--host', default='127.0.0.1')
+@click.option('-p', '--port', default=8080)
+@click.option('-w', '--workers', default=2, help='Worker processes')
+@click.option('-v', '--verbose', count=True, default=0)
+def serve(config, host, port, workers, verbose):
+    """Serve the webhook from several processes
+
+    Stops gracefully on SIGTERM, restarting workers that die until then.
+    """
+    from . import metrics
+    from . import prefork
     from .handlers import app
-    app.run()
+
+    setup_logging(verbose)
+    # $APP_CONFIG is loaded by the app itself
+    if config:
+        app.config.load_config(config)
+        metrics.registry.configure(app.config)
+    prefork.run(app.config, host, port, workers)
+
+
+@cli.command()
+@click.pass_context
+def start(context):
+    """Start server, as `serve` with the defaults"""
+    context.invoke(serve)
+
+
+@cli.command()
+@click.option('-s', '--sizes', default='250,10000,100000',
+              help='Comma separated number of stations of each city')
+@click.option('-r', '--repeat', default=100, help='Max runs per benchmark')
+@click.option('-b', '--budget', default=1.0,
+              help='Max seconds to spend per benchmark')
+@click.option('-k', '--only', multiple=True, help='Benchmark to run')
+@click.option('--stations', type=click.Path(dir_okay=False, exists=True),
+              help='Stations response to build the cities from')
+@click.option('-o', '--output', type=click.File('w'), default='-')
+def bench(sizes, repeat, budget, only, stations, output):
+    """Benchmark station queries and message handling"""
+    from . import bench
+
+    def progress(size, name):
+        click.echo('{} stations: {}'.format(size, name), err=True)
+
+    response = bench.load_response(stations)
+    sizes = [int(size) for size in sizes.split(',')]
+    report = bench.run(response, sizes, repeat=repeat, budget=budget,
+                       only=only, progress=progress)
+    json.dump(report, output, indent=4, sort_keys=True)
+    output.write('\n')
+
+
+@cli.command('fake-servers')
+@click.option('--host', default='127.0.0.1')
+@click.option('--telegram-port', default=8081)
+@click.option('--bonopark-port', default=8082)
+@click.option('--stations', type=click.Path(dir_okay=False, exists=True),
+              help='Stations response to serve')
+@click.option('--size', type=int, help='Number of synthetic stations')
+@click.option('--updates', type=int, help='Updates to serve, endless if unset')
+@click.option('--batch', default=100, help='Max updates per getUpdates')
+@click.option('--chats', default=100, help='Number of different users')
+@click.option('--latency', default=0.0, help='Seconds to answer a request')
+@click.option('--error-rate', default=0.0, help='Part of failed requests')
+@click.option('--ratelimit-rate', default=0.0,
+              help='Part of requests answered with 429')
+@click.option('--moves', default=10, help='Bikes moved per stations request')
+def fake_servers(host, telegram_port, bonopark_port, stations, size, updates,
+                 batch, chats, latency, error_rate, ratelimit_rate, moves):
+    """Serve local Telegram and Bonopark stand-ins for load testing
+
+    Point the bot to them with `telegram.host` and `bicimad.url`.
+    """
+    from . import bench
+    from . import fakes
+    from .server import Server
+
+    response = bench.load_response(stations)
+    if size:
+        response = bench.synthetic_city(response, size)
+
+    fake_telegram = fakes.FakeTelegram(
+        fakes.generate_updates(response['estaciones'], updates, chats),
+        batch=batch, latency=latency, error_rate=error_rate,
+        ratelimit_rate=ratelimit_rate)
+    fake_bonopark = fakes.FakeBonopark(response, moves=moves)
+
+    servers = [
+        Server(fakes.make_telegram_app(fake_telegram),
+                     host, telegram_port).start(),
+        Server(fakes.make_bonopark_app(fake_bonopark),
+                     host, bonopark_port).start(),
+    ]
+    click.echo('telegram.host = {}'.format(servers[0].url))
+    click.echo('bicimad.url = {}'.format(servers[1].url))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.stop()
+        click.echo(json.dumps(fake_telegram.calls, sort_keys=True))
+
+
+@cli.command()
+@click.argument('station', type=int, required=False)
+@click.option('-p', '--path', type=click.Path(file_okay=False, exists=True),
+              help='History folder, history.path from config by default')
+@click.option('-c', '--config', type=click.Path(dir_okay=False, exists=True))
+@click.option('-s', '--since', help='Start time, as in 2016-05-01T08:30')
+@click.option('-u', '--until', help='End time, as in 2016-05-01T09:30')
+def history(station, path, config, since, until):
+    """Show occupancy changes of a station
+
+    Lists the stations with history when no station is given.
+    """
+    from .history import History, parse_time, format_time
+
+    path = path or get_config(config).get('history.path') \
+        or error(u'Missing history.path in config')
+    try:
+        since, until = parse_time(since), parse_time(until)
+    except ValueError as exc:
+        error(str(exc))
+
+    records = History(path)
+    if station is None:
+        for id in records.stations():
+            click.echo(id)
+        return
+
+    for timestamp, bikes, spaces in records.query(station, since, until):
+        click.echo('{}\t{}\t{}'.format(format_time(timestamp), bikes, spaces))
+
+
+@cli.command()
+@click.option('-p', '--path', type=click.Path(file_okay=False, exists=True),
+              help='History folder, history.path from config by default')
+@click.option('-c', '--config', type=click.Path(dir_okay=False, exists=True))
+@click.option('-m', '--minutes', default=15, help='Minutes ahead to forecast')
+@click.option('-s', '--step', default=300,
+              help='Seconds between forecasts')
+@click.option('-w', '--warmup', default=7 * 24,
+              help='Hours of history to learn from before forecasting')
+@click.option('-a', '--alpha', default=0.1, help='Flows smoothing factor')
+@click.option('-o', '--output', type=click.File('w'), default='-')
+def forecast(path, config, minutes, step, warmup, alpha, output):
+    """Score station forecasts against recorded history"""
+    from .history import History
+    from .forecast import evaluate
+
+    path = path or get_config(config).get('history.path') \
+        or error(u'Missing history.path in config')
+    report = evaluate(History(path), minutes=minutes, step=step,
+                      warmup=warmup * 60 * 60, alpha=alpha)
+    json.dump(report, output, indent=4, sort_keys=True)
+    output.write('\n')
+
+
+@cli.command()
+@click.option('--stations', type=click.Path(dir_okay=False, exists=True),
+              help='Stations response to take the addresses from')
+@click.option('-o', '--output', type=click.File('w'), default='-')
+def gazetteer(stations, output):
+    """Build the streets file used to locate addresses"""
+    from . import bench
+    from .gazetteer import build, format_line
+
+    streets = build(bench.load_response(stations))
+    for street in streets.streets:
+        output.write(format_line(street) + '\n')
 
 
 @cli.group('telegram')
 @click.option('-v', '--verbose', count=True, default=0)
-def telegram_cli(verbose):
+@click.option('--log-json', is_flag=True, help='Log json lines')
+@click.option('--log-sample', multiple=True, metavar='LEVEL=RATE',
+              help='Keep only a part of the updates logs of a level, '
+              'as in INFO=0.01')
+def telegram_cli(verbose, log_json, log_sample):
     """Telegram commands"""
-    setup_logging(verbose)
+    setup_logging(verbose, log_json, log_sample)
 
 
 def telegram_options(function):
@@ -66,49 +249,80 @@ def telegram_options(function):
 def updates(config, offset, timeout):
     """See pending updates from given offset"""
     config, tgram_api, bmad_api = init_apis(config, offset, timeout)
-    click.echo('offset: {}'.format(config.get('telegram.offset')))
-    updates = tgram_api.get_updates(config.get('telegram.offset'))
+    offsets = load_offsets(config, offset)
+    click.echo('offset: {}'.format(offsets.offset))
+    updates = tgram_api.get_updates(offsets.offset)
     click.echo(json.dumps(updates, indent=4, sort_keys=True))
-    click.echo('offset: {}'.format(config.get('telegram.offset')))
+    click.echo('offset: {}'.format(offsets.offset))
 
 
 @telegram_cli.command()
 @telegram_options
 def update(config, offset, timeout):
     """Get new updates from the api"""
-    process_updates(config, offset, timeout)
+    poller = Poller(config or getenv('APP_CONFIG'), offset, timeout)
+    poller.poll_once()
+    poller.offsets.commit()
     click.secho('Done', fg='green')
 
 
 @telegram_cli.command()
 @telegram_options
-def poll(config, offset, timeout):
-    """Poll the api for new updates"""
-    while True:
-        try:
-            process_updates(config, offset, timeout)
-        except KeyboardInterrupt:
-            raise click.ClickException(u'Exiting')
-        except Exception as error:
-            msg = u'Catched error: {}'.format(str(error))
-            log.exception(msg)
-            click.secho(msg, fg='red')
-
-
-def save_offset(filename, config):
-    with open(filename, 'w') as stream:
-        json.dump({'telegram.offset': config.get('telegram.offset')}, stream)
+@click.option('-m', '--metrics-port', type=int,
+              help='Serve Prometheus metrics from this port')
+def poll(config, offset, timeout, metrics_port):
+    """Poll the api for new updates
 
-
-def get_offset(filename, config):
-    try:
-        with open(filename) as stream:
-            config.update(json.load(stream))
-    except OSError:
-        pass
+    Reloads the configuration on SIGHUP or when the file changes and stops
+    gracefully on SIGTERM.
+    """
+    poller = Poller(config or getenv('APP_CONFIG'), offset, timeout,
+                    metrics_port=metrics_port)
+    poller.install_signals()
+    poller.run()
+    raise click.ClickException(u'Exiting')
 
 
-OFFSET_FILE = '/tmp/bmad_offset.json'
+@telegram_cli.command()
+@click.argument('path', type=click.Path(dir_okay=False, exists=True))
+@click.option('-s', '--speed', default=0.0,
+              help='Time compression, 0 replays without waiting')
+@click.option('-f', '--fanout', default=1,
+              help='Times each update is sent by different users')
+@click.option('--telegram-host', help='Send requests to this host')
+@click.option('--bicimad-url', help='Get stations from this url')
+@click.option('--stations', type=click.Path(dir_okay=False, exists=True),
+              help='Stations response to answer with')
+@click.option('-o', '--output', type=click.File('w'), default='-')
+def replay(path, speed, fanout, telegram_host, bicimad_url, stations, output):
+    """Replay recorded getUpdates payloads and report capacity
+
+    Requests are only counted unless --telegram-host is given, for example
+    pointing to `bmad fake-servers`.
+    """
+    from . import bench
+    from .replay import Replayer, RecordingTelegram, read_payloads
+
+    tgram_api = RecordingTelegram(telegram_host or telegram.DEFAULT_HOST,
+                                  'replay', forward=bool(telegram_host))
+    if bicimad_url:
+        bmad_api = bicimad.BiciMad(bicimad_url, None, None, None)
+    else:
+        bmad_api = bench.static_bicimad(bicimad.Stations.from_response(
+            bench.load_response(stations)))
+
+    replayer = Replayer(tgram_api, bmad_api, speed=speed, fanout=fanout)
+    report = replayer.run(read_payloads(path))
+    json.dump(report, output, indent=4, sort_keys=True)
+    output.write('\n')
+
+
+def load_offsets(config, offset):
+    """Offset log from config, starting at `offset` if given"""
+    offsets = OffsetLog.from_config(config).load()
+    if offset:
+        offsets.reset(offset)
+    return offsets
 
 
 def getenv(name):
@@ -117,9 +331,7 @@ def getenv(name):
 
 
 def get_config(path):
-    config = ConfigDict().load_config(path or getenv('APP_CONFIG'))
-    get_offset(OFFSET_FILE, config)
-    return config
+    return ConfigDict().load_config(path or getenv('APP_CONFIG'))
 
 
 def init_apis(config, offset, timeout):
@@ -134,9 +346,3 @@ def init_apis(config, offset, timeout):
 
     return config, tgram_api, bmad_api
 
-
-def process_updates(config, offset, timeout):
-    config, tgram_api, bmad_api = init_apis(config, offset, timeout)
-    updates = tgram_api.get_updates(config.get('telegram.offset'))
-    telegram.process_updates(updates, config, tgram_api, bmad_api)
-    save_offset(OFFSET_FILE, config)
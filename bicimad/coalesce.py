@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Coalesce bursts of messages from the same chat in an updates batch
+
+Users often repeat a command or send a command and right away the location
+it asks for. Repeated queries are only answered once, and the replies to a
+chat are held until the end of the batch, where prompts already answered
+are dropped and plain replies are merged in a single message.
+"""
+from .metrics import registry
+
+
+#: longest message telegram takes
+MAX_TEXT = 4096
+
+#: message types whose replies can wait to the end of the batch
+TYPES = frozenset(['text', 'command', 'location'])
+
+coalesced = registry.counter(
+    'bicimad_coalesced_total',
+    'Repeated updates skipped and replies merged or dropped')
+
+
+def coalescible(update):
+    """Whether the update can be coalesced with others of its chat
+
+    Not live locations, their reply is edited later and its id is needed.
+    """
+    return update.kind == 'message' and update.type in TYPES \
+        and update.chat_id is not None \
+        and not getattr(update, 'live_period', None)
+
+
+def signature(update):
+    """What the user asked for, to find repeated queries"""
+    if update.type == 'location':
+        return update.type, update.location
+    return update.type, ' '.join(update.text.split()).lower()
+
+
+def repeated(updates):
+    """Ids of the updates asking the same as the next one in their chat"""
+    last = {}
+    ids = set()
+    for update in updates:
+        if not coalescible(update):
+            # the conversation may have changed in between
+            last.pop(update.chat_id, None)
+            continue
+
+        previous = last.get(update.chat_id)
+        if previous is not None and signature(previous) == signature(update):
+            ids.add(previous.id)
+        last[update.chat_id] = update
+
+    if ids:
+        coalesced.inc(len(ids), result='skipped')
+    return ids
+
+
+def plain(kwargs):
+    return 'reply_markup' not in kwargs
+
+
+def merge(calls):
+    """Requests with the replies to each chat merged where possible
+
+    Prompts are dropped when the chat got other messages after them.
+    Consecutive messages without keyboards are joined while they fit.
+    """
+    merged = []
+    for endpoint, kwargs in calls:
+        if endpoint != 'sendMessage':
+            merged.append((endpoint, kwargs))
+            continue
+
+        previous = merged[-1] if merged else (None, {})
+        if previous[0] == 'sendMessage' \
+                and previous[1]['chat_id'] == kwargs['chat_id']:
+            if previous[1].get('reply_markup', {}).get('force_reply'):
+                merged[-1] = endpoint, kwargs
+                coalesced.inc(result='dropped')
+                continue
+
+            text = previous[1]['text'] + '\n\n' + kwargs['text']
+            if plain(previous[1]) and plain(kwargs) \
+                    and len(text) <= MAX_TEXT:
+                merged[-1] = endpoint, dict(previous[1], text=text)
+                coalesced.inc(result='merged')
+                continue
+
+        merged.append((endpoint, kwargs))
+    return merged
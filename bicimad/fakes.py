@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Local stand-ins for the Telegram and Bonopark apis
+
+Used to measure throughput and latency offline, from the tests or through
+``bmad fake-servers``.
+"""
+import time
+import random
+import logging
+import threading
+import itertools
+
+from bottle import Bottle, request, response
+
+from .bicimad import ENDPOINT
+
+
+log = logging.getLogger('bicimad.fakes')
+
+
+class FakeTelegram:
+    """Telegram bot api state
+
+    Serves generated updates from ``getUpdates`` and accepts any other
+    method, answering after `latency` seconds. A `error_rate` part of the
+    requests fail and a `ratelimit_rate` part are answered with 429.
+    """
+
+    def __init__(self, updates=(), batch=100, latency=0, error_rate=0,
+                 ratelimit_rate=0, retry_after=1, seed=0):
+        self.updates = iter(updates)
+        self.pending = []
+        self.batch = batch
+        self.latency = latency
+        self.error_rate = error_rate
+        self.ratelimit_rate = ratelimit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+        #: requests received per method
+        self.calls = {}
+        #: parameters of the requests received, by method
+        self.sent = {}
+
+    def get_updates(self, params):
+        offset = params.get('offset') or 0
+        with self.lock:
+            self.pending = [u for u in self.pending if u['update_id'] >= offset]
+            missing = self.batch - len(self.pending)
+            self.pending.extend(itertools.islice(self.updates, max(0, missing)))
+            return {'ok': True, 'result': list(self.pending)}
+
+    def call(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            draw = self.random.random()
+            if draw < self.ratelimit_rate:
+                return 429, {'ok': False, 'error_code': 429,
+                             'description': 'Too Many Requests',
+                             'parameters': {'retry_after': self.retry_after}}
+            if draw < self.ratelimit_rate + self.error_rate:
+                return 500, {'ok': False, 'error_code': 500,
+                             'description': 'Internal Server Error'}
+            self.sent.setdefault(method, []).append(params)
+            message_id = next(self.message_ids)
+
+        result = dict(message_id=message_id, date=int(time.time()),
+                      chat={'id': params.get('chat_id')},
+                      text=params.get('text'))
+        return 200, {'ok': True, 'result': result}
+
+
+def generate_updates(stations, count=None, chats=100, start=1, seed=0):
+    """Stream of location, command and text updates
+
+    :param stations: stations response items used to pick positions and names
+    :param count: number of updates, endless if None
+    """
+    rng = random.Random(seed)
+    ids = itertools.count(start) if count is None \
+        else range(start, start + count)
+    for update_id in ids:
+        chat = rng.randint(1, chats)
+        station = rng.choice(stations)
+        message = {
+            'message_id': update_id,
+            'from': {'id': chat, 'first_name': 'User', 'last_name': str(chat)},
+            'chat': {'id': chat, 'first_name': 'User', 'last_name': str(chat)},
+            'date': int(time.time()),
+        }
+        draw = rng.random()
+        if draw < 0.5:
+            message['location'] = {'latitude': float(station['latitud']),
+                                   'longitude': float(station['longitud'])}
+        elif draw < 0.8:
+            command = rng.choice(('bici', 'plaza', 'estacion'))
+            message['text'] = '/{} {}'.format(command, station['nombre'])
+        elif draw < 0.9:
+            message['text'] = rng.choice(('/start', '/help'))
+        else:
+            message['text'] = 'hola'
+        yield {'update_id': update_id, 'message': message}
+
+
+def make_telegram_app(fake):
+    app = Bottle()
+
+    @app.post('/bot<token>/<method>')
+    def method(token, method):
+        params = request.json or {}
+        if method == 'getUpdates':
+            return fake.get_updates(params)
+
+        status, body = fake.call(method, params)
+        response.status = status
+        return body
+
+    return app
+
+
+class FakeBonopark:
+    """Bonopark stations feed with changing occupancy
+
+    Each request moves some bikes between random stations.
+    """
+
+    def __init__(self, response, moves=10, seed=0):
+        self.response = response
+        self.stations = [dict(s) for s in response['estaciones']]
+        self.moves = moves
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def get_stations(self):
+        with self.lock:
+            self.requests += 1
+            for _ in range(self.moves):
+                self.move()
+            return dict(self.response,
+                        estaciones=[dict(s) for s in self.stations])
+
+    def move(self):
+        origin = self.random.choice(self.stations)
+        target = self.random.choice(self.stations)
+        if int(origin['bicis_enganchadas']) and int(target['bases_libres']):
+            change(origin, -1)
+            change(target, 1)
+
+
+def change(station, bikes):
+    station['bicis_enganchadas'] = str(int(station['bicis_enganchadas']) + bikes)
+    station['bases_libres'] = str(int(station['bases_libres']) - bikes)
+
+
+def make_bonopark_app(fake):
+    app = Bottle()
+
+    @app.post(ENDPOINT)
+    def stations():
+        return fake.get_stations()
+
+    return app
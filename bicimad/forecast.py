@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""Short term bikes and spaces forecast per station
+
+Bikes arriving to and leaving each station are modelled as Poisson
+processes whose rates depend on the time of the day, with separate days for
+weekdays and weekends. Rates are exponential moving averages per station and
+15 minutes bin, learnt from the net change between station snapshots.
+
+Stations are only looked at when they change, and the change is spread over
+the bins since their previous change, so quiet periods count as no flow.
+"""
+import math
+import time
+import array
+import bisect
+import threading
+
+from .helpers import to_float
+
+
+DEFAULT_ALPHA = 0.1
+DEFAULT_MINUTES = 15
+BIN_MINUTES = 15
+DAY_BINS = 24 * 60 // BIN_MINUTES
+#: weekdays and weekends
+BINS = 2 * DAY_BINS
+
+
+def time_bin(timestamp):
+    """Bin of the time of the day, weekend days after the weekdays ones"""
+    moment = time.localtime(timestamp)
+    minutes = moment.tm_hour * 60 + moment.tm_min
+    return (moment.tm_wday >= 5) * DAY_BINS + minutes // BIN_MINUTES
+
+
+def bin_end(timestamp):
+    """Time when the bin of `timestamp` ends"""
+    moment = time.localtime(timestamp)
+    seconds = (moment.tm_min % BIN_MINUTES) * 60 + moment.tm_sec
+    return int(timestamp) - seconds + BIN_MINUTES * 60
+
+
+def poisson(mean, limit):
+    """Probabilities of 0 to `limit` events"""
+    probability = math.exp(-mean)
+    probabilities = [probability]
+    for count in range(1, limit + 1):
+        probability *= mean / count
+        probabilities.append(probability)
+    return probabilities
+
+
+def at_least_one(current, gained, lost):
+    """Probability of current + Poisson(gained) - Poisson(lost) >= 1"""
+    limit = int(max(gained, lost) + 10 * math.sqrt(max(gained, lost)) + 10)
+    gains = poisson(gained, limit)
+    losses = poisson(lost, limit + current)
+
+    # P(lost <= n)
+    cumulative = []
+    total = 0.0
+    for probability in losses:
+        total += probability
+        cumulative.append(total)
+
+    probability = 0.0
+    for count, gain in enumerate(gains):
+        most = min(current + count - 1, len(cumulative) - 1)
+        if most >= 0:
+            probability += gain * cumulative[most]
+    return min(1.0, max(0.0, probability))
+
+
+class Prediction:
+    __slots__ = ('minutes', 'bikes', 'spaces', 'expected', 'observations')
+
+    def __init__(self, minutes, bikes, spaces, expected, observations):
+        self.minutes = minutes
+        #: probability of some bikes
+        self.bikes = bikes
+        #: probability of some free spaces
+        self.spaces = spaces
+        #: expected number of bikes
+        self.expected = expected
+        #: times the rates used were updated
+        self.observations = observations
+
+    def __repr__(self):
+        return 'Prediction(minutes={}, bikes={:.2f}, spaces={:.2f})'.format(
+            self.minutes, self.bikes, self.spaces)
+
+
+class Flows:
+    """Arrival and departure rates of a station, in bikes per minute"""
+    __slots__ = ('arrivals', 'departures', 'observations')
+
+    def __init__(self):
+        self.arrivals = array.array('d', [0.0]) * BINS
+        self.departures = array.array('d', [0.0]) * BINS
+        self.observations = array.array('H', [0]) * BINS
+
+    def observe(self, bin, arrivals, departures, alpha):
+        # plain average until there are enough observations
+        count = self.observations[bin]
+        weight = max(alpha, 1.0 / (count + 1))
+        self.arrivals[bin] += weight * (arrivals - self.arrivals[bin])
+        self.departures[bin] += weight * (departures - self.departures[bin])
+        self.observations[bin] = min(count + 1, 0xffff)
+
+
+class Forecaster:
+    """Learns station flows from snapshots and forecasts availability
+
+    Updates take time proportional to the stations that changed and
+    predictions a constant time.
+    """
+
+    def __init__(self, alpha=DEFAULT_ALPHA, clock=time.time):
+        self.alpha = alpha
+        self.clock = clock
+        #: {station id: Flows}
+        self.flows = {}
+        #: {station id: (time, bikes)} of the last change
+        self.last = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        alpha = to_float(config.get('forecast.alpha'))
+        return cls(DEFAULT_ALPHA if alpha is None else alpha)
+
+    def observe(self, station_id, timestamp, bikes):
+        """Learn from the bikes of a station at `timestamp`"""
+        with self.lock:
+            last = self.last.get(station_id)
+            if last is not None and last[1] == bikes:
+                return
+            self.last[station_id] = timestamp, bikes
+            if last is None or timestamp <= last[0]:
+                return
+
+            flows = self.flows.get(station_id)
+            if flows is None:
+                flows = self.flows[station_id] = Flows()
+            self.spread(flows, last[0], timestamp, bikes - last[1])
+
+    def spread(self, flows, start, end, change):
+        """Update bins from `start` to `end` with the average change rate"""
+        rate = change * 60.0 / (end - start)
+        arrivals, departures = max(rate, 0.0), max(-rate, 0.0)
+        # a week at most, older bins would be overwritten anyway
+        start = max(start, end - 7 * 24 * 60 * 60)
+        while start < end:
+            flows.observe(time_bin(start), arrivals, departures, self.alpha)
+            start = bin_end(start)
+
+    def update(self, previous, current):
+        """Stations listener"""
+        timestamp = self.clock()
+        for station in current.stations:
+            before = previous.ids.get(station.id) \
+                if previous is not None else None
+            if before is None or before.bikes != station.bikes:
+                self.observe(station.id, timestamp, station.bikes)
+
+    def train(self, history):
+        """Learn from recorded :class:`history.History`"""
+        for station_id in history.stations():
+            for timestamp, bikes, spaces in history.query(station_id):
+                self.observe(station_id, timestamp, bikes)
+
+    def predict(self, station_id, bikes, spaces, minutes, timestamp=None):
+        """Availability of a station with `bikes` and `spaces` now"""
+        timestamp = self.clock() if timestamp is None else timestamp
+        flows = self.flows.get(station_id)
+        if flows is None:
+            return Prediction(minutes, float(bikes > 0), float(spaces > 0),
+                              float(bikes), 0)
+
+        gained = lost = 0.0
+        observations = None
+        start, end = timestamp, timestamp + minutes * 60
+        while start < end:
+            bin = time_bin(start)
+            span = (min(bin_end(start), end) - start) / 60.0
+            gained += flows.arrivals[bin] * span
+            lost += flows.departures[bin] * span
+            observations = flows.observations[bin] if observations is None \
+                else min(observations, flows.observations[bin])
+            start = bin_end(start)
+
+        return Prediction(minutes, at_least_one(bikes, gained, lost),
+                          at_least_one(spaces, lost, gained),
+                          min(max(bikes + gained - lost, 0), bikes + spaces),
+                          observations or 0)
+
+
+def state_at(times, records, timestamp):
+    """Record at or before `timestamp`"""
+    return records[bisect.bisect_right(times, timestamp) - 1]
+
+
+def evaluate(history, minutes=DEFAULT_MINUTES, step=300, warmup=7 * 86400,
+             alpha=DEFAULT_ALPHA):
+    """Score forecasts replaying recorded history
+
+    Every `step` seconds after `warmup` the availability in `minutes` is
+    forecast with what was learnt so far and compared with what actually
+    happened. Brier scores are given for the model and for a baseline that
+    expects the station to stay as it is, lower is better.
+    """
+    forecaster = Forecaster(alpha)
+    samples = 0
+    model = dict(bikes=0.0, spaces=0.0)
+    baseline = dict(bikes=0.0, spaces=0.0)
+
+    for station_id in history.stations():
+        records = history.query(station_id)
+        if not records:
+            continue
+        times = [record[0] for record in records]
+        horizon = minutes * 60
+        seen = 0
+        moment = times[0] + warmup
+        while moment + horizon <= times[-1]:
+            while seen < len(records) and times[seen] <= moment:
+                timestamp, bikes, spaces = records[seen]
+                forecaster.observe(station_id, timestamp, bikes)
+                seen += 1
+
+            _, bikes, spaces = state_at(times, records, moment)
+            _, later_bikes, later_spaces = state_at(
+                times, records, moment + horizon)
+            prediction = forecaster.predict(
+                station_id, bikes, spaces, minutes, moment)
+
+            for kind, now, later, probability in (
+                    ('bikes', bikes, later_bikes, prediction.bikes),
+                    ('spaces', spaces, later_spaces, prediction.spaces)):
+                outcome = float(later > 0)
+                model[kind] += (probability - outcome) ** 2
+                baseline[kind] += (float(now > 0) - outcome) ** 2
+
+            samples += 1
+            moment += step
+
+    def scores(totals):
+        return dict((kind, total / samples if samples else None)
+                    for kind, total in totals.items())
+
+    return dict(minutes=minutes, samples=samples,
+                brier=scores(model), baseline_brier=scores(baseline))
+
+
+def install(config, bicimad, forecaster=None):
+    """Learn flows from stations refreshes and recorded history
+
+    Reuses the given `forecaster`, if any.
+    """
+    if forecaster is None:
+        forecaster = Forecaster.from_config(config)
+        if bicimad.history is not None:
+            forecaster.train(bicimad.history)
+
+    bicimad.forecaster = forecaster
+    bicimad.listeners.append(forecaster.update)
+    return forecaster
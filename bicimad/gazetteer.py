@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""Offline street names to position lookup
+
+Streets are read from a bundled tab separated file with a line per street:
+normalized name, name and `number:lat:long` points separated by commas. The
+number is empty for points of the street without one. It is only loaded the
+first time an address is looked up.
+"""
+import re
+import bisect
+import pkgutil
+import threading
+
+import unidecode
+
+
+DATA = 'data/streets.tsv'
+
+#: words naming the kind of street, or joining names
+STOP_WORDS = frozenset("""
+c calle av avda avenida p po paseo pza plaza plazuela gta glta glorieta
+de del la las los el en y no n
+""".split())
+
+#: abbreviated words, as in 'Sta Engracia'
+ABBREVIATIONS = {
+    'sta': 'santa',
+    'sto': 'santo',
+    'sra': 'senora',
+    'sr': 'senor',
+    'dr': 'doctor',
+    'gral': 'general',
+}
+
+_NUMBER_RE = re.compile(r'\b(\d+)\b')
+_APOSTROPHE_RE = re.compile(r"['`\xb4]")
+# doubled consonants, not x so roman numbers as in 'Juan XXIII' are kept
+_DOUBLED_RE = re.compile(r'([bcdfghjklmnpqrstvwyz])\1+')
+_WORD_RE = re.compile(r'[a-z0-9]+')
+# 'No 8', 'nº8' or a trailing 'No'
+_NUMBER_SIGN_RE = re.compile(
+    r'\bn[o\xba]?\W?\s*(?=\d)|[\s,]+n[o\xba]?\W*$', re.IGNORECASE)
+# where the street name ends in addresses as 'Serrano esquina Goya'
+_CROSSING_RE = re.compile(r'\(|\besquina\b|\bc/v\b|\bcon\b|\bfrente\b|'
+                          r'\besq\b|-(?=\s*[^\W\d])', re.IGNORECASE)
+
+_gazetteer = None
+_lock = threading.Lock()
+
+
+def normalize(text):
+    """Street name words without accents, kinds of street or numbers
+
+    Abbreviations are expanded, and apostrophes and doubled consonants are
+    dropped, so 'Sta Engracia' is 'santa engracia' and both O'Donell and
+    ODonnell are 'odonel'.
+    """
+    text = _APOSTROPHE_RE.sub('', unidecode.unidecode(text).lower())
+    words = (ABBREVIATIONS.get(word, word) for word in _WORD_RE.findall(text))
+    return ' '.join(_DOUBLED_RE.sub(r'\1', word) for word in words
+                    if word not in STOP_WORDS
+                    and not any(char.isdigit() for char in word))
+
+
+def parse_address(text):
+    """(normalized street, number or None) from an address"""
+    text = _CROSSING_RE.split(unidecode.unidecode(text))[0]
+    text = _NUMBER_SIGN_RE.sub(' ', text)
+    numbers = _NUMBER_RE.findall(text)
+    # numbers that are part of the name, as in 'Doce de Octubre', are
+    # written with letters
+    number = int(numbers[0]) if numbers else None
+    return normalize(text), number
+
+
+class Street:
+    __slots__ = ('key', 'name', 'points')
+
+    def __init__(self, key, name, points):
+        self.key = key
+        self.name = name
+        #: [(number or None, lat, long)], numbered ones sorted
+        self.points = points
+
+    def position(self, number=None):
+        """Position of a number, interpolated between known ones"""
+        numbered = [point for point in self.points if point[0] is not None]
+        if number is None or not numbered:
+            points = self.points
+            return (sum(point[1] for point in points) / len(points),
+                    sum(point[2] for point in points) / len(points))
+
+        numbers = [point[0] for point in numbered]
+        index = bisect.bisect_left(numbers, number)
+        if index == 0:
+            return numbered[0][1:]
+        if index == len(numbered):
+            return numbered[-1][1:]
+
+        (low, lat1, long1), (high, lat2, long2) = \
+            numbered[index - 1], numbered[index]
+        part = (number - low) / float(high - low)
+        return lat1 + (lat2 - lat1) * part, long1 + (long2 - long1) * part
+
+    def __repr__(self):
+        return self.name
+
+
+class Gazetteer:
+    """Streets indexed by normalized name for prefix lookups"""
+
+    def __init__(self, streets):
+        self.streets = sorted(streets, key=lambda street: street.key)
+        self.keys = [street.key for street in self.streets]
+
+    @classmethod
+    def from_text(cls, text):
+        return cls(map(parse_line, text.splitlines()))
+
+    def __len__(self):
+        return len(self.streets)
+
+    def find(self, name):
+        """Street named `name` or the first one starting like it"""
+        key = normalize(name)
+        if not key:
+            return None
+
+        index = bisect.bisect_left(self.keys, key)
+        if index < len(self.keys) and self.keys[index].startswith(key):
+            return self.streets[index]
+        return None
+
+    def locate(self, address):
+        """(street, number, position) of an address, None if unknown"""
+        key, number = parse_address(address)
+        street = self.find(key)
+        if street is None:
+            return None
+        return street, number, street.position(number)
+
+
+def parse_line(line):
+    key, name, points = line.rstrip('\n').split('\t')
+    parsed = []
+    for point in points.split(','):
+        number, lat, long = point.split(':')
+        parsed.append((int(number) if number else None,
+                       float(lat), float(long)))
+    parsed.sort(key=lambda point: (point[0] is None, point[0] or 0))
+    return Street(key, name, parsed)
+
+
+def format_line(street):
+    return '{}\t{}\t{}'.format(street.key, street.name, ','.join(
+        '{}:{:.5f}:{:.5f}'.format('' if number is None else number, lat,
+                                  long)
+        for number, lat, long in street.points))
+
+
+def build(response):
+    """Streets from the addresses of a stations response"""
+    streets = {}
+    for station in response['estaciones']:
+        address = station['direccion'].strip()
+        key, number = parse_address(address)
+        if not key or address == 'NO OPERATIVA':
+            continue
+        name = _NUMBER_SIGN_RE.sub(' ', _CROSSING_RE.split(address)[0])
+        name = ' '.join(_NUMBER_RE.sub('', name).split()).strip(' ,.-')
+        street = streets.setdefault(key, Street(key, name, []))
+        point = (number, float(station['latitud']),
+                 float(station['longitud']))
+        if point not in street.points:
+            street.points.append(point)
+
+    for street in streets.values():
+        street.points.sort(key=lambda point: (point[0] is None,
+                                              point[0] or 0))
+    return Gazetteer(streets.values())
+
+
+def get_gazetteer():
+    """Bundled gazetteer, loaded on first use"""
+    global _gazetteer
+    if _gazetteer is None:
+        with _lock:
+            if _gazetteer is None:
+                text = pkgutil.get_data(__package__, DATA).decode('utf-8')
+                _gazetteer = Gazetteer.from_text(text)
+    return _gazetteer
+
+
+def locate(address):
+    """(street, number, position) of an address in the bundled gazetteer"""
+    return get_gazetteer().locate(address)
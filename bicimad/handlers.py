@@ -1,22 +1,133 @@
 # -*- coding: utf-8 -*-
 import os
 import logging
+import threading
 
-from bottle import request, Bottle, abort
+import requests
+from bottle import request, response, Bottle, abort, HTTPResponse
 
-from . import bicimad
+from . import metrics
 from . import telegram
+from .helpers import to_float
+from .scheduler import conversation_key
+from .workers import WorkerPool, Busy, Reply
 
 
 app = Bottle()
-app.config.load_config(os.getenv(u'APP_CONFIG'))
+if os.getenv(u'APP_CONFIG'):
+    app.config.load_config(os.getenv(u'APP_CONFIG'))
+    metrics.registry.configure(app.config)
 log = logging.getLogger('bicimad.app')
 
+#: Background workers, started on first use
+pool = None
+_pool_lock = threading.Lock()
 
-def process_updates(data, config):
-    tgram_api = telegram.Telegram.from_config(app.config)
-    bmad_api = bicimad.BiciMad.from_config(app.config)
-    telegram.process_updates(data, config, tgram_api, bmad_api)
+#: Stations shared by a prefork parent, see :mod:`bicimad.prefork`
+shared_bicimad = None
+
+#: Urls of the prefork workers, each one keeping the state of a share of
+#: the chats, and the number of this one
+peers = ()
+worker = None
+
+#: Seconds to wait for a peer on top of the reply timeout
+FORWARD_TIMEOUT = 5.0
+
+#: Commands answered with a single message
+FAST_REPLY_COMMANDS = frozenset(['start', 'help'])
+
+#: Seconds to wait for an answer to send in the webhook response
+DEFAULT_REPLY_TIMEOUT = 1.0
+
+
+def get_pool():
+    global pool
+    if pool is None:
+        with _pool_lock:
+            if pool is None:
+                pool = WorkerPool.from_config(
+                    app.config, shared_bicimad).start()
+    return pool
+
+
+def get_reply_timeout():
+    timeout = to_float(app.config.get('webhook.reply_timeout'))
+    return DEFAULT_REPLY_TIMEOUT if timeout is None else timeout
+
+
+def wants_fast_reply(update):
+    """Whether the update is usually answered with a single message
+
+    Live locations are not, their reply id is needed to edit it later.
+    """
+    return (update.type == 'location' and not update.live_period) or (
+        update.type == 'command' and update.command in FAST_REPLY_COMMANDS) \
+        or update.type == 'inline'
+
+
+def owner(update):
+    """Number of the worker keeping the state of the update chat, or None
+    when this one has to process it"""
+    if not peers:
+        return None
+    number = hash(conversation_key(update)[1]) % len(peers)
+    return None if number == worker else number
+
+
+def forward(number, token):
+    """Have worker `number` process the update, relaying its response"""
+    forwarded = requests.post(
+        '{}/webhook/{}'.format(peers[number], token),
+        data=request.body.read(),
+        headers={'Content-Type': 'application/json'},
+        timeout=get_reply_timeout() + FORWARD_TIMEOUT)
+    headers = dict((name, forwarded.headers[name])
+                   for name in ('Content-Type', 'Retry-After')
+                   if name in forwarded.headers)
+    return HTTPResponse(forwarded.content, status=forwarded.status_code,
+                        headers=headers)
+
+
+def worker_metrics(number):
+    """Metrics of worker `number`, labelled with it"""
+    if number == worker:
+        return metrics.registry.render([('worker', worker)])
+    try:
+        return requests.get('{}/metrics/worker'.format(peers[number]),
+                            timeout=FORWARD_TIMEOUT).text
+    except requests.RequestException as error:
+        log.warning(u'Could not get metrics of worker %d: %s', number, error)
+        return ''
+
+
+@app.get('/metrics')
+def serve_metrics():
+    """Metrics of this process, or of every worker under prefork"""
+    response.content_type = metrics.CONTENT_TYPE
+    if not peers:
+        return metrics.registry.render()
+    return metrics.merge(worker_metrics(number)
+                         for number in range(len(peers)))
+
+
+@app.get('/metrics/worker')
+def serve_worker_metrics():
+    if not peers:
+        abort(404, u'Not a prefork worker')
+    response.content_type = metrics.CONTENT_TYPE
+    return worker_metrics(worker)
+
+
+def parse_update(data):
+    """Update from webhook payload or None when it can't be managed"""
+    if not isinstance(data, dict) or 'update_id' not in data:
+        abort(400, u'Not an update')
+
+    try:
+        return telegram.Update.from_response(data)
+    except (KeyError, TypeError, ValueError):
+        log.info(u'Unmanaged update: %r', data)
 
 
 @app.post('/webhook/<token>')
@@ -25,4 +136,31 @@ def webhook(token):
         log.info(u'Unknown token: %s', token)
         abort(401, u'Not my token')
 
-    process_updates(request.json)
+    update = parse_update(request.json)
+    if update is None:
+        return ''
+
+    number = owner(update)
+    if number is not None:
+        try:
+            return forward(number, token)
+        except requests.RequestException as error:
+            # restarting, its state is lost anyway
+            log.warning(u'%r Could not forward to worker %d: %s',
+                        update, number, error)
+
+    timeout = get_reply_timeout()
+    reply = Reply() if timeout > 0 and wants_fast_reply(update) else None
+
+    try:
+        get_pool().submit(update, reply)
+    except Busy:
+        log.warning(u'%r Rejected update, workers are busy', update)
+        raise HTTPResponse(u'Busy', status=503, headers={'Retry-After': '1'})
+
+    # answer with the method call instead of making another request
+    call = reply.wait(timeout) if reply is not None else None
+    if call is not None:
+        return telegram.as_webhook_response(*call)
+
+    return ''
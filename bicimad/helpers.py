@@ -7,3 +7,22 @@ def to_int(text):
         return int(text)
     except (TypeError, ValueError):
         return None
+
+
+def to_float(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_bool(text):
+    """Boolean from config text, None when unset or unknown"""
+    if isinstance(text, bool):
+        return text
+    value = str(text).strip().lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    if value in ('0', 'false', 'no', 'off'):
+        return False
+    return None
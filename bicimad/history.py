@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""Station occupancy history
+
+Only changes are kept. Each one is a 4 bytes record with the seconds since
+the previous change of the station and its bikes and spaces after it, so a
+station moving a couple hundred bikes a day takes less than a KB per day.
+
+Recent changes are kept in memory and written to segment files every
+`history.segment` seconds. Segment files are immutable, hold the changes of
+each station one after the other and are read through mmap.
+"""
+import os
+import mmap
+import time
+import array
+import struct
+import logging
+import datetime
+import threading
+
+from .bicimad import Refresher, DEFAULT_TTL
+from .offset import atomic_write
+from .helpers import to_int
+
+
+DEFAULT_CAPACITY = 4096
+DEFAULT_SEGMENT = 24 * 60 * 60
+
+#: seconds since previous change, bikes, spaces
+RECORD = struct.Struct('<HBB')
+#: magic, number of stations, start and end time
+HEADER = struct.Struct('<4sIdd')
+#: station id, time of first record, records offset, number of records
+INDEX = struct.Struct('<IdII')
+MAGIC = b'BMH1'
+MAX_DELTA = 0xffff
+MAX_COUNT = 0xff
+EXTENSION = '.seg'
+
+log = logging.getLogger('bicimad.history')
+
+
+class Series:
+    """Occupancy changes of a station, in memory
+
+    Records are kept in arrays of seconds since the previous record, bikes
+    and spaces. When `capacity` is reached the oldest half is dropped.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        #: time of the first and last records
+        self.start = None
+        self.last = None
+        self.deltas = array.array('H')
+        self.bikes = array.array('B')
+        self.spaces = array.array('B')
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def append(self, timestamp, bikes, spaces):
+        """Record occupancy at `timestamp`, returns whether it changed"""
+        timestamp = int(timestamp)
+        bikes = min(max(bikes, 0), MAX_COUNT)
+        spaces = min(max(spaces, 0), MAX_COUNT)
+
+        if self.last is None:
+            self.start = self.last = timestamp
+            self.push(0, bikes, spaces)
+            return True
+
+        if bikes == self.bikes[-1] and spaces == self.spaces[-1]:
+            return False
+
+        delta = max(0, timestamp - self.last)
+        self.last += delta
+        # repeat last values to span gaps that don't fit in a record
+        while delta > MAX_DELTA:
+            self.push(MAX_DELTA, self.bikes[-1], self.spaces[-1])
+            delta -= MAX_DELTA
+        self.push(delta, bikes, spaces)
+        return True
+
+    def push(self, delta, bikes, spaces):
+        if len(self.deltas) >= self.capacity:
+            self.trim(len(self.deltas) // 2)
+        self.deltas.append(delta)
+        self.bikes.append(bikes)
+        self.spaces.append(spaces)
+
+    def trim(self, count):
+        """Drop the oldest `count` records"""
+        self.start += sum(self.deltas[1:count + 1])
+        del self.deltas[:count]
+        del self.bikes[:count]
+        del self.spaces[:count]
+        self.deltas[0] = 0
+
+    def tail(self, timestamp):
+        """New series starting with the current occupancy at `timestamp`"""
+        series = Series(self.capacity)
+        if self.last is not None:
+            series.append(max(timestamp, self.last),
+                          self.bikes[-1], self.spaces[-1])
+        return series
+
+    def records(self, since=None, until=None):
+        """(timestamp, bikes, spaces) changes in the time window"""
+        timestamp = self.start
+        for delta, bikes, spaces in zip(self.deltas, self.bikes, self.spaces):
+            timestamp += delta
+            if until is not None and timestamp > until:
+                return
+            if since is None or timestamp >= since:
+                yield timestamp, bikes, spaces
+
+    def to_bytes(self):
+        data = bytearray(len(self.deltas) * RECORD.size)
+        for number, record in enumerate(zip(
+                self.deltas, self.bikes, self.spaces)):
+            RECORD.pack_into(data, number * RECORD.size, *record)
+        return bytes(data)
+
+
+def write_segment(path, start, end, series):
+    """Write the {station id: series} records to a segment file"""
+    ids = sorted(id for id, records in series.items() if len(records))
+    offset = HEADER.size + len(ids) * INDEX.size
+    index = []
+    blocks = []
+    for id in ids:
+        records = series[id]
+        index.append(INDEX.pack(id, records.start, offset, len(records)))
+        blocks.append(records.to_bytes())
+        offset += len(blocks[-1])
+
+    header = HEADER.pack(MAGIC, len(ids), start, end)
+    atomic_write(path, b''.join([header] + index + blocks))
+
+
+class Segment:
+    """Read only segment file"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as stream:
+            self.map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count, self.start, self.end = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            self.map.close()
+            raise ValueError(u'Not a history segment: {}'.format(path))
+
+        #: {station id: (time of first record, offset, number of records)}
+        self.index = {}
+        for number in range(count):
+            id, first, offset, records = INDEX.unpack_from(
+                self.map, HEADER.size + number * INDEX.size)
+            self.index[id] = first, offset, records
+
+    def close(self):
+        self.map.close()
+
+    def overlaps(self, since, until):
+        return (since is None or self.end >= since) \
+            and (until is None or self.start <= until)
+
+    def records(self, station_id, since=None, until=None):
+        """(timestamp, bikes, spaces) changes in the time window"""
+        entry = self.index.get(station_id)
+        if entry is None:
+            return
+
+        timestamp, offset, count = entry
+        timestamp = int(timestamp)
+        block = self.map[offset:offset + count * RECORD.size]
+        for delta, bikes, spaces in RECORD.iter_unpack(block):
+            timestamp += delta
+            if until is not None and timestamp > until:
+                return
+            if since is None or timestamp >= since:
+                yield timestamp, bikes, spaces
+
+
+class History:
+    """Occupancy changes of every station
+
+    Without a `path` only the last `capacity` changes per station are kept
+    in memory.
+
+    :param segment: seconds of history per segment file
+    """
+
+    def __init__(self, path=None, capacity=DEFAULT_CAPACITY,
+                 segment=DEFAULT_SEGMENT, clock=time.time):
+        self.path = path
+        self.capacity = capacity
+        self.segment = segment
+        self.clock = clock
+        #: {station id: Series} since the current segment start
+        self.series = {}
+        self.segments = []
+        self.started = None
+        self.lock = threading.Lock()
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self.load()
+
+    @classmethod
+    def from_config(cls, config):
+        capacity = to_int(config.get('history.capacity'))
+        segment = to_int(config.get('history.segment'))
+        return cls(config.get('history.path'),
+                   capacity=DEFAULT_CAPACITY if capacity is None else capacity,
+                   segment=DEFAULT_SEGMENT if segment is None else segment)
+
+    def load(self):
+        """Open segment files in `path`"""
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith(EXTENSION):
+                try:
+                    self.segments.append(
+                        Segment(os.path.join(self.path, name)))
+                except (ValueError, struct.error) as error:
+                    log.error(u'Skipping history segment: %s', error)
+        self.segments.sort(key=lambda segment: segment.start)
+
+    def close(self):
+        self.flush()
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+    def record(self, stations, timestamp=None):
+        """Keep occupancy of the stations that changed"""
+        timestamp = self.clock() if timestamp is None else timestamp
+        with self.lock:
+            if self.started is not None \
+                    and timestamp >= self.started + self.segment:
+                self._flush(timestamp)
+            if self.started is None:
+                self.started = timestamp
+
+            for station in stations:
+                series = self.series.get(station.id)
+                if series is None:
+                    series = self.series[station.id] = Series(self.capacity)
+                series.append(timestamp, station.bikes, station.spaces)
+
+    def update(self, previous, current):
+        """Stations listener"""
+        self.record(current)
+
+    def flush(self):
+        """Write changes in memory to a segment file"""
+        with self.lock:
+            self._flush(self.clock())
+
+    def _flush(self, timestamp):
+        if self.path is None or self.started is None:
+            return
+
+        end = max([timestamp] + [series.last for series in
+                                 self.series.values() if series.last])
+        path = os.path.join(self.path, '{:d}-{:d}{}'.format(
+            int(self.started), int(end), EXTENSION))
+        write_segment(path, self.started, end, self.series)
+        self.segments.append(Segment(path))
+        log.info(u'Wrote history segment %s', path)
+
+        self.series = dict((id, series.tail(timestamp))
+                           for id, series in self.series.items())
+        self.started = timestamp
+
+    def stations(self):
+        """Ids of the stations with some history"""
+        with self.lock:
+            ids = set(self.series)
+            for segment in self.segments:
+                ids.update(segment.index)
+        return sorted(ids)
+
+    def query(self, station_id, since=None, until=None):
+        """(timestamp, bikes, spaces) changes of a station in a time window
+
+        The first record of each segment is the occupancy at its start, even
+        if it didn't change.
+        """
+        with self.lock:
+            segments = [segment for segment in self.segments
+                        if segment.overlaps(since, until)]
+            series = self.series.get(station_id)
+            recent = list(series.records(since, until)) \
+                if series is not None else []
+
+        records = []
+        for segment in segments:
+            records.extend(segment.records(station_id, since, until))
+        records.extend(recent)
+        return records
+
+
+def parse_time(text):
+    """Unix time from seconds or an ISO date as in 2016-05-01T08:30"""
+    if text is None:
+        return None
+
+    try:
+        return float(text)
+    except ValueError:
+        pass
+
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(text, format))
+        except ValueError:
+            continue
+
+    raise ValueError(u'Unknown time format: {}'.format(text))
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).isoformat()
+
+
+def install(config, bicimad, history=None):
+    """Record stations history if `history.path` is set
+
+    Reuses the given `history`, if any, and returns a refresher that fetches
+    stations every `history.interval` seconds, or None when disabled.
+    """
+    if history is None:
+        if not config.get('history.path'):
+            return None
+        history = History.from_config(config)
+
+    bicimad.history = history
+    bicimad.listeners.append(history.update)
+
+    interval = to_int(config.get('history.interval'))
+    return Refresher(bicimad, DEFAULT_TTL if interval is None else interval)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Answers to inline queries, as `@BiciMadBot sol` from any chat
+
+Inline queries are sent on every keystroke, so answers are kept for a few
+seconds by snapshot version and normalized query. A new stations snapshot
+makes older answers useless and they are dropped as they are found.
+"""
+import time
+import threading
+import collections
+
+
+DEFAULT_TTL = 10
+DEFAULT_SIZE = 10000
+#: results per answer, as many as telegram takes
+MAX_RESULTS = 50
+
+
+def article(station, text):
+    """Inline query result sending `text` about a station"""
+    return {
+        'type': 'article',
+        'id': str(station.id),
+        'title': station.address,
+        'description': text,
+        'input_message_content': {'message_text': text},
+    }
+
+
+class AnswerCache:
+    """Answers by (snapshot version, query) for `ttl` seconds
+
+    Only `size` answers are kept, the least recently used are dropped
+    first.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, size=DEFAULT_SIZE,
+                 clock=time.monotonic):
+        self.ttl = ttl
+        self.size = size
+        self.clock = clock
+        #: {(version, query): (expires, results)}
+        self.answers = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.answers)
+
+    def get(self, version, query):
+        """Cached results, None if missing or expired"""
+        key = version, query
+        with self.lock:
+            answer = self.answers.get(key)
+            if answer is None:
+                return None
+            if answer[0] < self.clock():
+                del self.answers[key]
+                return None
+            self.answers.move_to_end(key)
+            return answer[1]
+
+    def put(self, version, query, results):
+        with self.lock:
+            self.answers[version, query] = self.clock() + self.ttl, results
+            self.answers.move_to_end((version, query))
+            while len(self.answers) > self.size:
+                self.answers.popitem(last=False)
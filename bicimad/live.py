@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Replies kept up to date while users share their live location"""
+import time
+import threading
+import collections
+
+
+DEFAULT_SIZE = 10000
+
+
+def signature(stations):
+    """What a nearby stations reply shows, but distances, to compare cheaply"""
+    return tuple((station.id, station.enabled, station.bikes, station.spaces)
+                 for station in stations)
+
+
+def reply_id(response):
+    """Sent message id from a sendMessage response, if any"""
+    try:
+        return response['result']['message_id']
+    except (KeyError, TypeError):
+        return None
+
+
+class Session:
+    __slots__ = ('reply_id', 'signature', 'expires')
+
+    def __init__(self, reply_id, signature, expires):
+        self.reply_id = reply_id
+        self.signature = signature
+        self.expires = expires
+
+
+class LiveSessions:
+    """Bot reply for each live location being shared
+
+    Sessions are keyed by chat and the message holding the live location, as
+    its updates come as edits of that message. A session ends when the live
+    period is over or the user stops sharing. Only `size` sessions are kept,
+    the least recently updated are dropped first.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, clock=time.time):
+        self.size = size
+        self.clock = clock
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def start(self, update, reply_id, signature):
+        expires = update.message['date'] + update.live_period
+        with self.lock:
+            self.sessions[update.chat_id, update.message_id] = Session(
+                reply_id, signature, expires)
+            while len(self.sessions) > self.size:
+                self.sessions.popitem(last=False)
+
+    def get(self, update):
+        """Session for an edited live location, None if there is none"""
+        key = update.chat_id, update.message_id
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                return None
+            if session.expires < self.clock():
+                del self.sessions[key]
+                return None
+            self.sessions.move_to_end(key)
+            return session
+
+    def stop(self, update):
+        with self.lock:
+            self.sessions.pop((update.chat_id, update.message_id), None)
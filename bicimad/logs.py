@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Structured, sampled logging for update handling"""
+import json
+import logging
+import threading
+import contextlib
+
+
+_local = threading.local()
+
+
+def current_update():
+    """Id of the update being handled by this thread, if any"""
+    return getattr(_local, 'update', None)
+
+
+@contextlib.contextmanager
+def correlate(update_id):
+    """Tag log records emitted inside with the update id"""
+    previous = current_update()
+    _local.update = update_id
+    try:
+        yield
+    finally:
+        _local.update = previous
+
+
+class CorrelationFilter(logging.Filter):
+    """Adds `update` attribute with the current update id to records"""
+
+    def filter(self, record):
+        record.update = current_update()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a part of the records of the given levels
+
+    Records are sampled by update, so either all the lines of an update are
+    kept or none of them. Records not tied to an update and levels without
+    a rate are always kept.
+
+    :param rates: {level number: part of records to keep}
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        if rate is None or rate >= 1:
+            return True
+
+        update = getattr(record, 'update', None)
+        if update is None:
+            update = current_update()
+        if update is None:
+            return True
+
+        return spread(update) < rate
+
+
+def spread(number):
+    """Map consecutive ids evenly to [0, 1) with a multiplicative hash"""
+    return (number * 2654435761 % 2 ** 32) / 2.0 ** 32
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line"""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        update = getattr(record, 'update', None)
+        if update is not None:
+            data['update'] = update
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+def parse_rates(specs):
+    """{level: rate} from LEVEL=RATE strings, as in INFO=0.01"""
+    rates = {}
+    for spec in specs:
+        name, _, rate = spec.partition('=')
+        level = logging.getLevelName(name.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError(u'Unknown log level: {}'.format(name))
+        rates[level] = float(rate)
+    return rates
+
+
+def make_handler(json_format=False, rates=None, format=None):
+    """Stream handler with correlation ids and optional sampling"""
+    handler = logging.StreamHandler()
+    handler.addFilter(CorrelationFilter())
+    if rates:
+        handler.addFilter(SamplingFilter(rates))
+    handler.setFormatter(JsonFormatter() if json_format
+                         else logging.Formatter(format))
+    return handler
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""Update handling stage timings and counters in Prometheus format"""
+import time
+import random
+import threading
+import functools
+
+from bottle import Bottle, response
+
+from .helpers import to_float
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n')\
+        .replace('"', '\\"')
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                          for name, value in pairs) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, key, (), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        #: labels: [bucket counts..., sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.values.get(key)
+            if values is None:
+                values = self.values[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def get(self, **labels):
+        """Observations count"""
+        values = self.values.get(tuple(sorted(labels.items())))
+        return values[-1] if values else 0
+
+    def samples(self):
+        for key, values in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, values):
+                yield self.name + '_bucket', key, (('le', bound),), count
+            yield self.name + '_bucket', key, (('le', '+Inf'),), values[-1]
+            yield self.name + '_sum', key, (), values[-2]
+            yield self.name + '_count', key, (), values[-1]
+
+
+class Registry:
+    """Metrics to expose
+
+    Stage spans are only timed for a `sample_rate` part of the calls,
+    none by default. Counters are always kept.
+    """
+
+    def __init__(self, sample_rate=0):
+        self.sample_rate = sample_rate
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.stages = self.histogram(
+            'bicimad_stage_seconds', 'Time spent per update handling stage')
+        self.errors = self.counter(
+            'bicimad_stage_errors_total', 'Errors raised per stage')
+
+    def configure(self, config):
+        rate = to_float(config.get('metrics.sample_rate'))
+        self.sample_rate = 0 if rate is None else rate
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def sampled(self):
+        rate = self.sample_rate
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+    def render(self, labels=()):
+        """Metrics in Prometheus text exposition format
+
+        :param labels: (name, value) pairs added to every sample
+        """
+        labels = tuple(labels)
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP {} {}'.format(name, metric.help))
+            lines.append('# TYPE {} {}'.format(name, metric.type))
+            for sample, key, extra, value in metric.samples():
+                lines.append('{}{} {}'.format(
+                    sample, format_labels(labels + key, extra),
+                    format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+#: Default registry
+registry = Registry()
+
+
+def timed(stage):
+    """Record the time spent in the decorated function as `stage`
+
+    Only sampled calls are timed, the rest pay an attribute check.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not registry.sample_rate or not registry.sampled():
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                registry.errors.inc(stage=stage)
+                raise
+            finally:
+                registry.stages.observe(time.perf_counter() - start,
+                                        stage=stage)
+        return wrapper
+    return decorator
+
+
+def merge(texts):
+    """Join several renders, with the samples of each metric together
+
+    Renders should tell their samples apart with some label.
+    """
+    #: {name: ([comment lines], [sample lines])}
+    families = {}
+    for text in texts:
+        comments = samples = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                comments, samples = families.setdefault(
+                    line.split()[2], ([], []))
+                if line not in comments:
+                    comments.append(line)
+            elif line:
+                samples.append(line)
+
+    lines = []
+    for name, (comments, samples) in sorted(families.items()):
+        lines.extend(comments)
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+def make_app(registry=registry):
+    """Bottle app serving /metrics"""
+    app = Bottle()
+    add_route(app, registry)
+    return app
+
+
+def add_route(app, registry=registry):
+    @app.get('/metrics')
+    def metrics():
+        response.content_type = CONTENT_TYPE
+        return registry.render()
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import logging
+import tempfile
+import collections
+
+from .helpers import to_int
+
+
+DEFAULT_PATH = '/tmp/bmad_offset.json'
+DEFAULT_INTERVAL = 5
+DEFAULT_RECENT = 1000
+
+log = logging.getLogger('bicimad.offset')
+
+
+def atomic_write(path, data):
+    """Replace `path` contents with `data` without partial writes
+
+    Writes to a temporary file in the same folder, fsyncs it and renames it
+    over the destination, so readers see either the old or the new contents.
+    The folder is fsynced afterwards to make the rename itself durable.
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=folder,
+                               prefix='.' + os.path.basename(path) + '-')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') \
+                as stream:
+            stream.write(data)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+    try:
+        dirfd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dirfd)
+    except OSError:
+        pass
+    finally:
+        os.close(dirfd)
+
+
+class RecentIds:
+    """Bounded set of the last seen update ids"""
+
+    def __init__(self, size=DEFAULT_RECENT, ids=()):
+        self.size = size
+        self.order = collections.deque()
+        self.ids = set()
+        for id in ids:
+            self.add(id)
+
+    def add(self, id):
+        if id in self.ids:
+            return
+        self.order.append(id)
+        self.ids.add(id)
+        while len(self.order) > self.size:
+            self.ids.discard(self.order.popleft())
+
+    def __contains__(self, id):
+        return id in self.ids
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+
+class OffsetLog:
+    """Telegram update offset kept in memory and committed in batches
+
+    The offset is advanced in memory for each processed update and written
+    to disk atomically at most every `interval` seconds, along with a
+    bounded set of the most recent update ids. In between, each processed
+    update is appended to a journal next to it, which is replayed on load
+    and emptied on commit, so updates processed since the last commit are
+    skipped when Telegram sends them again after a crash.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, interval=DEFAULT_INTERVAL,
+                 recent=DEFAULT_RECENT, clock=time.monotonic):
+        self.path = path
+        self.interval = interval
+        self.clock = clock
+        self.offset = 0
+        self.recent = RecentIds(recent)
+        self.dirty = False
+        self.committed_at = clock()
+        self.journal = None
+
+    @classmethod
+    def from_config(cls, config):
+        interval = to_int(config.get('telegram.offset_interval'))
+        recent = to_int(config.get('telegram.offset_recent'))
+        return cls(config.get('telegram.offset_file') or DEFAULT_PATH,
+                   interval=DEFAULT_INTERVAL if interval is None else interval,
+                   recent=DEFAULT_RECENT if recent is None else recent)
+
+    def load(self):
+        """Read last committed offset and recent ids, if any"""
+        try:
+            with open(self.path) as stream:
+                data = json.load(stream)
+        except (OSError, ValueError) as error:
+            log.info(u'No previous offset at %s: %s', self.path, error)
+            return self
+
+        self.offset = data.get('telegram.offset') or 0
+        self.recent = RecentIds(self.recent.size, data.get('recent', ()))
+        log.debug(u'Loaded offset %d from %s', self.offset, self.path)
+        self.replay()
+        return self
+
+    @property
+    def journal_path(self):
+        return self.path + '.journal'
+
+    def replay(self):
+        """Apply the updates journaled after the last commit"""
+        try:
+            with open(self.journal_path) as stream:
+                lines = stream.read().splitlines()
+        except OSError:
+            return
+
+        for line in lines:
+            try:
+                operation, update_id = line.split()
+                update_id = int(update_id)
+            except ValueError:
+                # last line of a crash while writing it
+                continue
+            if operation == 'advance':
+                self.advance(update_id, journal=False)
+            elif operation == 'mark':
+                self.mark(update_id, journal=False)
+        if lines:
+            log.info(u'Replayed %d updates from %s', len(lines),
+                     self.journal_path)
+
+    def write_journal(self, operation, update_id):
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'a')
+        self.journal.write('{} {}\n'.format(operation, update_id))
+        # in the OS buffers, safe from the process dying
+        self.journal.flush()
+
+    def seen(self, update_id):
+        """Whether the update was already processed"""
+        return update_id < self.offset or update_id in self.recent
+
+    def advance(self, update_id, journal=True):
+        """Mark update as processed and move the offset past it"""
+        self.recent.add(update_id)
+        if update_id + 1 > self.offset:
+            self.offset = update_id + 1
+        self.dirty = True
+        if journal:
+            self.write_journal('advance', update_id)
+
+    def mark(self, update_id, journal=True):
+        """Mark update as processed, but earlier ones are still pending"""
+        self.recent.add(update_id)
+        self.dirty = True
+        if journal:
+            self.write_journal('mark', update_id)
+
+    def reset(self, offset):
+        """Force a given offset, as requested from the command line"""
+        self.offset = offset
+        self.dirty = True
+
+    def maybe_commit(self):
+        """Commit if there are changes and the interval has passed"""
+        if self.dirty and self.clock() - self.committed_at >= self.interval:
+            self.commit()
+
+    def commit(self):
+        """Write offset to disk atomically"""
+        if not self.dirty:
+            return
+        data = {'telegram.offset': self.offset, 'recent': list(self.recent)}
+        atomic_write(self.path, json.dumps(data))
+        if self.journal is not None:
+            self.journal.truncate(0)
+        self.dirty = False
+        self.committed_at = self.clock()
+        log.debug(u'Committed offset %d to %s', self.offset, self.path)
+
+    def close(self):
+        """Commit and close the journal"""
+        self.commit()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
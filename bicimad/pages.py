@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Pages of search and location results
+
+Replies show the first page of results with buttons to see the next one or
+refresh the current one. Results are kept sorted as station ids, so moving
+to the next page doesn't run the query again, and each page is rendered
+from the latest stations snapshot.
+"""
+import os
+import time
+import binascii
+import threading
+import collections
+
+
+DEFAULT_TTL = 10 * 60
+DEFAULT_SIZE = 10000
+PAGE_SIZE = 5
+#: results kept per cursor
+MAX_RESULTS = 25
+
+MORE = 'mas'
+REFRESH = 'actualizar'
+
+
+class Cursor:
+    """Sorted results and the page being shown
+
+    :param ids: station ids, in the order they are shown
+    :param distances: distance to each station, or None
+    :param queryname: stations query telling good results from bad
+    """
+    __slots__ = ('ids', 'distances', 'queryname', 'offset', 'expires')
+
+    def __init__(self, ids, distances, queryname):
+        self.ids = ids
+        self.distances = distances
+        self.queryname = queryname
+        self.offset = 0
+        self.expires = None
+
+    @classmethod
+    def from_stations(cls, stations, queryname, located=False):
+        return cls(tuple(station.id for station in stations),
+                   tuple(station.distance for station in stations)
+                   if located else None, queryname)
+
+    @property
+    def located(self):
+        return self.distances is not None
+
+    @property
+    def has_next(self):
+        return self.offset + PAGE_SIZE < len(self.ids)
+
+    def next(self):
+        if self.has_next:
+            self.offset += PAGE_SIZE
+
+    def page(self):
+        """(station id, distance or None) of the current page"""
+        end = self.offset + PAGE_SIZE
+        distances = self.distances[self.offset:end] if self.located \
+            else (None,) * PAGE_SIZE
+        return list(zip(self.ids[self.offset:end], distances))
+
+
+def keyboard(token, cursor):
+    """Inline keyboard to move through the results of a cursor"""
+    buttons = []
+    if cursor.has_next:
+        buttons.append(dict(text='Más', callback_data=MORE + ':' + token))
+    buttons.append(dict(text='Actualizar',
+                        callback_data=REFRESH + ':' + token))
+    return [buttons]
+
+
+def parse_data(data):
+    """(action, token) from a button callback data"""
+    action, _, token = (data or '').partition(':')
+    return action, token
+
+
+class Cursors:
+    """Cursors by chat and a random token, for `ttl` seconds
+
+    Only `size` cursors are kept, the least recently used are dropped first.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, size=DEFAULT_SIZE, clock=time.time):
+        self.ttl = ttl
+        self.size = size
+        self.clock = clock
+        self.cursors = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.cursors)
+
+    def add(self, chat_id, cursor):
+        """Keep a cursor, returns the token to get it back"""
+        # random, so buttons of a previous run don't get other results
+        token = binascii.hexlify(os.urandom(6)).decode('ascii')
+        cursor.expires = self.clock() + self.ttl
+        with self.lock:
+            self.cursors[chat_id, token] = cursor
+            while len(self.cursors) > self.size:
+                self.cursors.popitem(last=False)
+        return token
+
+    def get(self, chat_id, token):
+        """Cursor of a chat, None if unknown or expired"""
+        key = chat_id, token
+        with self.lock:
+            cursor = self.cursors.get(key)
+            if cursor is None:
+                return None
+            if cursor.expires < self.clock():
+                del self.cursors[key]
+                return None
+            self.cursors.move_to_end(key)
+            return cursor
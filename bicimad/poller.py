@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import os
+import signal
+import logging
+
+from bottle import ConfigDict
+
+from . import alerts
+from . import bicimad
+from . import history
+from . import forecast
+from . import metrics
+from . import telegram
+from . import ratelimit
+from . import scheduler
+from .offset import OffsetLog
+from .server import Server
+from .helpers import to_int, to_bool
+
+
+log = logging.getLogger('bicimad.poller')
+
+
+class Stopped(Exception):
+    """Raised to interrupt an idle long poll on shutdown"""
+
+
+class Poller:
+    """Long lived Telegram updates poll loop
+
+    Configuration, api clients, station caches, conversations and the update
+    offset are built once and kept across poll iterations. The configuration
+    file is only read again on SIGHUP or when it changes on disk. SIGTERM
+    stops the loop after the batch being processed is done and its offset is
+    committed.
+
+    Metrics are served from `metrics_port` (or `metrics.port`) if set.
+    Alert subscriptions, stations history, the forecast model and user rate
+    limits survive configuration reloads.
+    """
+
+    def __init__(self, path, offset=0, timeout=None, metrics_port=None):
+        self.path = path
+        self.timeout = timeout
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.config = None
+        self.mtime = None
+        self.telegram = None
+        self.bicimad = None
+        self.alerts = None
+        self.history = None
+        self.forecaster = None
+        self.refreshers = []
+        self.conversations = {}
+        self.throttle = None
+        self.running = False
+        self.busy = False
+        self.reload_requested = False
+
+        self.load()
+        self.offsets = OffsetLog.from_config(self.config).load()
+        if offset:
+            self.offsets.reset(offset)
+
+    def load(self):
+        """Read configuration and build api clients"""
+        self.mtime = self.get_mtime()
+        config = ConfigDict().load_config(self.path)
+        if self.timeout is not None:
+            config['telegram.poll_timeout'] = self.timeout
+
+        self.config = config
+        self.telegram = telegram.Telegram.from_config(config)
+        self.bicimad = bicimad.BiciMad.from_config(config)
+        self.install_listeners()
+        metrics.registry.configure(config)
+        if self.throttle is None:
+            self.throttle = ratelimit.Throttle.from_config(config)
+        else:
+            self.throttle.configure(config)
+        self.reload_requested = False
+        log.info(u'Loaded configuration from %s', self.path)
+
+    def install_listeners(self):
+        """Move alerts, history and forecasts to the current api clients"""
+        previous = self.refreshers
+        self.refreshers = [alerts.install(self.config, self.telegram,
+                                          self.bicimad, self.alerts)]
+        self.alerts = self.bicimad.alerts
+
+        refresher = history.install(self.config, self.bicimad, self.history)
+        self.history = self.bicimad.history
+        if refresher is not None:
+            self.refreshers.append(refresher)
+
+        self.forecaster = forecast.install(self.config, self.bicimad,
+                                          self.forecaster)
+
+        if any(refresher.thread is not None for refresher in previous):
+            for refresher in previous:
+                refresher.stop()
+            for refresher in self.refreshers:
+                refresher.start()
+
+    def get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def maybe_reload(self):
+        """Reload configuration if asked to or if the file changed"""
+        if self.reload_requested or self.get_mtime() != self.mtime:
+            try:
+                self.load()
+            except Exception:
+                self.reload_requested = False
+                self.mtime = self.get_mtime()
+                log.exception(u'Could not reload configuration from %s',
+                              self.path)
+
+    def start_metrics(self):
+        """Serve metrics from a side port, if configured"""
+        port = self.metrics_port or to_int(self.config.get('metrics.port'))
+        if port and self.metrics_server is None:
+            host = self.config.get('metrics.host') or '127.0.0.1'
+            self.metrics_server = Server(metrics.make_app(), host, port)
+            self.metrics_server.start()
+
+    def install_signals(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+    def handle_stop(self, signum, frame):
+        log.info(u'Got signal %d, stopping', signum)
+        self.running = False
+        if not self.busy:
+            raise Stopped()
+
+    def handle_reload(self, signum, frame):
+        log.info(u'Got signal %d, reloading configuration', signum)
+        self.reload_requested = True
+
+    def poll_once(self):
+        """Get and process one batch of updates"""
+        self.maybe_reload()
+        updates = self.telegram.get_updates(self.offsets.offset)
+
+        coalesce_chats = to_bool(self.config.get('telegram.coalesce'))
+        overload = to_int(self.config.get('telegram.overload'))
+        self.busy = True
+        try:
+            telegram.process_updates(updates, self.config, self.telegram,
+                                     self.bicimad, self.offsets,
+                                     coalesce_chats=bool(coalesce_chats),
+                                     overload=scheduler.DEFAULT_OVERLOAD
+                                     if overload is None else overload,
+                                     conversations=self.conversations,
+                                     throttle=self.throttle)
+        finally:
+            self.busy = False
+
+        self.offsets.maybe_commit()
+
+    def run(self):
+        """Poll until stopped"""
+        self.running = True
+        self.start_metrics()
+        for refresher in self.refreshers:
+            refresher.start()
+        try:
+            while self.running:
+                try:
+                    self.poll_once()
+                except (Stopped, KeyboardInterrupt):
+                    raise
+                except Exception as error:
+                    log.exception(u'Catched error: %s', error)
+        except (Stopped, KeyboardInterrupt):
+            log.info(u'Stopped')
+        finally:
+            self.running = False
+            self.offsets.close()
+            for refresher in self.refreshers:
+                refresher.stop()
+            if self.history is not None:
+                self.history.close()
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+                self.metrics_server = None
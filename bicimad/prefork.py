@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""Serve the webhook from several processes
+
+The parent binds the listening socket, forks the workers that accept on it
+and restarts them when they die. It is the only one fetching stations, each
+refresh is written to a snapshot file in shared memory, /dev/shm when there
+is one, and workers load it again only when it changes. The parent also
+records the history, and workers train their forecast from its files.
+
+Conversations, result pages, live locations and rate limits are kept by
+each worker, so every chat belongs to one of them. The parent also binds a
+local port for each worker, and updates arriving at another worker are
+forwarded there, see :func:`handlers.owner`.
+
+The parent runs no threads, so forking a worker again is safe.
+"""
+import os
+import json
+import time
+import errno
+import signal
+import shutil
+import logging
+import tempfile
+import functools
+import threading
+from wsgiref.simple_server import make_server
+
+from . import bicimad
+from . import history
+from .offset import atomic_write
+from .server import ThreadingWSGIServer, QuietHandler
+
+
+DEFAULT_WORKERS = 2
+SHARED_MEMORY = '/dev/shm'
+SNAPSHOT = 'stations.json'
+#: seconds between checks for dead workers
+TICK = 1.0
+
+log = logging.getLogger('bicimad.prefork')
+
+
+class PublishingBiciMad(bicimad.BiciMad):
+    """Stations api writing each response to a snapshot file"""
+
+    def __init__(self, path, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = path
+
+    @classmethod
+    def from_config(cls, config, path):
+        api = bicimad.BiciMad.from_config(config)
+        return cls(path, api.url, api.user, api.auth, api.security,
+                   ttl=api.ttl)
+
+    def get_locations(self):
+        response = super().get_locations()
+        atomic_write(self.path, json.dumps(response).encode('utf-8'))
+        return response
+
+
+class SharedBiciMad(bicimad.BiciMad):
+    """Stations read from the snapshot file of a :class:`PublishingBiciMad`
+
+    The file is only read again when it was replaced.
+    """
+
+    def __init__(self, path):
+        super().__init__(None, None, None, None)
+        self.path = path
+        #: (inode, modification time) of the file loaded
+        self.loaded = None
+
+    @property
+    def expired(self):
+        return self.snapshot is None or self.identity() != self.loaded
+
+    def identity(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def refresh(self):
+        """Load the snapshot, if it changed"""
+        if not self.expired:
+            return self.snapshot
+        return super().refresh()
+
+    def get_locations(self):
+        with open(self.path, 'rb') as stream:
+            stat = os.fstat(stream.fileno())
+            data = stream.read()
+        self.loaded = stat.st_ino, stat.st_mtime_ns
+        return json.loads(data.decode('utf-8'))
+
+
+def snapshot_folder():
+    """Temporary folder for the snapshot, in memory when possible"""
+    shared = SHARED_MEMORY if os.path.isdir(SHARED_MEMORY) else None
+    return tempfile.mkdtemp(prefix='bicimad-', dir=shared)
+
+
+class Prefork:
+    """Parent of the worker processes
+
+    :param server: bound wsgi server the workers serve from
+    :param bicimad: :class:`PublishingBiciMad` refreshed every `ttl`
+    :param serve: called in each new worker with the server and its number,
+        the worker exits when it returns. A restarted worker gets the
+        number of the dead one.
+    """
+
+    def __init__(self, server, bicimad, serve, workers=DEFAULT_WORKERS,
+                 clock=time.monotonic):
+        self.server = server
+        self.bicimad = bicimad
+        self.serve = serve
+        self.workers = workers
+        self.clock = clock
+        #: {pid: worker number}
+        self.pids = {}
+        self.running = False
+
+    def spawn(self, number):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                self.serve(self.server, number)
+                code = 0
+            except Exception:
+                log.exception(u'Worker %d failed', os.getpid())
+            finally:
+                os._exit(code)
+
+        log.info(u'Started worker %d as number %d', pid, number)
+        self.pids[pid] = number
+        return pid
+
+    def reap(self):
+        """Forget dead workers and start others in their place"""
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno != errno.ECHILD:
+                    raise
+                self.pids.clear()
+                break
+            if not pid:
+                break
+            if pid in self.pids:
+                del self.pids[pid]
+                log.warning(u'Worker %d exited with status %d', pid, status)
+
+        if self.running:
+            numbers = set(self.pids.values())
+            for number in range(self.workers):
+                if number not in numbers:
+                    self.spawn(number)
+
+    def refresh(self):
+        try:
+            self.bicimad.refresh()
+        except Exception:
+            log.exception(u'Could not refresh stations')
+
+    def run(self):
+        """Refresh stations and keep the workers alive until stopped"""
+        self.running = True
+        # workers need a snapshot to start with
+        self.refresh()
+        refreshed = self.clock()
+        self.reap()
+
+        while self.running:
+            time.sleep(TICK)
+            if self.clock() - refreshed >= self.bicimad.ttl:
+                self.refresh()
+                refreshed = self.clock()
+            self.reap()
+
+    def stop(self, *args):
+        self.running = False
+
+    def shutdown(self):
+        """Stop workers, letting them finish their queued updates"""
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError:
+                break
+            self.pids.pop(pid, None)
+        self.server.server_close()
+
+    def install_signals(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+
+def make_wsgi_server(app, host, port):
+    return make_server(host, port, app, server_class=ThreadingWSGIServer,
+                       handler_class=QuietHandler)
+
+
+def server_url(server):
+    host, port = server.server_address[:2]
+    return 'http://{}:{}'.format(host, port)
+
+
+def serve_webhook(server, number, peers):
+    """Serve the webhook app in a worker until SIGTERM
+
+    :param peers: local server of each worker, for updates forwarded to it
+    """
+    from . import handlers
+
+    own = peers[number]
+    for peer in peers:
+        if peer is not own:
+            peer.server_close()
+    handlers.worker = number
+    handlers.get_pool()
+
+    def stop(signum, frame):
+        # shutdown waits for serve_forever, which runs in this thread
+        thread = threading.Thread(target=server.shutdown)
+        thread.daemon = True
+        thread.start()
+
+    signal.signal(signal.SIGTERM, stop)
+    forwarded = threading.Thread(target=own.serve_forever,
+                                 kwargs={'poll_interval': 0.5})
+    forwarded.daemon = True
+    forwarded.start()
+
+    server.serve_forever(poll_interval=0.5)
+    own.shutdown()
+    handlers.pool.stop()
+
+
+def run(config, host, port, workers=DEFAULT_WORKERS):
+    """Serve the webhook app from `workers` processes until SIGTERM"""
+    from . import handlers
+
+    folder = snapshot_folder()
+    path = os.path.join(folder, SNAPSHOT)
+    publisher = PublishingBiciMad.from_config(config, path)
+    # only the parent sees every refresh, so it keeps the history
+    history.install(config, publisher)
+
+    handlers.shared_bicimad = SharedBiciMad(path)
+    server = make_wsgi_server(handlers.app, host, port)
+    peers = [make_wsgi_server(handlers.app, '127.0.0.1', 0)
+             for _ in range(workers)]
+    handlers.peers = [server_url(peer) for peer in peers]
+    log.info(u'Serving at http://%s:%d with %d workers', host, port, workers)
+
+    parent = Prefork(server, publisher, functools.partial(
+        serve_webhook, peers=peers), workers)
+    parent.install_signals()
+    try:
+        parent.run()
+    finally:
+        parent.shutdown()
+        for peer in peers:
+            peer.server_close()
+        if publisher.history is not None:
+            publisher.history.close()
+        shutil.rmtree(folder, ignore_errors=True)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Per user token buckets, so a single user can't keep the workers busy"""
+import time
+import threading
+import collections
+
+from .metrics import registry
+from .helpers import to_float
+
+
+DEFAULT_IDLE = 10 * 60
+DEFAULT_SIZE = 100000
+
+#: (tokens per second, burst) for each kind of update
+DEFAULT_LIMITS = {
+    'location': (0.5, 5),
+    'live': (0.5, 3),
+    'search': (0.5, 5),
+    'help': (0.2, 3),
+    'inline': (5.0, 20),
+    'callback': (1.0, 5),
+    'other': (0.5, 5),
+}
+
+#: commands that don't look up stations
+HELP_COMMANDS = frozenset(['start', 'help'])
+
+throttled = registry.counter(
+    'bicimad_throttled_updates_total',
+    'Updates dropped for going over the user rate limit, by kind')
+
+
+def category(update):
+    """Kind of update, each one with its own limits"""
+    if update.type == 'location':
+        return 'live' if update.kind == 'edited_message' else 'location'
+    if update.type == 'command':
+        return 'help' if update.command in HELP_COMMANDS else 'search'
+    if update.type in ('inline', 'callback'):
+        return update.type
+    return 'other'
+
+
+class Bucket:
+    __slots__ = ('tokens', 'updated', 'warned')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+        #: whether the user was told to slow down since last allowed
+        self.warned = False
+
+
+class Throttle:
+    """Token buckets by user and kind of update
+
+    Buckets are kept from least to most recently used, so the ones idle for
+    more than `idle` seconds are dropped from the front as others are used,
+    once they have refilled, as they are given back full. Past `size`
+    buckets the least recently used is dropped even if it was still
+    draining, and its user gets a full one back. That takes `size` users
+    and kinds active within less time than it takes to refill.
+    """
+
+    def __init__(self, limits=None, idle=DEFAULT_IDLE, size=DEFAULT_SIZE,
+                 clock=time.monotonic):
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self.idle = idle
+        self.size = size
+        self.clock = clock
+        self.buckets = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        throttle = cls()
+        throttle.configure(config)
+        return throttle
+
+    def configure(self, config):
+        """Read `throttle.KIND.rate` and `throttle.KIND.burst` limits"""
+        for kind, (rate, burst) in DEFAULT_LIMITS.items():
+            configured_rate = to_float(config.get(
+                'throttle.{}.rate'.format(kind)))
+            configured_burst = to_float(config.get(
+                'throttle.{}.burst'.format(kind)))
+            self.limits[kind] = (
+                rate if configured_rate is None else configured_rate,
+                burst if configured_burst is None else configured_burst)
+        idle = to_float(config.get('throttle.idle'))
+        self.idle = DEFAULT_IDLE if idle is None else idle
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def take(self, user_id, kind):
+        """Whether the user may do something more of that kind
+
+        :returns: (allowed, whether to tell the user to slow down)
+        """
+        rate, burst = self.limits[kind]
+        now = self.clock()
+        key = user_id, kind
+        with self.lock:
+            self.evict(now)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = Bucket(burst, now)
+            else:
+                bucket.tokens = min(
+                    burst, bucket.tokens + (now - bucket.updated) * rate)
+                bucket.updated = now
+                self.buckets.move_to_end(key)
+
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                bucket.warned = False
+                return True, False
+
+            warn = not bucket.warned
+            bucket.warned = True
+
+        throttled.inc(kind=kind)
+        return False, warn
+
+    def evict(self, now):
+        buckets = self.buckets
+        while len(buckets) >= self.size:
+            buckets.popitem(last=False)
+
+        while buckets:
+            (user_id, kind), oldest = next(iter(buckets.items()))
+            rate, burst = self.limits[kind]
+            idle = now - oldest.updated
+            if idle < self.idle or oldest.tokens + idle * rate < burst:
+                return
+            buckets.popitem(last=False)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Replay recorded getUpdates payloads to size the bot"""
+import json
+import time
+import copy
+import logging
+import itertools
+
+from . import telegram
+from .bench import percentile
+
+
+log = logging.getLogger('bicimad.replay')
+
+#: added to chat and user ids of each fan out copy
+FANOUT_ID_STEP = 10 ** 9
+
+
+class RecordingTelegram(telegram.Telegram):
+    """Telegram api that counts requests by the command being answered
+
+    Requests are only sent when `forward` is set, for example to a fake
+    server, otherwise they get a successful answer right away.
+    """
+
+    def __init__(self, host, token, forward=False, **kwargs):
+        super().__init__(host, token, **kwargs)
+        self.forward = forward
+        self.message_ids = itertools.count(1)
+        #: key of the update being processed
+        self.current = None
+        #: requests by update key and endpoint
+        self.calls = {}
+
+    def send_telegram(self, endpoint, **kwargs):
+        calls = self.calls.setdefault(self.current, {})
+        calls[endpoint] = calls.get(endpoint, 0) + 1
+
+        if self.forward:
+            return super().send_telegram(endpoint, **kwargs)
+
+        return {'ok': True, 'result': {
+            'message_id': next(self.message_ids),
+            'chat': {'id': kwargs.get('chat_id')}, 'text': kwargs.get('text')}}
+
+
+def read_payloads(path):
+    """getUpdates payloads from a json lines file or a single json file"""
+    with open(path) as stream:
+        content = stream.read()
+
+    try:
+        return [json.loads(content)]
+    except ValueError:
+        return [json.loads(line) for line in content.splitlines()
+                if line.strip()]
+
+
+def fan_out(update, copies):
+    """Copies of an update as if sent by `copies` different users"""
+    for number in range(copies):
+        copied = copy.deepcopy(update)
+        copied['update_id'] = update['update_id'] * copies + number
+        for kind in telegram.MESSAGE_KINDS:
+            message = copied.get(kind)
+            if message is None:
+                continue
+            for field in ('from', 'chat'):
+                if field in message:
+                    message[field]['id'] += number * FANOUT_ID_STEP
+        yield copied
+
+
+def batch_date(payload):
+    """Latest message date in a payload, if any"""
+    dates = [update[kind].get('date', 0)
+             for update in payload.get('result', ())
+             for kind in telegram.MESSAGE_KINDS if kind in update]
+    return max(dates) if dates else None
+
+
+def update_key(update):
+    """Name to group stats of an update by"""
+    return '/' + update.command if update.type == 'command' else update.type
+
+
+class Replayer:
+    """Feed payloads through :func:`telegram.process_updates`
+
+    :param speed: time compression, 10 plays ten times faster than recorded.
+        Payloads are played without waiting when it's 0.
+    :param fanout: times each update is repeated from different users
+    """
+
+    def __init__(self, telegram_api, bicimad_api, speed=0, fanout=1):
+        self.telegram = telegram_api
+        self.bicimad = bicimad_api
+        self.speed = speed
+        self.fanout = fanout
+        self.conversations = {}
+        self.config = {}
+        self.latencies = []
+        self.updates = {}
+
+    def run(self, payloads):
+        started = time.perf_counter()
+        previous = None
+        for payload in payloads:
+            date = batch_date(payload)
+            if self.speed and previous is not None and date is not None:
+                time.sleep(max(0, date - previous) / float(self.speed))
+            previous = date if date is not None else previous
+            self.play(payload)
+
+        return self.report(time.perf_counter() - started)
+
+    def play(self, payload):
+        if not payload.get('ok'):
+            log.error(u'Skipping bad payload: %r', payload)
+            return
+
+        for recorded in payload['result']:
+            for update in fan_out(recorded, self.fanout):
+                self.process(update)
+
+    def process(self, update):
+        parsed = telegram.Update.from_response(update)
+        key = update_key(parsed)
+        self.telegram.current = key
+        self.updates[key] = self.updates.get(key, 0) + 1
+
+        start = time.perf_counter()
+        telegram.process_updates({'ok': True, 'result': [update]},
+                                 self.config, self.telegram, self.bicimad,
+                                 conversations=self.conversations)
+        self.latencies.append(time.perf_counter() - start)
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        commands = dict(
+            (key, dict(updates=updates,
+                       calls=self.telegram.calls.get(key, {})))
+            for key, updates in self.updates.items())
+        return dict(
+            updates=count,
+            elapsed=elapsed,
+            updates_per_s=count / elapsed if elapsed else None,
+            p50=percentile(latencies, 50) if count else None,
+            p99=percentile(latencies, 99) if count else None,
+            commands=commands,
+        )
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Order the updates of a batch by how much users are waiting for them
+
+Locations, live ones included, commands, buttons and inline queries go
+first, then plain text, then updates nobody waits for, as other edits and
+unmanaged messages. Updates of
+the same chat keep their order, as they may be steps of a conversation.
+Under overload the least urgent updates are dropped.
+"""
+import collections
+
+from .metrics import registry
+
+
+#: scheduling classes, most urgent first
+PRIORITIES = ('interactive', 'text', 'background')
+INTERACTIVE_TYPES = frozenset(['command', 'location', 'callback', 'inline'])
+#: updates in a batch above which background ones are dropped
+DEFAULT_OVERLOAD = 50
+
+queue_wait = registry.histogram(
+    'bicimad_update_queue_seconds',
+    'Time updates wait in their batch before being processed, by priority')
+dropped = registry.counter(
+    'bicimad_dropped_updates_total',
+    'Updates dropped under overload, by priority')
+
+
+def classify(update):
+    """Scheduling class of an update"""
+    if update.kind in ('message', 'callback_query', 'inline_query') \
+            and update.type in INTERACTIVE_TYPES:
+        return 'interactive'
+    # live locations come as edits
+    if update.kind == 'edited_message' and update.type == 'location':
+        return 'interactive'
+    if update.kind == 'message' and update.type == 'text':
+        return 'text'
+    return 'background'
+
+
+def conversation_key(update):
+    if update.chat_id is not None:
+        return 'chat', update.chat_id
+    if update.sender is not None:
+        return 'user', update.sender.id
+    return 'update', update.id
+
+
+def schedule(updates, overload=DEFAULT_OVERLOAD):
+    """(updates in processing order, dropped updates) of a batch
+
+    An update can't go before earlier ones of its chat, so these are moved
+    forward along with it.
+    """
+    classes = [classify(update) for update in updates]
+    drop = overload is not None and len(updates) > overload
+
+    # best priority of each update and the later ones of its chat
+    effective = [None] * len(updates)
+    best = {}
+    for index in reversed(range(len(updates))):
+        key = conversation_key(updates[index])
+        priority = PRIORITIES.index(classes[index])
+        best[key] = min(priority, best.get(key, priority))
+        effective[index] = best[key]
+
+    order = sorted(range(len(updates)), key=effective.__getitem__)
+    scheduled = []
+    skipped = []
+    for index in order:
+        if drop and classes[index] == 'background':
+            dropped.inc(priority=classes[index])
+            skipped.append(updates[index])
+        else:
+            scheduled.append((updates[index], classes[index]))
+    return scheduled, skipped
+
+
+class Progress:
+    """Ids of a batch processed in any order, to advance the offset only
+    past the ones with every earlier update done"""
+
+    def __init__(self, ids):
+        self.pending = collections.deque(sorted(ids))
+        self.done = set()
+
+    def complete(self, update_id):
+        """Ids that can be advanced past now, in order"""
+        self.done.add(update_id)
+        ready = []
+        while self.pending and self.pending[0] in self.done:
+            ready.append(self.pending.popleft())
+        return ready
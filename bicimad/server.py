@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+
+log = logging.getLogger('bicimad.server')
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class Server:
+    """Serve a wsgi app from a background thread"""
+
+    def __init__(self, app, host='127.0.0.1', port=0):
+        self.server = make_server(host, port, app,
+                                  server_class=ThreadingWSGIServer,
+                                  handler_class=QuietHandler)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+        log.info(u'Serving at %s', self.url)
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
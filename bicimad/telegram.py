@@ -1,9 +1,17 @@
+import time
 import logging
 import datetime
+import threading
+import contextlib
+
 import requests
 
+from . import coalesce
+from . import scheduler
 from .bot import process_message
+from .logs import correlate
 from .helpers import urljoin, to_int
+from .metrics import timed
 
 
 DEFAULT_HOST = 'https://api.telegram.org'
@@ -11,22 +19,98 @@ DEFAULT_HOST = 'https://api.telegram.org'
 log = logging.getLogger('bicimad.telegram')
 
 
-def process_updates(updates, config, telegram, bicimad):
-    log.debug(u'Got updates: {}'.format(updates))
+def process_updates(updates, config, telegram, bicimad, offsets=None,
+                    coalesce_chats=False, overload=scheduler.DEFAULT_OVERLOAD,
+                    **kwargs):
+    """Process a getUpdates response
+
+    Updates are processed by priority, see :mod:`bicimad.scheduler`, and
+    with more than `overload` updates in the batch the least urgent are
+    dropped.
+
+    When an `offsets` log is given, updates already processed are skipped
+    and the offset is advanced on it as updates are done, otherwise the
+    offset is kept at `config['telegram.offset']`. It is only moved past
+    an update once all the earlier ones are done.
+
+    With `coalesce_chats`, repeated queries from a chat are answered once
+    and the replies to each chat are sent merged at the end of the batch,
+    see :mod:`bicimad.coalesce`. Their updates are only done once the
+    replies to their chat were sent.
+
+    Extra keyword arguments are passed to :func:`process_message`.
+    """
+    log.debug(u'Got updates: %r', updates)
     if not updates.get('ok'):
         log.error(u'Got bad update response: %r',
                   updates.get('description', u'Unknown'))
         return
 
-    last_update = config.get('telegram.offset', 0)
+    last_update = config.get('telegram.offset', 0) \
+        if offsets is None else offsets.offset
     log.debug('Current update offset: %d', last_update)
 
+    batch = []
     for update in map(Update.from_response, updates['result']):
-        log.debug('(update: %d) Update offset: %d to %d',
-                    update.id, last_update, update.id)
-        last_update = update.id + 1
-
-        process_message(update, telegram, bicimad)
+        if offsets is not None and offsets.seen(update.id):
+            log.info('(update: %d) Skipping already processed update',
+                     update.id)
+        else:
+            batch.append(update)
+    repeated = coalesce.repeated(batch) if coalesce_chats else ()
+    #: {chat id: ([update], [captured call])}
+    held = {}
+    started = time.perf_counter()
+    scheduled, dropped = scheduler.schedule(batch, overload)
+    progress = scheduler.Progress(update.id for update in batch)
+
+    for update in dropped:
+        log.warning(u'%r Dropping update under overload', update)
+
+    def done(update):
+        ready = progress.complete(update.id)
+        if offsets is not None:
+            for update_id in ready:
+                offsets.advance(update_id)
+            if update.id not in ready:
+                offsets.mark(update.id)
+        return max([last_update] + [update_id + 1 for update_id in ready])
+
+    for update in dropped:
+        last_update = done(update)
+
+    for update, priority in scheduled:
+        with correlate(update.id):
+            scheduler.queue_wait.observe(time.perf_counter() - started,
+                                         priority=priority)
+            log.debug('(update: %d) Update offset: %d to %d',
+                      update.id, last_update, update.id)
+
+            if update.id in repeated:
+                log.info(u'%r Skipping repeated update', update)
+            elif coalesce_chats and coalesce.coalescible(update):
+                with telegram.capture() as calls:
+                    process_message(update, telegram, bicimad, **kwargs)
+                chat_updates, chat_calls = held.setdefault(
+                    update.chat_id, ([], []))
+                chat_updates.append(update)
+                chat_calls.extend(calls)
+                continue
+            else:
+                process_message(update, telegram, bicimad, **kwargs)
+
+            last_update = done(update)
+
+    for chat_id in sorted(held, key=str):
+        chat_updates, chat_calls = held[chat_id]
+        try:
+            telegram.send_captured(coalesce.merge(chat_calls))
+        except Exception:
+            # not done, so they are fetched and answered again
+            log.exception(u'Could not send replies to chat %s', chat_id)
+            continue
+        for update in chat_updates:
+            last_update = done(update)
 
     log.debug(u'Last offset: %d', last_update)
     config['telegram.offset'] = last_update
@@ -39,18 +123,48 @@ class Telegram:
         self.timeout = 5 if timeout is None else timeout
         #: max time to wait to the server to send data (see get_updates)
         self.poll_timeout = 300 if poll_timeout is None else poll_timeout
+        #: requests kept per thread while capturing replies
+        self.captured = threading.local()
 
     @classmethod
     def from_config(cls, config):
-        return cls(DEFAULT_HOST, config.get('telegram.token'),
+        return cls(config.get('telegram.host') or DEFAULT_HOST,
+                   config.get('telegram.token'),
                    timeout=to_int(config.get('telegram.timeout')),
                    poll_timeout=to_int(config.get('telegram.poll_timeout')))
 
+    @timed('send')
     def send_telegram(self, endpoint, **kwargs):
         """Send generic telegram api requests"""
+        calls = getattr(self.captured, 'calls', None)
+        if calls is not None:
+            calls.append((endpoint, kwargs))
+            return {'ok': True, 'result': None}
+
         return requests.post(urljoin(self.url, endpoint),
                             timeout=self.timeout, json=kwargs).json()
 
+    @contextlib.contextmanager
+    def capture(self):
+        """Keep requests made from this thread instead of sending them
+
+        Yields the list where the (endpoint, params) pairs are kept, so they
+        can be answered in a webhook response or sent later with
+        :meth:`send_captured`. Captured requests get an empty successful
+        result, so it is only suitable for handlers that don't use it.
+        """
+        calls = []
+        self.captured.calls = calls
+        try:
+            yield calls
+        finally:
+            self.captured.calls = None
+
+    def send_captured(self, calls):
+        """Send requests kept by :meth:`capture`"""
+        for endpoint, kwargs in calls:
+            self.send_telegram(endpoint, **kwargs)
+
     def get_updates(self, offset=0):
         """Get input updates from the server
 
@@ -75,16 +189,40 @@ class Telegram:
                             timeout=timeout, json=params).json()
 
     def send_message(self, chat_id, text, reply_to=None, force_reply=None,
-                     selective=None):
+                     selective=None, keyboard=None):
+        """Send a text message
+
+        :param keyboard: rows of inline keyboard buttons
+        """
         kwargs = dict(chat_id=chat_id, text=text)
         if force_reply:
             kwargs['reply_markup'] = dict(force_reply=True)
+        if keyboard:
+            kwargs['reply_markup'] = dict(inline_keyboard=keyboard)
         if reply_to:
             kwargs['reply_to_message_id'] = reply_to
         if selective is not None:
             kwargs['selective'] = bool(selective)
         return self.send_telegram('sendMessage', **kwargs)
 
+    def edit_message_text(self, chat_id, message_id, text, keyboard=None):
+        kwargs = dict(chat_id=chat_id, message_id=message_id, text=text)
+        if keyboard:
+            kwargs['reply_markup'] = dict(inline_keyboard=keyboard)
+        return self.send_telegram('editMessageText', **kwargs)
+
+    def answer_callback_query(self, callback_query_id, text=None):
+        kwargs = dict(callback_query_id=callback_query_id)
+        if text is not None:
+            kwargs['text'] = text
+        return self.send_telegram('answerCallbackQuery', **kwargs)
+
+    def answer_inline_query(self, inline_query_id, results, cache_time=None):
+        kwargs = dict(inline_query_id=inline_query_id, results=results)
+        if cache_time is not None:
+            kwargs['cache_time'] = cache_time
+        return self.send_telegram('answerInlineQuery', **kwargs)
+
     def send_location(self, chat_id, latitude, longitude, reply_to=None):
         kwargs = dict(chat_id=chat_id, latitude=latitude, longitude=longitude)
         if reply_to:
@@ -92,8 +230,15 @@ class Telegram:
         return self.send_telegram('sendLocation', **kwargs)
 
 
+def as_webhook_response(endpoint, kwargs):
+    """Method call to be sent back as a webhook response body"""
+    return dict(kwargs, method=endpoint)
+
+
 class User:
-    def __init__(self, id, first_name, last_name, **kwargs):
+    __slots__ = ('id', 'first_name', 'last_name')
+
+    def __init__(self, id, first_name, last_name=None, **kwargs):
         self.id = id
         self.first_name = first_name
         self.last_name = last_name
@@ -107,12 +252,11 @@ class User:
 
     def __str__(self):
         return '(name="{} {}", id={})'.format(
-            self.first_name, self.last_name, self.id)
+            self.first_name, self.last_name or '', self.id)
 
 
 class Update:
-    def __init__(self, update):
-        """Load from Telegram Update
+    """Load from Telegram Update
 
     {
       "update_id": 987235638,
@@ -132,17 +276,25 @@ class Update:
         "text": "/bici"
       }
     }
-        """
+
+    Sender and date are only parsed when used.
+    """
+    __slots__ = ('raw', 'id', 'kind', 'message', '_sender', '_date')
+
+    #: message content type
+    type = 'unknown'
+
+    def __init__(self, update, kind='message'):
         self.raw = update
         self.id = update['update_id']
-        self.message = update['message']
-        self.message_id = self.message['message_id']
-        self.sender = User.from_response(self.message['from'])
-        self.chat = self.message['chat']
-        self.chat_id = self.chat['id']
-        self.date = datetime.datetime.fromtimestamp(self.message.get('date'))
+        #: update field with the content: message, edited_message...
+        self.kind = kind
+        self.message = update.get(kind)
+        self._sender = None
+        self._date = None
 
     @classmethod
+    @timed('parse')
     def from_response(cls, update):
         """Create update from a Telegram response Update
 
@@ -152,43 +304,67 @@ class Update:
         :param update: `from_dict` method
         :returns: Update subtype instance
         """
-        for subcls in cls.__subclasses__():
-            if subcls.accepts(update):
-                return subcls(update)
+        for kind in MESSAGE_KINDS:
+            message = update.get(kind)
+            if message is not None:
+                return message_type(message)(update, kind)
+
+        for kind, type in UPDATE_TYPES.items():
+            if kind in update:
+                return type(update, kind)
+
+        kind = next((key for key in update if key != 'update_id'), None)
+        return UnknownUpdate(update, kind)
+
+    @property
+    def message_id(self):
+        return self.message['message_id'] if self.message else None
+
+    @property
+    def chat(self):
+        return self.message['chat'] if self.message else None
+
+    @property
+    def chat_id(self):
+        return self.message['chat']['id'] if self.message else None
+
+    @property
+    def sender(self):
+        if self._sender is None and self.message and 'from' in self.message:
+            self._sender = User.from_response(self.message['from'])
+        return self._sender
+
+    @property
+    def date(self):
+        if self._date is None and self.message:
+            self._date = datetime.datetime.fromtimestamp(self.message['date'])
+        return self._date
 
     def __str__(self):
-        return '(update=%d, chat=%d)' % (self.id, self.chat_id)
+        return '(update=%d, chat=%s)' % (self.id, self.chat_id)
 
     def __repr__(self):
         return type(self).__name__ + str(self)
 
 
 class TextUpdate(Update):
+    __slots__ = ('text',)
     type = 'text'
 
-    def __init__(self, data):
-        super().__init__(data)
+    def __init__(self, data, kind='message'):
+        super().__init__(data, kind)
         self.text = self.message['text']
 
-    @staticmethod
-    def accepts(update):
-        text = update['message'].get('text')
-        return text is not None and not is_command(text)
-
 
 class CommandUpdate(Update):
+    __slots__ = ('text', 'command', 'arguments')
     type = 'command'
 
-    def __init__(self, data):
-        super().__init__(data)
+    def __init__(self, data, kind='message'):
+        super().__init__(data, kind)
         self.text = self.message['text']
         self.command, self.arguments = self.parse_command(self.text)
 
-    @staticmethod
-    def accepts(update):
-        text = update['message'].get('text')
-        return text and is_command(text)
-
     def parse_command(self, text):
         parsed = text.split(' ', 1)
         command = parsed[0].strip('/')
@@ -197,17 +373,101 @@ class CommandUpdate(Update):
 
 
 class LocationUpdate(Update):
+    """Location message
+
+    Live locations have the seconds they are shared for as `live_period`,
+    position changes are sent as edits of the same message.
+    """
+    __slots__ = ('location', 'live_period')
     type = 'location'
 
-    def __init__(self, data):
-        super().__init__(data)
-        self.location = (self.message['location']['latitude'],
-                         self.message['location']['longitude'])
+    def __init__(self, data, kind='message'):
+        super().__init__(data, kind)
+        location = self.message['location']
+        self.location = (location['latitude'], location['longitude'])
+        self.live_period = location.get('live_period')
+
+
+class CallbackUpdate(Update):
+    """Inline keyboard button press
+
+    The message is the one holding the keyboard, if it was sent by the bot.
+    """
+    __slots__ = ('callback', 'callback_id', 'data')
+    type = 'callback'
+
+    def __init__(self, data, kind='callback_query'):
+        super().__init__(data, kind)
+        self.callback = self.message
+        self.message = self.callback.get('message')
+        self.callback_id = self.callback['id']
+        self.data = self.callback.get('data')
+
+    @property
+    def sender(self):
+        if self._sender is None:
+            self._sender = User.from_response(self.callback['from'])
+        return self._sender
+
+
+class InlineUpdate(Update):
+    """Inline query, text typed after the bot name in any chat
+
+    There is no message nor chat, only the query and who is typing it.
+    """
+    __slots__ = ('inline_query', 'query_id', 'query')
+    type = 'inline'
+
+    def __init__(self, data, kind='inline_query'):
+        super().__init__(data, kind)
+        self.inline_query = self.message
+        self.message = None
+        self.query_id = self.inline_query['id']
+        self.query = self.inline_query.get('query', '')
 
-    @staticmethod
-    def accepts(update):
-        return 'location' in update['message']
+    @property
+    def sender(self):
+        if self._sender is None:
+            self._sender = User.from_response(self.inline_query['from'])
+        return self._sender
+
+
+class UnknownUpdate(Update):
+    """Update without a message, of a kind not managed"""
+    __slots__ = ()
+
+    def __init__(self, data, kind=None):
+        super().__init__(data, kind)
+        self.message = None
 
 
 def is_command(text):
     return text.startswith('/')
+
+
+def message_type(message):
+    """Update type for a message, by its content"""
+    text = message.get('text')
+    if text is not None:
+        return CommandUpdate if is_command(text) else TextUpdate
+
+    for content, type in CONTENT_TYPES.items():
+        if content in message:
+            return type
+
+    return Update
+
+
+#: Update fields holding a message
+MESSAGE_KINDS = ('message', 'edited_message')
+
+#: Other managed update fields
+UPDATE_TYPES = {
+    'callback_query': CallbackUpdate,
+    'inline_query': InlineUpdate,
+}
+
+#: Message types by content other than text
+CONTENT_TYPES = {
+    'location': LocationUpdate,
+}
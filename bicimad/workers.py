@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+import queue
+import logging
+import threading
+
+from . import alerts
+from . import bicimad
+from . import history
+from . import forecast
+from . import telegram
+from . import ratelimit
+from .bot import process_message
+from .helpers import to_int
+from .scheduler import conversation_key
+
+
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 100
+
+log = logging.getLogger('bicimad.workers')
+
+
+class Busy(Exception):
+    """Raised when there is no room for more updates"""
+
+
+class Reply:
+    """Single reply handed from a worker to a waiting webhook request
+
+    The worker processes the update capturing its Telegram requests. If it
+    produced exactly one request and the webhook is still waiting, the
+    request is handed over to be sent in the webhook response. Otherwise the
+    worker sends the requests itself.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.call = None
+        self.abandoned = False
+
+    def resolve(self, calls):
+        """Offer captured requests, returns whether they were taken"""
+        with self.lock:
+            taken = not self.abandoned and len(calls) == 1
+            if taken:
+                self.call = calls[0]
+            self.event.set()
+            return taken
+
+    def wait(self, timeout):
+        """Wait for the single request, None if there is none in time"""
+        self.event.wait(timeout)
+        with self.lock:
+            if self.call is None:
+                self.abandoned = True
+            return self.call
+
+
+class WorkerPool:
+    """Threads processing updates in the background
+
+    Api clients, the stations cache and conversations are shared by all the
+    workers. Each worker has its own bounded queue and updates are routed
+    by chat, as prefork workers route them, so a conversation is always
+    handled by the same thread and in order.
+
+    :param refreshers: stations :class:`bicimad.Refresher` to run along
+    :param throttle: :class:`ratelimit.Throttle` for each sender, if any
+    """
+
+    def __init__(self, telegram, bicimad, workers=DEFAULT_WORKERS,
+                 queue_size=DEFAULT_QUEUE_SIZE, refreshers=(), throttle=None):
+        self.telegram = telegram
+        self.bicimad = bicimad
+        self.refreshers = list(refreshers)
+        self.throttle = throttle
+        self.conversations = {}
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.threads = []
+
+    @classmethod
+    def from_config(cls, config, bicimad_api=None):
+        """Pool for the webhook
+
+        :param bicimad_api: stations source to use instead of fetching them,
+            whoever provides it records the history and the forecast is
+            trained from its files
+        """
+        workers = to_int(config.get('webhook.workers'))
+        queue_size = to_int(config.get('webhook.queue_size'))
+        telegram_api = telegram.Telegram.from_config(config)
+        refreshers = []
+        recorded = bicimad_api is not None
+        if not recorded:
+            bicimad_api = bicimad.BiciMad.from_config(config)
+            refreshers.append(history.install(config, bicimad_api))
+        refreshers.append(alerts.install(config, telegram_api, bicimad_api))
+        forecaster = forecast.install(config, bicimad_api)
+        if recorded and config.get('history.path'):
+            records = history.History.from_config(config)
+            forecaster.train(records)
+            records.close()
+        return cls(telegram_api, bicimad_api,
+                   workers=DEFAULT_WORKERS if workers is None else workers,
+                   queue_size=DEFAULT_QUEUE_SIZE
+                   if queue_size is None else queue_size,
+                   refreshers=[refresher for refresher in refreshers
+                               if refresher is not None],
+                   throttle=ratelimit.Throttle.from_config(config))
+
+    def start(self):
+        for number, updates in enumerate(self.queues):
+            thread = threading.Thread(target=self.work, args=(updates,),
+                                      name='worker-{}'.format(number))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        for refresher in self.refreshers:
+            refresher.start()
+        return self
+
+    def stop(self):
+        """Process queued updates and stop the workers"""
+        for updates in self.queues:
+            updates.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        for refresher in self.refreshers:
+            refresher.stop()
+        records = getattr(self.bicimad, 'history', None)
+        if records is not None:
+            records.close()
+
+    def submit(self, update, reply=None):
+        """Queue update for processing without blocking
+
+        :param reply: :class:`Reply` to hand the answer to, if any
+        :raises Busy: when the chat's worker queue is full
+        """
+        # the whole key, prefork workers spread chats by its id alone
+        updates = self.queues[hash(conversation_key(update))
+                              % len(self.queues)]
+        try:
+            updates.put_nowait((update, reply))
+        except queue.Full:
+            raise Busy(u'Worker queue full')
+
+    def work(self, updates):
+        while True:
+            item = updates.get()
+            try:
+                if item is None:
+                    return
+                self.process(*item)
+            except Exception:
+                log.exception(u'%r Could not process update', item[0])
+            finally:
+                updates.task_done()
+
+    def process(self, update, reply=None):
+        if reply is None:
+            process_message(update, self.telegram, self.bicimad,
+                            self.conversations, throttle=self.throttle)
+            return
+
+        try:
+            with self.telegram.capture() as calls:
+                process_message(update, self.telegram, self.bicimad,
+                                self.conversations, throttle=self.throttle)
+        finally:
+            if not reply.resolve(calls):
+                self.telegram.send_captured(calls)
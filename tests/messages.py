@@ -74,3 +74,16 @@ UPDATE_LOCATION = {
     "update_id": UPDATE_ID,
     "message": MSG_LOCATION
 }
+
+INLINE_QUERY_ID = "4128581990"
+INLINE_QUERY = {
+    "id": INLINE_QUERY_ID,
+    "from": CHAT_MSG_SENDER,
+    "query": "Puerta del s",
+    "offset": ""
+}
+
+UPDATE_INLINE = {
+    "update_id": UPDATE_ID,
+    "inline_query": INLINE_QUERY
+}
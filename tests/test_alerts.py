@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+from unittest.mock import Mock
+
+from bicimad.alerts import Alerts, RateLimitedSender, install
+from bicimad.bicimad import BiciMad, Stations, Station
+from bicimad.telegram import Telegram
+
+from hamcrest import (assert_that, is_, contains, contains_inanyorder,
+                      has_length, empty, same_instance, instance_of)
+
+from .stations import FIRST_STATION
+
+
+CHAT_ID = 4128581
+OTHER_CHAT_ID = 4128582
+
+
+def stations(bikes=0, spaces=0, enabled='1'):
+    station = dict(FIRST_STATION, bicis_enganchadas=str(bikes),
+                   bases_libres=str(spaces), activo=enabled)
+    return Stations([station])
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestAlerts:
+    def setup(self):
+        self.sender = Mock(RateLimitedSender)
+        self.alerts = Alerts(self.sender, format=lambda s, kind: kind)
+
+    def test_it_should_find_stations_getting_bikes(self):
+        self.alerts.subscribe(CHAT_ID, 1)
+
+        crossed = list(self.alerts.crossed(stations(0), stations(3)))
+
+        assert_that(crossed, contains(contains(
+            instance_of(Station), 'bici')))
+
+    def test_it_should_find_stations_getting_spaces(self):
+        self.alerts.subscribe(CHAT_ID, 1, 'plaza')
+
+        crossed = list(self.alerts.crossed(stations(spaces=0),
+                                           stations(spaces=2)))
+
+        assert_that(crossed, has_length(1))
+
+    def test_it_should_ignore_stations_that_already_had_bikes(self):
+        self.alerts.subscribe(CHAT_ID, 1)
+
+        crossed = list(self.alerts.crossed(stations(1), stations(3)))
+
+        assert_that(crossed, is_(empty()))
+
+    def test_it_should_ignore_disabled_stations(self):
+        self.alerts.subscribe(CHAT_ID, 1)
+
+        crossed = list(self.alerts.crossed(stations(0),
+                                           stations(3, enabled='0')))
+
+        assert_that(crossed, is_(empty()))
+
+    def test_it_should_find_enabled_again_stations_with_bikes(self):
+        self.alerts.subscribe(CHAT_ID, 1)
+
+        crossed = list(self.alerts.crossed(stations(3, enabled='0'),
+                                           stations(3)))
+
+        assert_that(crossed, has_length(1))
+
+    def test_it_should_only_look_up_stations_that_crossed_zero(self):
+        looked = []
+
+        class Subscriptions(dict):
+            def get(self, key, default=None):
+                looked.append(key)
+                return super().get(key, default)
+
+        self.alerts.subscriptions = Subscriptions()
+        self.alerts.subscribe(CHAT_ID, 1)
+        self.alerts.subscribe(CHAT_ID, 2)
+        before = Stations([dict(FIRST_STATION, bicis_enganchadas='3'),
+                           dict(FIRST_STATION, idestacion='2',
+                                bicis_enganchadas='0')])
+        after = Stations([dict(FIRST_STATION, bicis_enganchadas='2'),
+                          dict(FIRST_STATION, idestacion='2',
+                               bicis_enganchadas='1')])
+        del looked[:]
+
+        crossed = list(self.alerts.crossed(before, after))
+
+        assert_that([station.id for station, kind in crossed], contains(2))
+        assert_that(looked, contains(2))
+
+    def test_it_should_notify_every_subscribed_chat(self):
+        self.alerts.subscribe(CHAT_ID, 1)
+        self.alerts.subscribe(OTHER_CHAT_ID, 1)
+
+        self.alerts.notify(stations(0), stations(3))
+
+        assert_that([call[0] for call in
+                     self.sender.send_message.call_args_list],
+                    contains_inanyorder((CHAT_ID, 'bici'),
+                                        (OTHER_CHAT_ID, 'bici')))
+
+    def test_it_should_notify_only_once(self):
+        self.alerts.subscribe(CHAT_ID, 1)
+
+        self.alerts.notify(stations(0), stations(3))
+        self.alerts.notify(stations(0), stations(3))
+
+        assert_that(self.sender.send_message.call_count, is_(1))
+        assert_that(self.alerts, has_length(0))
+
+    def test_it_should_keep_other_kinds_after_notifying(self):
+        self.alerts.subscribe(CHAT_ID, 1)
+        self.alerts.subscribe(CHAT_ID, 1, 'plaza')
+
+        self.alerts.notify(stations(0), stations(3))
+
+        assert_that(self.alerts.subscriptions[1], is_({'plaza': {CHAT_ID}}))
+
+    def test_it_should_unsubscribe(self):
+        self.alerts.subscribe(CHAT_ID, 1)
+
+        self.alerts.unsubscribe(CHAT_ID, 1)
+
+        assert_that(self.alerts, has_length(0))
+
+
+class TestRateLimitedSender:
+    def setup(self):
+        self.clock = FakeClock()
+        self.telegram = Mock(Telegram)
+        self.sender = RateLimitedSender(self.telegram, rate=10,
+                                        clock=self.clock,
+                                        sleep=self.clock.sleep)
+
+    def test_it_should_space_out_messages(self):
+        for number in range(3):
+            self.sender.send_message(CHAT_ID, str(number))
+        self.sender.messages.put(None)
+
+        self.sender.run()
+
+        assert_that(self.telegram.send_message.call_count, is_(3))
+        assert_that(self.clock.sleeps, contains(0.1, 0.1))
+
+    def test_it_should_not_wait_after_a_pause(self):
+        self.sender.wait()
+        self.clock.now += 1
+
+        self.sender.wait()
+
+        assert_that(self.clock.sleeps, is_(empty()))
+
+    def test_it_should_keep_sending_after_errors(self):
+        self.telegram.send_message.side_effect = [ValueError(), None]
+        self.sender.send_message(CHAT_ID, 'a')
+        self.sender.send_message(CHAT_ID, 'b')
+        self.sender.messages.put(None)
+
+        self.sender.run()
+
+        assert_that(self.telegram.send_message.call_count, is_(2))
+
+
+class TestInstall:
+    def setup(self):
+        self.bicimad = Mock(BiciMad)
+        self.bicimad.listeners = []
+        self.alerts = Alerts(Mock(RateLimitedSender))
+
+    def test_it_should_listen_to_stations_refreshes(self):
+        install({}, Mock(Telegram), self.bicimad, self.alerts)
+
+        assert_that(self.bicimad.alerts, same_instance(self.alerts))
+        assert_that(self.bicimad.listeners, contains(self.alerts.notify))
+
+    def test_it_should_refresh_only_with_subscriptions(self):
+        refresher = install({}, Mock(Telegram), self.bicimad, self.alerts)
+        wanted = refresher.wanted()
+
+        self.alerts.subscribe(CHAT_ID, 1)
+
+        assert_that((wanted, refresher.wanted()), is_((False, True)))
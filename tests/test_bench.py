@@ -0,0 +1,71 @@
+import random
+
+from bicimad import bot, bench
+from bicimad.bicimad import Stations
+
+from hamcrest import (assert_that, has_length, has_entries, has_key,
+                      greater_than, less_than, only_contains, has_entry,
+                      is_)
+
+from .stations import RESPONSE
+
+
+class TestLoadResponse:
+    def test_it_should_load_the_bundled_stations(self):
+        assert_that(bench.load_response()['estaciones'],
+                    has_length(len(RESPONSE['estaciones'])))
+
+
+class TestSyntheticCity:
+    def test_it_should_have_given_size(self):
+        city = bench.synthetic_city(RESPONSE, 500)
+
+        assert_that(city['estaciones'], has_length(500))
+
+    def test_it_should_have_unique_ids(self):
+        city = bench.synthetic_city(RESPONSE, 500)
+
+        assert_that(set(s['idestacion'] for s in city['estaciones']),
+                    has_length(500))
+
+
+class TestRun:
+    def test_it_should_report_stats_for_each_benchmark(self):
+        report = bench.run(RESPONSE, sizes=[50], repeat=3, budget=0)
+
+        assert_that(report['results'], has_entry('50', has_length(
+            len(bench.benchmarks(RESPONSE)))))
+        assert_that(report['results']['50'].values(), only_contains(
+            has_entries(count=3, p50=greater_than(0), p99=greater_than(0),
+                        ops_per_s=greater_than(0))))
+
+    def test_it_should_not_keep_pages_or_answers_between_runs(self):
+        cursors, answers = len(bot.cursors), len(bot.inline_answers)
+
+        bench.run(RESPONSE, sizes=[50], repeat=3, budget=0,
+                  only=['process_command', 'process_inline'])
+
+        assert_that(len(bot.cursors), is_(cursors))
+        assert_that(len(bot.inline_answers), is_(answers))
+
+    def test_it_should_run_only_given_benchmarks(self):
+        report = bench.run(RESPONSE, sizes=[50], repeat=3, budget=0,
+                           only=['by_id'])
+
+        assert_that(report['results']['50'], has_length(1))
+        assert_that(report['results']['50'], has_key('by_id'))
+
+
+class TestFuzzySearchLatency:
+    def test_it_should_stay_within_the_limit_at_100k_stations(self):
+        city = bench.synthetic_city(RESPONSE, 100000)
+        stations = Stations.from_response(city)
+        names = [station['nombre'] for station in city['estaciones']]
+        rng = random.Random(0)
+        # builds the search index
+        stations.by_search(names[0])
+
+        stats = bench.measure(lambda: stations.by_search(
+            bench.misspell(rng, rng.choice(names))), repeat=50, budget=5)
+
+        assert_that(stats['p90'], less_than(bench.FUZZY_SEARCH_LIMIT))
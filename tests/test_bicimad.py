@@ -1,4 +1,6 @@
+import copy
 import json as stdjson
+from unittest.mock import patch
 
 from bicimad.helpers import urljoin
 from bicimad.bicimad import BiciMad, DEFAULT_URL, ENDPOINT, Stations, Station
@@ -9,7 +11,8 @@ from .stations import (RESPONSE, N_STATIONS, AVAILABLE_STATION,
 import httpretty
 from hamcrest import (assert_that, has_property, has_entry, is_, has_entries,
                       has_length, only_contains, greater_than, has_properties,
-                      all_of, none, any_of, contains_string)
+                      all_of, none, any_of, contains_string,
+                      same_instance, not_, close_to)
 
 
 ID_USER = '74582027C'
@@ -53,6 +56,25 @@ class TestBiciMad:
 
         assert_that(list(stations.stations), has_length(N_STATIONS))
 
+    @httpretty.activate
+    def test_it_should_reuse_stations_until_expired(self):
+        self.register(RESPONSE)
+
+        first = self.bicimad.stations
+        second = self.bicimad.stations
+
+        assert_that(second, is_(same_instance(first)))
+
+    @httpretty.activate
+    def test_it_should_fetch_stations_again_when_expired(self):
+        self.register(RESPONSE)
+        self.bicimad.ttl = 0
+
+        first = self.bicimad.stations
+        second = self.bicimad.stations
+
+        assert_that(second, is_(not_(same_instance(first))))
+
     def register(self, json):
         httpretty.register_uri(
             httpretty.POST,
@@ -111,6 +133,84 @@ class TestStations:
             )))
         ))
 
+    def test_it_should_get_closest_first(self):
+        position = (40.4168984, -3.7024244)
+
+        distances = [station.distance for station in
+                     self.stations.by_distance(position, max=10)]
+        everything = [station.distance for station in
+                      self.stations.by_distance(position, max=None)]
+
+        assert_that(distances, is_(everything[:10]))
+
+    def test_it_should_copy_only_the_closest_stations(self):
+        position = (40.4168984, -3.7024244)
+
+        with patch('copy.copy', wraps=copy.copy) as copied:
+            self.stations.by_distance(position, max=3)
+
+        assert_that(copied.call_count, is_(3))
+        assert_that(self.stations.stations, only_contains(
+            not_(has_property('distance'))))
+
+    def test_it_should_plan_routes_by_walking_distance(self):
+        origin = (40.4168984, -3.7024244)
+        destination = (40.4086, -3.7013)
+
+        routes = self.stations.by_route(origin, destination)
+
+        walks = [walk for walk, pickup, dropoff in routes]
+        assert_that(routes, has_length(3))
+        assert_that(walks, is_(sorted(walks)))
+        for walk, pickup, dropoff in routes:
+            assert_that(pickup.bikes, greater_than(0))
+            assert_that(dropoff.spaces, greater_than(0))
+            assert_that(pickup.id, is_(not_(dropoff.id)))
+
+    def test_it_should_give_nearest_neighbours(self):
+        station = self.stations.by_id(1)
+
+        nearby = self.stations.neighbours(station)
+        closest = self.stations.by_distance(station.position, max=6)[1:]
+
+        assert_that([s.id for s in nearby], is_([s.id for s in closest]))
+        assert_that(nearby[0].distance, close_to(closest[0].distance, 1))
+
+    def test_it_should_keep_neighbours_when_stations_dont_move(self):
+        self.stations.neighbours(self.stations.by_id(1))
+        refreshed = Stations.from_response(RESPONSE)
+
+        refreshed.inherit(self.stations)
+
+        assert_that(refreshed.graph, same_instance(self.stations.graph))
+
+    def test_it_should_rebuild_neighbours_when_stations_move(self):
+        self.stations.neighbours(self.stations.by_id(1))
+        refreshed = Stations.from_response(RESPONSE)
+        refreshed.stations[0].position = (40.0, -3.0)
+
+        refreshed.inherit(self.stations)
+
+        assert_that(refreshed.graph, is_(none()))
+
+    def test_it_should_keep_fragments_of_unchanged_stations(self):
+        self.stations.stations[0].fragments['text'] = 'rendered'
+        refreshed = Stations.from_response(RESPONSE)
+
+        refreshed.inherit(self.stations)
+
+        assert_that(refreshed.stations[0].fragments,
+                    same_instance(self.stations.stations[0].fragments))
+
+    def test_it_should_render_changed_stations_again(self):
+        self.stations.stations[0].fragments['text'] = 'rendered'
+        refreshed = Stations.from_response(RESPONSE)
+        refreshed.stations[0].bikes += 1
+
+        refreshed.inherit(self.stations)
+
+        assert_that(refreshed.stations[0].fragments, is_({}))
+
     def test_it_should_search_stations_by_name(self):
         query = 'callEaVapiés'
         stations = list(self.stations.by_search(query))
@@ -121,6 +221,49 @@ class TestStations:
         )))
         assert_that(stations, has_length(greater_than(0)))
 
+    def test_it_should_search_stations_with_typos(self):
+        stations = self.stations.by_search('lavapiez')
+
+        assert_that(stations, has_length(greater_than(0)))
+        assert_that(stations, only_contains(
+            has_property('address', contains_string('Lavapies'))))
+
+    def test_it_should_prefer_exact_matches(self):
+        stations = self.stations.by_search('sol')
+
+        assert_that(stations, only_contains(
+            has_property('address', contains_string('Sol'))))
+
+    def test_it_should_keep_search_index_when_names_dont_change(self):
+        self.stations.by_search('sol')
+        refreshed = Stations.from_response(RESPONSE)
+
+        refreshed.inherit(self.stations)
+
+        assert_that(refreshed.search_index,
+                    same_instance(self.stations.search_index))
+
+    def test_it_should_rebuild_search_index_when_names_change(self):
+        self.stations.by_search('sol')
+        refreshed = Stations.from_response(RESPONSE)
+        refreshed.stations[0].address = 'Calle Nueva'
+
+        refreshed.inherit(self.stations)
+
+        assert_that(refreshed.search_index, is_(none()))
+
+    def test_it_should_search_stations_being_typed(self):
+        stations = self.stations.by_prefix('puerta del s')
+
+        assert_that(stations, has_length(greater_than(0)))
+        assert_that(stations, only_contains(
+            has_property('address', contains_string('Puerta del Sol'))))
+
+    def test_it_should_have_different_versions(self):
+        refreshed = Stations.from_response(RESPONSE)
+
+        assert_that(refreshed.version, is_(not_(self.stations.version)))
+
     def test_it_should_search_stations_by_id(self):
         station = self.stations.by_id(1)
 
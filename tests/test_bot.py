@@ -1,13 +1,27 @@
 # -*- coding: utf-8 -*-
 
-from bicimad.bot import process_message
+from bicimad import metrics
+from bicimad.bot import process_message, format_station, format_station_area
+from bicimad.metrics import Registry
+from bicimad.alerts import Alerts
+from bicimad.live import LiveSessions
+from bicimad.inline import AnswerCache
+from bicimad.pages import MAX_RESULTS
+from bicimad.ratelimit import Throttle
+from bicimad.forecast import Prediction
 from bicimad.telegram import Telegram, Update
 from bicimad.bicimad import BiciMad, Stations
 
-from unittest.mock import Mock
-from hamcrest import assert_that, contains_string, all_of, contains
+from unittest.mock import Mock, ANY
+from hamcrest import (assert_that, contains_string, all_of, contains, is_,
+                      has_length, is_not, has_entries)
 
-from .messages import CHAT_ID, UPDATE_ID, LOCATION, MSG_LOCATION
+from .messages import (CHAT_ID, UPDATE_ID, LOCATION, MSG_LOCATION,
+                       UPDATE_INLINE, INLINE_QUERY_ID)
+
+
+REPLY_ID = 9
+DESTINATION = 40.4086, -3.7013
 
 
 def message(text):
@@ -63,6 +77,7 @@ class ProcessMessage:
     def setup_mocks(self):
         self.bicimad = Mock(BiciMad)
         self.bicimad.stations = Mock(Stations)
+        self.bicimad.stations.neighbours.return_value = []
         self.telegram = Mock(Telegram)
 
     def assert_answer(self, matcher):
@@ -105,6 +120,38 @@ class SearchCommand(ProcessMessage):
         function = getattr(self.bicimad.stations, self.queryname)
         function.return_value = good
 
+    def set_neighbours(self, stations):
+        self.bicimad.stations.neighbours.return_value = \
+            list(self.with_distance(stations))
+        getattr(self.bicimad.stations, self.queryname).side_effect = \
+            lambda stations, max=5: [s for s in stations if s.bikes]
+
+    def test_it_should_suggest_nearby_stations_when_useless(self):
+        self.bicimad.stations.by_id.return_value = STATIONS[0]
+        self.set_neighbours(STATIONS[1:])
+
+        self.process_with_args('100')
+
+        self.assert_answer(all_of(
+            contains_string('Prueba en estas, que están cerca'),
+            contains_string('a 100m\n  en C/ Dirección B (101)')))
+
+    def test_it_should_not_suggest_nearby_stations_when_useful(self):
+        self.bicimad.stations.by_id.return_value = STATIONS[1]
+        self.set_neighbours(STATIONS[1:])
+
+        self.process_with_args('101')
+
+        self.assert_answer(is_not(contains_string('Prueba en estas')))
+
+    def test_it_should_suggest_nearby_stations_for_useless_results(self):
+        self.bicimad.stations.by_search.return_value = STATIONS[:1]
+        self.set_neighbours(STATIONS[1:])
+
+        self.process_with_args('dirección a')
+
+        self.assert_answer(contains_string('Prueba en estas'))
+
     def process_with_args(self, argument, convs=None):
         convs = {} if convs is None else convs
         self.process(message('/{} {}'.format(self.command, argument)), convs)
@@ -189,6 +236,28 @@ class SearchCommand(ProcessMessage):
 
         self.assert_answer(contains_string(STATIONS[0].address))
 
+    def test_it_should_answer_stations_near_addresses(self):
+        self.bicimad.stations.by_distance.return_value = \
+            list(self.with_distance(STATIONS))
+        self.set_result(STATIONS, STATIONS)
+
+        self.process_with_args('calle alcalá 49')
+
+        self.bicimad.stations.by_search.assert_not_called()
+        self.bicimad.stations.by_distance.assert_called_once_with(ANY)
+        self.assert_answer(all_of(
+            contains_string('Cerca de Calle Alcala 49'),
+            contains_string(STATIONS[1].address)))
+
+    def test_it_should_look_for_streets_when_no_station_matches(self):
+        self.bicimad.stations.by_distance.return_value = \
+            list(self.with_distance(STATIONS))
+        self.set_result([])
+
+        self.process_with_args('alcalá')
+
+        self.assert_answer(contains_string('Cerca de Calle Alcala:'))
+
     def test_it_should_answer_by_id_with_no_results_message(self):
         self.bicimad.stations.by_id.return_value = None
 
@@ -219,7 +288,8 @@ class TestProcessLocation(ProcessMessage):
     def test_it_should_query_available_bikes(self):
         self.process(MSG_LOCATION)
 
-        self.bicimad.stations.by_distance.assert_called_once_with(LOCATION)
+        self.bicimad.stations.by_distance.assert_called_once_with(
+            LOCATION, max=MAX_RESULTS)
 
     def test_it_should_answer_message_with_empty_stations(self):
         self.process(MSG_LOCATION)
@@ -252,3 +322,449 @@ class TestProcessLocation(ProcessMessage):
             list(self.with_distance(STATIONS + BAD_STATIONS))
         self.bicimad.stations.with_some_use.return_value = \
             list(self.with_distance(STATIONS))
+
+
+class TestAvisameCommand(ProcessMessage):
+    """/avisame command"""
+    def setup(self):
+        self.setup_mocks()
+        self.bicimad.alerts = Mock(Alerts)
+        self.bicimad.stations.by_id.return_value = STATIONS[0]
+
+    def test_it_should_subscribe_to_bikes(self):
+        self.process_text('/avisame 100')
+
+        self.bicimad.alerts.subscribe.assert_called_once_with(
+            CHAT_ID, 100, 'bici')
+        self.assert_answer(contains_string('te aviso cuando haya bicis'))
+
+    def test_it_should_subscribe_to_spaces(self):
+        self.process_text('/avisame plaza 100')
+
+        self.bicimad.alerts.subscribe.assert_called_once_with(
+            CHAT_ID, 100, 'plaza')
+        self.assert_answer(contains_string('plazas libres'))
+
+    def test_it_should_ask_for_station(self):
+        convs = {}
+        self.process_text('/avisame', convs)
+
+        self.assert_answer(contains_string('número de la estación'))
+
+        self.process_text('100', convs)
+
+        self.bicimad.alerts.subscribe.assert_called_once_with(
+            CHAT_ID, 100, 'bici')
+
+    def test_it_should_answer_right_away_when_available(self):
+        self.bicimad.stations.by_id.return_value = STATIONS[1]
+
+        self.process_text('/avisame 101')
+
+        assert_that(self.bicimad.alerts.subscribe.called, is_(False))
+        self.assert_answer(contains_string('ya hay'))
+
+    def test_it_should_answer_unknown_station(self):
+        self.bicimad.stations.by_id.return_value = None
+
+        self.process_text('/avisame 9999')
+
+        self.assert_answer(contains_string('ninguna estación'))
+
+    def test_it_should_answer_when_alerts_are_not_available(self):
+        self.bicimad.alerts = None
+
+        self.process_text('/avisame 100')
+
+        self.assert_answer(contains_string('no puedo avisarte'))
+
+
+class TestProcessLiveLocation(ProcessMessage):
+    def test_it_should_answer_and_start_session(self):
+        self.process(self.live_message())
+
+        assert_that(self.sessions, has_length(1))
+
+    def test_it_should_not_edit_when_stations_are_the_same(self):
+        self.process(self.live_message())
+
+        self.process(self.live_message(), kind='edited_message')
+
+        assert_that(self.telegram.edit_message_text.called, is_(False))
+
+    def test_it_should_edit_reply_when_stations_change(self):
+        self.process(self.live_message())
+        self.set_stations(list(reversed(STATIONS)))
+
+        self.process(self.live_message(), kind='edited_message')
+
+        self.telegram.edit_message_text.assert_called_once_with(
+            CHAT_ID, REPLY_ID, ANY)
+
+    def test_it_should_stop_when_sharing_stops(self):
+        self.process(self.live_message())
+
+        self.process(MSG_LOCATION, kind='edited_message')
+
+        assert_that(self.sessions, has_length(0))
+
+    def test_it_should_ignore_edits_of_unknown_locations(self):
+        self.process(self.live_message(), kind='edited_message')
+
+        assert_that(self.bicimad.stations.by_distance.called, is_(False))
+
+    def process(self, msg, kind='message'):
+        update = Update.from_response({'update_id': UPDATE_ID, kind: msg})
+        process_message(update, self.telegram, self.bicimad, {},
+                        live_sessions=self.sessions)
+
+    def live_message(self):
+        return dict(MSG_LOCATION, location=dict(MSG_LOCATION['location'],
+                                                live_period=900))
+
+    def set_stations(self, stations):
+        self.bicimad.stations.by_distance.return_value = \
+            list(self.with_distance(stations))
+        self.bicimad.stations.with_some_use.return_value = \
+            list(self.with_distance(stations))
+
+    def setup(self):
+        self.setup_mocks()
+        self.sessions = LiveSessions(clock=lambda: MSG_LOCATION['date'])
+        self.telegram.send_message.return_value = {
+            'ok': True, 'result': {'message_id': REPLY_ID}}
+        self.set_stations(STATIONS)
+
+
+class TestPrevisionCommand(ProcessMessage):
+    """/prevision command"""
+    def setup(self):
+        self.setup_mocks()
+        self.bicimad.stations.by_id.return_value = STATIONS[1]
+        self.bicimad.stations.forecast.side_effect = \
+            lambda station, minutes: Prediction(minutes, 0.25, 0.9, 1.0, 3)
+
+    def test_it_should_forecast_bikes_and_spaces(self):
+        self.process_text('/prevision 101')
+
+        self.assert_answer(all_of(
+            contains_string('en 10 min: 25% de que haya bicis y 90% plazas'),
+            contains_string('en 30 min'),
+        ))
+
+    def test_it_should_warn_about_little_data(self):
+        self.bicimad.stations.forecast.side_effect = \
+            lambda station, minutes: Prediction(minutes, 1, 1, 1.0, 0)
+
+        self.process_text('/prevision 101')
+
+        self.assert_answer(contains_string('pocos datos'))
+
+    def test_it_should_answer_without_model(self):
+        self.bicimad.stations.forecast.side_effect = None
+        self.bicimad.stations.forecast.return_value = None
+
+        self.process_text('/prevision 101')
+
+        self.assert_answer(contains_string('no puedo hacer previsiones'))
+
+    def test_it_should_answer_unknown_station(self):
+        self.bicimad.stations.by_id.return_value = None
+
+        self.process_text('/prevision 9999')
+
+        self.assert_answer(contains_string('ninguna estación'))
+
+
+class TestRutaCommand(ProcessMessage):
+    """/ruta command"""
+    def setup(self):
+        self.setup_mocks()
+        self.convs = {}
+        pickup, dropoff = self.with_distance(STATIONS[1:] + STATIONS[:1])
+        self.bicimad.stations.by_search.return_value = [Obj(
+            id=101, position=DESTINATION, address='C/ Dirección B')]
+        self.bicimad.stations.by_route.return_value = [
+            (200.1, pickup, dropoff)]
+
+    def test_it_should_ask_for_origin_with_destination(self):
+        self.process_text('/ruta dirección b', self.convs)
+
+        self.assert_answer(contains_string('Comparte tu posición'))
+
+    def test_it_should_plan_route_to_destination(self):
+        self.process_text('/ruta dirección b', self.convs)
+
+        self.process(MSG_LOCATION, self.convs)
+
+        self.bicimad.stations.by_route.assert_called_once_with(
+            LOCATION, DESTINATION)
+        self.assert_answer(contains_string('Andarás unos 200m en total'))
+
+    def test_it_should_ask_for_destination(self):
+        self.process_text('/ruta', self.convs)
+        self.process(MSG_LOCATION, self.convs)
+
+        self.assert_answer(contains_string('¿A dónde vas?'))
+
+        self.process_text('dirección b', self.convs)
+
+        self.bicimad.stations.by_route.assert_called_once_with(
+            LOCATION, DESTINATION)
+
+    def test_it_should_answer_unknown_destinations(self):
+        self.bicimad.stations.by_search.return_value = []
+
+        self.process_text('/ruta ningún sitio', self.convs)
+
+        self.assert_answer(contains_string('no me suena ese destino'))
+
+    def test_it_should_answer_when_there_are_no_routes(self):
+        self.bicimad.stations.by_route.return_value = []
+        self.process_text('/ruta dirección b', self.convs)
+
+        self.process(MSG_LOCATION, self.convs)
+
+        self.assert_answer(contains_string('No encuentro estaciones'))
+
+
+class TestInlineQuery(ProcessMessage):
+    def setup(self):
+        self.setup_mocks()
+        self.answers = AnswerCache()
+        self.bicimad.stations.version = 1
+        self.bicimad.stations.by_prefix.return_value = STATIONS
+
+    def process_inline(self, query=None):
+        inline = UPDATE_INLINE['inline_query']
+        if query is not None:
+            inline = dict(inline, query=query)
+        update = Update.from_response(dict(UPDATE_INLINE,
+                                           inline_query=inline))
+        process_message(update, self.telegram, self.bicimad, {},
+                        inline_answers=self.answers)
+
+    def assert_results(self, matcher):
+        assert_that(self.telegram.answer_inline_query.call_args[0],
+                    contains(INLINE_QUERY_ID, matcher))
+
+    def test_it_should_answer_matching_stations(self):
+        self.process_inline()
+
+        self.bicimad.stations.by_prefix.assert_called_once_with(
+            'puerta del s', max=ANY)
+        self.assert_results(contains(
+            has_entries(id='100', title=STATIONS[0].address),
+            has_entries(id='101', description=contains_string(
+                '1 bici y 1 plaza'))))
+
+    def test_it_should_reuse_answers_for_the_same_snapshot(self):
+        self.process_inline()
+        self.process_inline('puerta  del S')
+
+        assert_that(self.bicimad.stations.by_prefix.call_count, is_(1))
+        assert_that(self.telegram.answer_inline_query.call_count, is_(2))
+
+    def test_it_should_search_again_in_new_snapshots(self):
+        self.process_inline()
+        self.bicimad.stations.version = 2
+
+        self.process_inline()
+
+        assert_that(self.bicimad.stations.by_prefix.call_count, is_(2))
+
+    def test_it_should_time_inline_queries_and_dispatch(self):
+        registry = metrics.registry
+        metrics.registry = Registry()
+        metrics.registry.sample_rate = 1
+        try:
+            self.process_inline()
+
+            assert_that(metrics.registry.stages.get(stage='inline'), is_(1))
+            assert_that(metrics.registry.stages.get(stage='dispatch'),
+                        is_(1))
+        finally:
+            metrics.registry = registry
+
+    def test_it_should_answer_empty_queries_with_nothing(self):
+        self.process_inline('  ')
+
+        self.bicimad.stations.by_prefix.assert_not_called()
+        self.assert_results(is_([]))
+
+
+class TestFragments:
+    def setup(self):
+        self.station = Obj(id=100, enabled=True, bikes=2, spaces=1,
+                           address='C/ Dirección A', fragments={})
+
+    def test_it_should_render_stations_once(self):
+        text = format_station(self.station)
+        self.station.bikes = 5
+
+        assert_that(format_station(self.station), is_(text))
+        assert_that(text, contains_string('2 bicis y 1 plaza'))
+
+    def test_it_should_render_distances_every_time(self):
+        self.station.distance = 120.3
+        format_station_area(self.station)
+        self.station.distance = 80.9
+
+        assert_that(format_station_area(self.station), is_(
+            '- 2 bicis y 1 plaza a 80m\n  en C/ Dirección A (100)'))
+
+    def test_it_should_render_stations_without_fragments(self):
+        del self.station.fragments
+
+        assert_that(format_station(self.station),
+                    contains_string('2 bicis y 1 plaza'))
+
+
+class TestPagination(ProcessMessage):
+    def setup(self):
+        self.setup_mocks()
+        self.stations = list(self.with_distance([
+            Obj(id=id, enabled=True, bikes=1, spaces=1,
+                address='C/ Dirección {}'.format(id))
+            for id in range(100, 107)]))
+        self.ids = dict((station.id, station) for station in self.stations)
+        self.bicimad.stations.by_distance.return_value = self.stations
+        self.bicimad.stations.by_id.side_effect = self.ids.get
+        self.bicimad.stations.with_some_use.side_effect = \
+            lambda stations, max=None: [s for s in stations if s.bikes]
+
+    def press(self, text):
+        """Press the button with `text` in the last keyboard sent"""
+        calls = self.telegram.edit_message_text.call_args_list \
+            or self.telegram.send_message.call_args_list
+        shown = calls[-1][0][-1]
+        keyboard = calls[-1][1]['keyboard']
+        data = [button['callback_data'] for row in keyboard
+                for button in row if button['text'] == text]
+        self.callback(data[0] if data else None, shown, keyboard)
+
+    def callback(self, data, shown='', keyboard=None):
+        """Press a button of a message showing `shown` and `keyboard`"""
+        shown = dict(message(shown), message_id=REPLY_ID)
+        if keyboard is not None:
+            shown['reply_markup'] = {'inline_keyboard': keyboard}
+        update = Update.from_response({
+            'update_id': UPDATE_ID, 'callback_query': {
+                'id': '42', 'from': message('')['from'], 'data': data,
+                'message': shown}})
+        process_message(update, self.telegram, self.bicimad, {})
+
+    def assert_edited(self, matcher):
+        assert_that(self.telegram.edit_message_text.call_args[0],
+                    contains(CHAT_ID, REPLY_ID, matcher))
+
+    def test_it_should_show_first_page_with_buttons(self):
+        self.process(MSG_LOCATION)
+
+        self.assert_answer(all_of(
+            contains_string('(104)'), is_not(contains_string('(105)'))))
+        assert_that(self.telegram.send_message.call_args[1]['keyboard'],
+                    contains(contains(has_entries(text='Más'),
+                                      has_entries(text='Actualizar'))))
+
+    def test_it_should_show_next_page(self):
+        self.process(MSG_LOCATION)
+
+        self.press('Más')
+
+        self.assert_edited(all_of(
+            contains_string('(105)'), contains_string('(106)'),
+            is_not(contains_string('(104)'))))
+        self.telegram.answer_callback_query.assert_called_once_with('42')
+        assert_that(self.bicimad.stations.by_distance.call_count, is_(1))
+
+    def test_it_should_not_offer_more_in_last_page(self):
+        self.process(MSG_LOCATION)
+
+        self.press('Más')
+
+        assert_that(self.telegram.edit_message_text.call_args[1]['keyboard'],
+                    contains(contains(has_entries(text='Actualizar'))))
+
+    def test_it_should_refresh_page_with_latest_stations(self):
+        self.process(MSG_LOCATION)
+        self.ids[100] = Obj(id=100, enabled=True, bikes=7, spaces=1,
+                            address='C/ Dirección 100')
+
+        self.press('Actualizar')
+
+        self.assert_edited(contains_string('7 bicis y 1 plaza a 100m'))
+
+    def test_it_should_not_edit_past_the_last_page(self):
+        self.process(MSG_LOCATION)
+        more = self.telegram.send_message.call_args[1]['keyboard'][0][0]
+        self.press('Más')
+        edited = self.telegram.edit_message_text.call_args
+
+        # pressed again before the first edit was shown
+        self.callback(more['callback_data'], edited[0][-1],
+                      edited[1]['keyboard'])
+
+        assert_that(self.telegram.edit_message_text.call_count, is_(1))
+        assert_that(self.telegram.answer_callback_query.call_args[0],
+                    contains('42', 'No hay más estaciones'))
+
+    def test_it_should_not_edit_unchanged_pages(self):
+        self.process(MSG_LOCATION)
+
+        self.press('Actualizar')
+
+        self.telegram.edit_message_text.assert_not_called()
+        assert_that(self.telegram.answer_callback_query.call_args[0],
+                    contains('42', 'Sin cambios'))
+
+    def test_it_should_page_search_results(self):
+        self.bicimad.stations.by_search.return_value = self.stations
+
+        self.process_text('/estacion dirección')
+        self.press('Más')
+
+        self.assert_edited(contains_string('(105)'))
+
+    def test_it_should_answer_unknown_buttons(self):
+        self.callback('mas:123abc')
+
+        self.telegram.edit_message_text.assert_not_called()
+        assert_that(self.telegram.answer_callback_query.call_args[0],
+                    contains('42', contains_string('vuelve a buscar')))
+
+
+class TestThrottledMessages(ProcessMessage):
+    def setup(self):
+        self.setup_mocks()
+        self.throttle = Throttle({'help': (0.1, 1), 'callback': (0.1, 0)})
+
+    def process_text(self, text):
+        update = Update.from_response({'update_id': UPDATE_ID,
+                                       'message': message(text)})
+        process_message(update, self.telegram, self.bicimad, {},
+                        throttle=self.throttle)
+
+    def test_it_should_answer_within_limits(self):
+        self.process_text('/help')
+
+        self.assert_answer(contains_string('Puedo ayudarte'))
+
+    def test_it_should_ask_to_slow_down_once(self):
+        for _ in range(3):
+            self.process_text('/help')
+
+        assert_that(self.telegram.send_message.call_count, is_(2))
+        self.assert_answer(contains_string('más despacio'))
+
+    def test_it_should_answer_throttled_buttons(self):
+        update = Update.from_response({
+            'update_id': UPDATE_ID, 'callback_query': {
+                'id': '42', 'from': message('')['from'], 'data': 'mas:a',
+                'message': message('')}})
+
+        process_message(update, self.telegram, self.bicimad, {},
+                        throttle=self.throttle)
+
+        self.telegram.answer_callback_query.assert_called_once_with(
+            '42', 'Más despacio, por favor')
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from bicimad.coalesce import repeated, merge, coalescible, MAX_TEXT
+from bicimad.telegram import Update
+
+from hamcrest import assert_that, is_, contains, has_entries
+
+from .messages import MSG_COMMAND, MSG_LOCATION, UPDATE_ID
+
+
+def update(id, message=MSG_COMMAND, **fields):
+    return Update.from_response({'update_id': id,
+                                 'message': dict(message, **fields)})
+
+
+def send(chat_id, text, **kwargs):
+    return 'sendMessage', dict(kwargs, chat_id=chat_id, text=text)
+
+
+class TestCoalescible:
+    def test_it_should_coalesce_commands_and_locations(self):
+        assert_that(coalescible(update(1)), is_(True))
+        assert_that(coalescible(update(1, MSG_LOCATION)), is_(True))
+
+    def test_it_should_not_coalesce_live_locations(self):
+        location = dict(MSG_LOCATION['location'], live_period=60)
+
+        assert_that(coalescible(update(1, MSG_LOCATION, location=location)),
+                    is_(False))
+
+
+class TestRepeated:
+    def test_it_should_skip_all_but_the_last_repetition(self):
+        updates = [update(UPDATE_ID), update(UPDATE_ID + 1, text='/bici  sol'),
+                   update(UPDATE_ID + 2, text='/bici sol')]
+
+        assert_that(repeated(updates), is_({UPDATE_ID + 1}))
+
+    def test_it_should_not_skip_different_queries(self):
+        updates = [update(UPDATE_ID, text='/bici sol'),
+                   update(UPDATE_ID + 1, MSG_LOCATION)]
+
+        assert_that(repeated(updates), is_(set()))
+
+    def test_it_should_compare_within_each_chat(self):
+        other = dict(MSG_COMMAND['chat'], id=1)
+        updates = [update(UPDATE_ID), update(UPDATE_ID + 1, chat=other),
+                   update(UPDATE_ID + 2)]
+
+        assert_that(repeated(updates), is_({UPDATE_ID}))
+
+
+class TestMerge:
+    def test_it_should_join_plain_messages_to_a_chat(self):
+        merged = merge([send(1, 'a'), send(1, 'b')])
+
+        assert_that(merged, contains(send(1, 'a\n\nb')))
+
+    def test_it_should_not_join_messages_to_other_chats(self):
+        merged = merge([send(1, 'a'), send(2, 'b')])
+
+        assert_that(merged, is_([send(1, 'a'), send(2, 'b')]))
+
+    def test_it_should_drop_answered_prompts(self):
+        prompt = send(1, '¿Dónde?', reply_markup=dict(force_reply=True))
+
+        merged = merge([prompt, send(1, 'aquí')])
+
+        assert_that(merged, is_([send(1, 'aquí')]))
+
+    def test_it_should_keep_messages_with_keyboards_apart(self):
+        keyboard = dict(inline_keyboard=[[]])
+
+        merged = merge([send(1, 'a'), send(1, 'b', reply_markup=keyboard)])
+
+        assert_that(merged, contains(
+            send(1, 'a'), contains('sendMessage', has_entries(text='b'))))
+
+    def test_it_should_keep_messages_short_enough(self):
+        text = 'a' * (MAX_TEXT // 2 + 1)
+
+        merged = merge([send(1, text), send(1, text)])
+
+        assert_that(merged, is_([send(1, text), send(1, text)]))
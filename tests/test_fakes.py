@@ -0,0 +1,81 @@
+from bicimad import fakes
+from bicimad.server import Server
+from bicimad.telegram import Telegram
+from bicimad.bicimad import BiciMad
+
+from hamcrest import (assert_that, has_length, has_entries, has_entry, is_,
+                      not_)
+
+from .stations import RESPONSE, N_STATIONS
+
+
+TOKEN = 'ab209e3daffa293'
+
+
+class TestFakeTelegram:
+    def test_it_should_serve_generated_updates(self):
+        updates = self.telegram.get_updates()
+
+        assert_that(updates, has_entries(ok=True, result=has_length(5)))
+
+    def test_it_should_serve_updates_from_offset(self):
+        self.telegram.get_updates()
+
+        updates = self.telegram.get_updates(5)
+
+        assert_that(updates['result'][0], has_entry('update_id', 5))
+
+    def test_it_should_accept_messages(self):
+        result = self.telegram.send_message(1, 'hola')
+
+        assert_that(result, has_entries(ok=True, result=has_entries(
+            message_id=1, text='hola')))
+        assert_that(self.fake.calls, has_entry('sendMessage', 1))
+
+    def test_it_should_answer_rate_limited(self):
+        self.fake.ratelimit_rate = 1
+
+        result = self.telegram.send_message(1, 'hola')
+
+        assert_that(result, has_entries(ok=False, error_code=429))
+
+    def test_it_should_fail_requests(self):
+        self.fake.error_rate = 1
+
+        result = self.telegram.send_message(1, 'hola')
+
+        assert_that(result, has_entries(ok=False, error_code=500))
+
+    def setup(self):
+        updates = fakes.generate_updates(RESPONSE['estaciones'], count=20)
+        self.fake = fakes.FakeTelegram(updates, batch=5)
+        self.server = Server(fakes.make_telegram_app(self.fake)).start()
+        self.telegram = Telegram(self.server.url, TOKEN)
+
+    def teardown(self):
+        self.server.stop()
+
+
+class TestFakeBonopark:
+    def test_it_should_serve_stations(self):
+        stations = self.bicimad.refresh()
+
+        assert_that(stations.stations, has_length(N_STATIONS))
+
+    def test_it_should_change_occupancy(self):
+        before = occupancy(self.bicimad.get_locations())
+        after = occupancy(self.bicimad.get_locations())
+
+        assert_that(after, is_(not_(before)))
+
+    def setup(self):
+        self.fake = fakes.FakeBonopark(RESPONSE, moves=10)
+        self.server = Server(fakes.make_bonopark_app(self.fake)).start()
+        self.bicimad = BiciMad(self.server.url, 'user', 'auth', 'security')
+
+    def teardown(self):
+        self.server.stop()
+
+
+def occupancy(response):
+    return [s['bicis_enganchadas'] for s in response['estaciones']]
@@ -4,10 +4,11 @@ from .stations import (AVAILABLE_STATION, FIRST_STATION, UNAVAILABLE_STATION,
 
 from hamcrest import (assert_that, has_property, is_, only_contains,
                       greater_than, all_of, none, contains, less_than,
-                      contains_string)
+                      contains_string, has_length, has_entry)
 
 from bicimad.bicimad import (Station, enabled, distance, with_bikes, search,
-                             find, sort, query, index, with_spaces)
+                             find, sort, query, index, with_spaces,
+                             levenshtein, SearchIndex)
 
 
 class FilterTest:
@@ -142,3 +143,63 @@ class TestIndex(FilterTest):
             contains_string('matadero'),
             contains_string('chopera'))
         )))
+
+
+class TestLevenshtein:
+    def test_it_should_count_edits(self):
+        assert_that(levenshtein('atoxa', 'atocha', 2), is_(2))
+
+    def test_it_should_stop_past_the_limit(self):
+        assert_that(levenshtein('sol', 'lavapies', 2), is_(3))
+
+
+class TestSearchIndex(FilterTest):
+    def setup(self):
+        stations = list(self.stations((
+            FIRST_STATION, AVAILABLE_STATION, UNAVAILABLE_STATION,
+            NO_ACTIVE_STATION, NO_SPACES_STATION, NAME_AND_ADDRESS_STATION)))
+        self.index = SearchIndex(tuple((station.nombre, station.address)
+                                       for station in stations))
+        self.ids = [station.idestacion for station in stations]
+
+    def search(self, query, max=5):
+        return [self.ids[number] for number in self.index.search(query, max)]
+
+    def test_it_should_find_words_with_typos(self):
+        assert_that(self.search('lavapiez'),
+                    contains(UNAVAILABLE_STATION['idestacion']))
+
+    def test_it_should_need_every_word(self):
+        assert_that(self.search('santa lavapiez'), is_([]))
+
+    def test_it_should_find_short_words_with_two_typos(self):
+        assert_that(self.index.similar('sxntx'), has_entry('santa', 2))
+
+    def test_it_should_rank_fewer_typos_first(self):
+        assert_that(self.search('moya'), contains(
+            NO_ACTIVE_STATION['idestacion'], NO_SPACES_STATION['idestacion']))
+
+    def test_it_should_add_typos_of_every_word(self):
+        assert_that(self.search('goya colom'), contains(
+            NO_SPACES_STATION['idestacion']))
+
+    def test_it_should_limit_results(self):
+        assert_that(self.search('moya', max=1), has_length(1))
+
+    def test_it_should_not_allow_typos_in_short_words(self):
+        assert_that(self.search('sul'), is_([]))
+
+    def test_it_should_complete_the_last_word(self):
+        numbers = self.index.completing('puerta del s')
+
+        assert_that([self.ids[number] for number in numbers],
+                    contains(FIRST_STATION['idestacion']))
+
+    def test_it_should_need_every_complete_word(self):
+        assert_that(self.index.completing('santa lav'), is_([]))
+
+    def test_it_should_find_exact_matches_sorted(self):
+        numbers = self.index.matching('Plaza Santa Ana')
+
+        assert_that([self.ids[number] for number in numbers],
+                    contains(AVAILABLE_STATION['idestacion']))
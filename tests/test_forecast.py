@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import time
+from unittest.mock import Mock
+
+from bicimad.bicimad import BiciMad, Stations
+from bicimad.history import History
+from bicimad.forecast import (Forecaster, at_least_one, time_bin, bin_end,
+                              evaluate, install, BIN_MINUTES, DAY_BINS)
+
+from hamcrest import (assert_that, is_, close_to, less_than, greater_than,
+                      has_entries, has_property, same_instance, has_item,
+                      none)
+
+from .stations import FIRST_STATION
+
+
+# a monday at 08:00 local time
+MONDAY = time.mktime((2016, 5, 2, 8, 0, 0, 0, 0, -1))
+
+
+class Station:
+    def __init__(self, id, bikes, spaces=10):
+        self.id = id
+        self.bikes = bikes
+        self.spaces = spaces
+
+
+class TestAtLeastOne:
+    def test_it_should_keep_availability_without_flows(self):
+        assert_that(at_least_one(3, 0, 0), close_to(1, 1e-9))
+        assert_that(at_least_one(0, 0, 0), close_to(0, 1e-9))
+
+    def test_it_should_be_unlikely_when_bikes_leave_fast(self):
+        assert_that(at_least_one(1, 0, 10), less_than(0.01))
+
+    def test_it_should_be_likely_when_bikes_arrive_fast(self):
+        assert_that(at_least_one(0, 10, 0), greater_than(0.99))
+
+    def test_it_should_match_poisson_for_empty_stations(self):
+        assert_that(at_least_one(0, 2, 0), close_to(1 - 2.718281828 ** -2,
+                                                    1e-6))
+
+
+class TestTimeBins:
+    def test_it_should_split_the_day(self):
+        assert_that(time_bin(MONDAY), is_(8 * 60 // BIN_MINUTES))
+
+    def test_it_should_have_weekend_bins(self):
+        sunday = MONDAY - 24 * 60 * 60
+        assert_that(time_bin(sunday), is_(DAY_BINS + time_bin(MONDAY)))
+
+    def test_it_should_end_bins(self):
+        assert_that(bin_end(MONDAY + 60), is_(MONDAY + BIN_MINUTES * 60))
+
+
+class TestForecaster:
+    def test_it_should_learn_departures(self):
+        self.forecaster.observe(1, MONDAY, 10)
+        self.forecaster.observe(1, MONDAY + 600, 5)
+
+        prediction = self.forecaster.predict(1, 2, 10, 10, MONDAY)
+
+        assert_that(prediction, has_property('expected', close_to(0, 1e-9)))
+        assert_that(prediction.bikes, less_than(0.5))
+        assert_that(prediction.spaces, close_to(1, 1e-6))
+
+    def test_it_should_spread_changes_over_quiet_periods(self):
+        self.forecaster.observe(1, MONDAY, 10)
+        self.forecaster.observe(1, MONDAY + 3600, 14)
+
+        flows = self.forecaster.flows[1]
+
+        assert_that(flows.arrivals[time_bin(MONDAY)], close_to(4 / 60.0, 1e-9))
+        assert_that(flows.arrivals[time_bin(MONDAY + 3000)],
+                    close_to(4 / 60.0, 1e-9))
+
+    def test_it_should_keep_station_state_for_unknown_stations(self):
+        prediction = self.forecaster.predict(1, 2, 0, 10, MONDAY)
+
+        assert_that(prediction, has_property('observations', 0))
+        assert_that((prediction.bikes, prediction.spaces), is_((1.0, 0.0)))
+
+    def test_it_should_only_look_at_changed_stations(self):
+        self.forecaster.observe = Mock()
+        previous = Mock(Stations, stations=[Station(1, 3), Station(2, 3)])
+        previous.ids = dict((s.id, s) for s in previous.stations)
+        current = Mock(Stations, stations=[Station(1, 3), Station(2, 4)])
+
+        self.forecaster.update(previous, current)
+
+        self.forecaster.observe.assert_called_once_with(2, MONDAY, 4)
+
+    def test_it_should_learn_from_history(self):
+        history = History()
+        history.record([Station(1, 10)], MONDAY)
+        history.record([Station(1, 5)], MONDAY + 600)
+
+        self.forecaster.train(history)
+
+        assert_that(self.forecaster.flows[1].departures[time_bin(MONDAY)],
+                    close_to(0.5, 1e-9))
+
+    def setup(self):
+        self.forecaster = Forecaster(clock=lambda: MONDAY)
+
+
+class TestEvaluate:
+    def test_it_should_beat_keeping_things_as_they_are(self):
+        history = History()
+        # empties every morning between 8 and 9, fills up at 18
+        for day in range(8):
+            start = MONDAY + day * 24 * 60 * 60
+            for minute in range(0, 60, 5):
+                history.record([Station(1, 11 - minute // 5)],
+                               start + minute * 60)
+            for minute in range(0, 60, 5):
+                history.record([Station(1, minute // 5)],
+                               start + 10 * 60 * 60 + minute * 60)
+
+        report = evaluate(history, minutes=30, step=300,
+                          warmup=7 * 24 * 60 * 60)
+
+        assert_that(report, has_entries(samples=greater_than(0)))
+        assert_that(report['brier']['bikes'],
+                    less_than(report['baseline_brier']['bikes']))
+
+
+class TestStationsForecast:
+    def test_it_should_not_forecast_without_model(self):
+        stations = Stations([FIRST_STATION])
+
+        assert_that(stations.forecast(stations.stations[0], 10), is_(none()))
+
+    def test_it_should_forecast_with_model(self):
+        stations = Stations([FIRST_STATION], forecaster=Forecaster())
+
+        prediction = stations.forecast(stations.stations[0], 10)
+
+        assert_that(prediction, has_property('minutes', 10))
+
+
+class TestInstall:
+    def test_it_should_listen_to_stations_refreshes(self):
+        bicimad = Mock(BiciMad)
+        bicimad.listeners = []
+        bicimad.history = None
+
+        forecaster = install({}, bicimad)
+
+        assert_that(bicimad.forecaster, same_instance(forecaster))
+        assert_that(bicimad.listeners, has_item(forecaster.update))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from bicimad.gazetteer import (Gazetteer, Street, normalize, parse_address,
+                               parse_line, format_line, build, locate)
+
+from hamcrest import (assert_that, is_, is_not, none, not_none, contains,
+                      close_to, has_property, greater_than)
+
+
+ALCALA = Street('alcala', 'Calle Alcalá', [
+    (10, 40.0, -3.0), (30, 40.2, -3.2), (None, 41.0, -4.0)])
+ALCANTARA = Street('alcantara', 'Calle Alcántara', [(None, 40.4, -3.6)])
+
+
+class TestNormalize:
+    def test_it_should_remove_accents_and_case(self):
+        assert_that(normalize('Alcalá'), is_('alcala'))
+
+    def test_it_should_remove_kinds_of_street(self):
+        assert_that(normalize('C/ de la Princesa'), is_('princesa'))
+
+    def test_it_should_remove_numbers(self):
+        assert_that(normalize('Avenida Menéndez Pelayo 2'),
+                    is_('menendez pelayo'))
+
+    def test_it_should_expand_abbreviations(self):
+        assert_that(normalize('C/Sta Engracia'), is_('santa engracia'))
+
+    def test_it_should_ignore_apostrophes_and_doubled_letters(self):
+        assert_that(normalize("Calle O'Donell"),
+                    is_(normalize('Calle ODonnell')))
+
+    def test_it_should_keep_roman_numbers(self):
+        assert_that(normalize('Alfonso XII'), is_not(normalize('Alfonso XI')))
+
+
+class TestParseAddress:
+    def test_it_should_parse_street_and_number(self):
+        assert_that(parse_address('Calle Alcalá, 49'), is_(('alcala', 49)))
+
+    def test_it_should_parse_number_signs(self):
+        assert_that(parse_address('Plaza de Lavapiés Nº8'),
+                    is_(('lavapies', 8)))
+
+    def test_it_should_parse_streets_without_number(self):
+        assert_that(parse_address('Paseo del Prado'), is_(('prado', None)))
+
+    def test_it_should_ignore_crossings(self):
+        assert_that(parse_address('Serrano 12 esquina Goya'),
+                    is_(('serano', 12)))
+
+
+class TestStreet:
+    def test_it_should_interpolate_numbers(self):
+        lat, long = ALCALA.position(20)
+
+        assert_that(lat, close_to(40.1, 1e-9))
+        assert_that(long, close_to(-3.1, 1e-9))
+
+    def test_it_should_clamp_numbers_out_of_range(self):
+        assert_that(ALCALA.position(90), is_((40.2, -3.2)))
+
+    def test_it_should_give_centroid_without_number(self):
+        lat, long = ALCALA.position()
+
+        assert_that(lat, close_to(40.4, 1e-9))
+
+    def test_it_should_round_trip_lines(self):
+        street = parse_line(format_line(ALCALA))
+
+        assert_that(street.points, is_(ALCALA.points))
+        assert_that(street.name, is_(ALCALA.name))
+
+
+class TestGazetteer:
+    def setup(self):
+        self.gazetteer = Gazetteer([ALCANTARA, ALCALA])
+
+    def test_it_should_find_by_exact_name(self):
+        assert_that(self.gazetteer.find('Alcalá'), is_(ALCALA))
+
+    def test_it_should_find_by_prefix(self):
+        assert_that(self.gazetteer.find('calle alcan'), is_(ALCANTARA))
+
+    def test_it_should_not_find_unknown_streets(self):
+        assert_that(self.gazetteer.find('wwwwww'), is_(none()))
+
+    def test_it_should_locate_addresses(self):
+        assert_that(self.gazetteer.locate('alcala 30'),
+                    contains(ALCALA, 30, (40.2, -3.2)))
+
+
+class TestBuild:
+    def test_it_should_build_from_station_addresses(self):
+        gazetteer = build({'estaciones': [
+            dict(direccion='Calle Alcalá nº 10', latitud='40.0',
+                 longitud='-3.0'),
+            dict(direccion='Calle Alcalá nº 30', latitud='40.2',
+                 longitud='-3.2'),
+            dict(direccion='NO OPERATIVA', latitud='0', longitud='0'),
+        ]})
+
+        assert_that(gazetteer.streets, contains(
+            has_property('points', [(10, 40.0, -3.0), (30, 40.2, -3.2)])))
+
+    def test_it_should_load_bundled_streets(self):
+        located = locate('Calle Alcalá 49')
+
+        assert_that(located, is_(not_none()))
+        assert_that(located[0].name, is_('Calle Alcala'))
+        assert_that(located[2][0], greater_than(40))
+
+    def test_it_should_list_bundled_streets_once(self):
+        assert_that(locate('Sta Engracia 168')[0],
+                    is_(locate('Santa Engracia 127')[0]))
+        assert_that(locate("O'Donnell 28")[0], is_(locate('ODonell 50')[0]))
@@ -0,0 +1,200 @@
+import io
+import json
+import time
+import threading
+from unittest.mock import Mock, patch
+
+from bicimad import handlers
+from bicimad.workers import WorkerPool
+from bicimad.telegram import Telegram, Update
+from bicimad.bicimad import BiciMad
+
+from hamcrest import (assert_that, is_, starts_with, has_entry, has_entries,
+                      contains_string, has_length, all_of)
+
+from .messages import (UPDATE_COMMAND, MSG_COMMAND, MSG_LOCATION, UPDATE_ID,
+                       CHAT_ID, UPDATE_INLINE)
+
+
+TOKEN = 'ab209e3daffa293'
+UPDATE_START = {
+    "update_id": UPDATE_ID,
+    "message": dict(MSG_COMMAND, text='/start')
+}
+
+
+class Response:
+    def __call__(self, status, headers, exc_info=None):
+        self.status = status
+        self.headers = dict(headers)
+
+
+def get(path):
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path}
+    response = Response()
+    response.body = b''.join(handlers.app(environ, response))
+    return response
+
+
+def post(path, data):
+    body = json.dumps(data).encode('utf-8')
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': path,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    }
+    response = Response()
+    response.body = b''.join(handlers.app(environ, response))
+    return response
+
+
+class TestWebhook:
+    def test_it_should_reject_unknown_tokens(self):
+        response = post('/webhook/other', UPDATE_COMMAND)
+
+        assert_that(response.status, starts_with('401'))
+
+    def test_it_should_reject_bad_updates(self):
+        response = post('/webhook/' + TOKEN, {'message': {}})
+
+        assert_that(response.status, starts_with('400'))
+
+    def test_it_should_queue_updates_and_answer_right_away(self):
+        response = post('/webhook/' + TOKEN, UPDATE_COMMAND)
+
+        assert_that(response.status, starts_with('200'))
+        assert_that(self.pool.queues[0].qsize(), is_(1))
+
+    def test_it_should_ask_to_retry_later_when_busy(self):
+        post('/webhook/' + TOKEN, UPDATE_COMMAND)
+
+        response = post('/webhook/' + TOKEN, UPDATE_COMMAND)
+
+        assert_that(response.status, starts_with('503'))
+        assert_that(response.headers, has_entry('Retry-After', '1'))
+
+    def test_it_should_answer_single_replies_in_the_response(self):
+        self.pool.telegram = Telegram('https://api.none.com', TOKEN)
+        self.pool.start()
+
+        response = post('/webhook/' + TOKEN, UPDATE_START)
+        self.pool.stop()
+
+        assert_that(response.headers, has_entry(
+            'Content-Type', 'application/json'))
+        assert_that(json.loads(response.body.decode('utf-8')), has_entries(
+            method='sendMessage', chat_id=CHAT_ID,
+            text=contains_string('¡Hola!')))
+
+    def test_it_should_not_wait_for_other_commands(self):
+        handlers.app.config['webhook.reply_timeout'] = '5'
+
+        response = post('/webhook/' + TOKEN, UPDATE_COMMAND)
+
+        assert_that(response.body, is_(b''))
+
+    def test_it_should_not_wait_for_live_locations(self):
+        location = dict(MSG_LOCATION['location'], live_period=900)
+        update = Update.from_response({
+            'update_id': UPDATE_ID,
+            'message': dict(MSG_LOCATION, location=location)})
+
+        assert_that(handlers.wants_fast_reply(update), is_(False))
+
+    def test_it_should_answer_inline_queries_fast(self):
+        update = Update.from_response(UPDATE_INLINE)
+
+        assert_that(handlers.wants_fast_reply(update), is_(True))
+
+    def test_it_should_forward_updates_of_chats_kept_by_other_workers(self):
+        handlers.peers = ['http://worker-0', 'http://worker-1']
+        handlers.worker = 1 - hash(CHAT_ID) % 2
+        forwarded = Mock(status_code=200, content=b'{"method": "x"}',
+                         headers={'Content-Type': 'application/json'})
+
+        with patch('requests.post', return_value=forwarded) as post_:
+            response = post('/webhook/' + TOKEN, UPDATE_COMMAND)
+
+        assert_that(post_.call_args[0][0], is_(
+            'http://worker-{}/webhook/{}'.format(hash(CHAT_ID) % 2, TOKEN)))
+        assert_that(response.body, is_(b'{"method": "x"}'))
+        assert_that(self.pool.queues[0].qsize(), is_(0))
+
+    def test_it_should_process_updates_of_its_own_chats(self):
+        handlers.peers = ['http://worker-0', 'http://worker-1']
+        handlers.worker = hash(CHAT_ID) % 2
+
+        with patch('requests.post') as post_:
+            post('/webhook/' + TOKEN, UPDATE_COMMAND)
+
+        post_.assert_not_called()
+        assert_that(self.pool.queues[0].qsize(), is_(1))
+
+    def test_it_should_create_a_single_pool(self):
+        handlers.pool = None
+        created = []
+
+        def from_config(config, bicimad):
+            created.append(config)
+            time.sleep(0.01)
+            return Mock(WorkerPool)
+
+        with patch.object(WorkerPool, 'from_config', from_config):
+            threads = [threading.Thread(target=handlers.get_pool)
+                       for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert_that(created, has_length(1))
+
+    def setup(self):
+        handlers.app.config['telegram.token'] = TOKEN
+        handlers.app.config['webhook.reply_timeout'] = '1'
+
+        self.pool = WorkerPool(Mock(Telegram), Mock(BiciMad),
+                               workers=1, queue_size=1)
+        handlers.pool = self.pool
+
+    def teardown(self):
+        handlers.pool = None
+        handlers.peers = ()
+        handlers.worker = None
+
+
+class TestMetrics:
+    def test_it_should_serve_prometheus_metrics(self):
+        response = get('/metrics')
+
+        assert_that(response.status, starts_with('200'))
+        assert_that(response.headers, has_entry(
+            'Content-Type', starts_with('text/plain; version=0.0.4')))
+        assert_that(response.body.decode('utf-8'), contains_string(
+            '# TYPE bicimad_stage_seconds histogram'))
+
+    def test_it_should_serve_metrics_of_every_worker(self):
+        handlers.peers = ['http://worker-0', 'http://worker-1']
+        handlers.worker = 0
+        other = handlers.metrics.registry.render([('worker', 1)])
+
+        with patch('requests.get', return_value=Mock(text=other)) as get_:
+            response = get('/metrics')
+
+        get_.assert_called_once_with('http://worker-1/metrics/worker',
+                                     timeout=handlers.FORWARD_TIMEOUT)
+        body = response.body.decode('utf-8')
+        assert_that(body.count('# TYPE bicimad_stage_seconds histogram'),
+                    is_(1))
+        assert_that(body, all_of(
+            contains_string('{worker="0",stage='),
+            contains_string('{worker="1",stage=')))
+
+    def setup(self):
+        handlers.metrics.registry.stages.observe(0.1, stage='metrics')
+
+    def teardown(self):
+        handlers.peers = ()
+        handlers.worker = None
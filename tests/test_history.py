@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from unittest.mock import Mock
+
+from bicimad.bicimad import BiciMad
+from bicimad.history import (History, Series, Segment, RECORD, MAX_DELTA,
+                             parse_time, install)
+
+from hamcrest import (assert_that, is_, contains, has_length, empty,
+                      same_instance, none, has_item)
+
+
+START = 1462084200
+
+
+class Station:
+    def __init__(self, id, bikes, spaces):
+        self.id = id
+        self.bikes = bikes
+        self.spaces = spaces
+
+
+class TestSeries:
+    def test_it_should_keep_only_changes(self):
+        series = Series()
+
+        series.append(START, 1, 5)
+        series.append(START + 30, 1, 5)
+        series.append(START + 60, 2, 4)
+
+        assert_that(list(series.records()), contains(
+            (START, 1, 5), (START + 60, 2, 4)))
+
+    def test_it_should_span_long_gaps(self):
+        series = Series()
+        series.append(START, 1, 5)
+
+        series.append(START + MAX_DELTA + 10, 2, 4)
+
+        assert_that(list(series.records())[-1],
+                    is_((START + MAX_DELTA + 10, 2, 4)))
+
+    def test_it_should_drop_oldest_records_when_full(self):
+        series = Series(capacity=4)
+        for number in range(6):
+            series.append(START + number * 10, number, 0)
+
+        assert_that(list(series.records()), contains(
+            (START + 20, 2, 0), (START + 30, 3, 0),
+            (START + 40, 4, 0), (START + 50, 5, 0)))
+
+    def test_it_should_query_time_windows(self):
+        series = Series()
+        for number in range(6):
+            series.append(START + number * 10, number, 0)
+
+        records = list(series.records(START + 15, START + 35))
+
+        assert_that(records, contains((START + 20, 2, 0), (START + 30, 3, 0)))
+
+    def test_it_should_take_four_bytes_per_change(self):
+        series = Series()
+        for number in range(10):
+            series.append(START + number, number, 0)
+
+        assert_that(series.to_bytes(), has_length(10 * RECORD.size))
+        assert_that(RECORD.size, is_(4))
+
+
+class TestHistory:
+    def test_it_should_record_stations(self):
+        self.history.record([Station(1, 3, 4)], START)
+
+        assert_that(self.history.query(1), contains((START, 3, 4)))
+
+    def test_it_should_write_segments(self):
+        self.history.record([Station(1, 3, 4)], START)
+        self.history.record([Station(1, 2, 5)], START + 30)
+
+        self.history.flush()
+
+        assert_that(os.listdir(self.folder), has_length(1))
+        assert_that(self.history.segments, has_length(1))
+
+    def test_it_should_start_segments_every_period(self):
+        self.history.record([Station(1, 3, 4)], START)
+
+        self.history.record([Station(1, 2, 5)], START + 3600)
+
+        assert_that(self.history.segments, has_length(1))
+
+    def test_it_should_query_across_segments_and_memory(self):
+        self.history.record([Station(1, 3, 4)], START)
+        self.history.record([Station(1, 2, 5)], START + 3600)
+        self.history.record([Station(1, 1, 6)], START + 3630)
+
+        assert_that(self.history.query(1), contains(
+            (START, 3, 4), (START + 3600, 3, 4),
+            (START + 3600, 2, 5), (START + 3630, 1, 6)))
+
+    def test_it_should_query_time_windows_in_segments(self):
+        for number in range(5):
+            self.history.record([Station(1, number, 0)], START + number * 10)
+        self.history.flush()
+
+        records = self.history.query(1, START + 15, START + 35)
+
+        assert_that(records, contains((START + 20, 2, 0), (START + 30, 3, 0)))
+
+    def test_it_should_load_segments_from_disk(self):
+        self.history.record([Station(1, 3, 4), Station(2, 0, 9)], START)
+        self.history.close()
+
+        history = History(self.folder)
+
+        assert_that(history.stations(), contains(1, 2))
+        assert_that(history.query(2), contains((START, 0, 9)))
+
+    def test_it_should_skip_bad_segments(self):
+        with open(os.path.join(self.folder, '0-1.seg'), 'wb') as stream:
+            stream.write(b'garbage' * 10)
+
+        history = History(self.folder)
+
+        assert_that(history.segments, is_(empty()))
+
+    def test_it_should_map_segment_files(self):
+        self.history.record([Station(1, 3, 4)], START)
+        self.history.flush()
+
+        segment = Segment(self.history.segments[0].path)
+
+        assert_that(list(segment.records(1)), contains((START, 3, 4)))
+        assert_that(list(segment.records(2)), is_(empty()))
+
+    def setup(self):
+        self.folder = tempfile.mkdtemp()
+        self.history = History(self.folder, segment=3600,
+                               clock=lambda: START + 60)
+
+    def teardown(self):
+        self.history.close()
+        shutil.rmtree(self.folder)
+
+
+class TestInstall:
+    def test_it_should_not_record_without_path(self):
+        bicimad = Mock(BiciMad)
+        bicimad.listeners = []
+
+        assert_that(install({}, bicimad), is_(none()))
+        assert_that(bicimad.listeners, is_(empty()))
+
+    def test_it_should_listen_to_stations_refreshes(self):
+        bicimad = Mock(BiciMad)
+        bicimad.listeners = []
+        history = History()
+
+        install({}, bicimad, history)
+
+        assert_that(bicimad.history, same_instance(history))
+        assert_that(bicimad.listeners, has_item(history.update))
+
+
+class TestParseTime:
+    def test_it_should_parse_seconds(self):
+        assert_that(parse_time('1462084200'), is_(1462084200.0))
+
+    def test_it_should_parse_iso_dates(self):
+        assert_that(parse_time('2016-05-01T08:30'),
+                    is_(parse_time('2016-05-01T08:30:00')))
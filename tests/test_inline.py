@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from bicimad.inline import AnswerCache, article
+
+from hamcrest import assert_that, is_, none, has_entries, has_length
+
+
+class Station:
+    id = 1
+    address = 'Puerta del Sol No 1'
+
+
+class TestArticle:
+    def test_it_should_send_text_about_station(self):
+        assert_that(article(Station(), 'text'), has_entries(
+            type='article', id='1', title=Station.address,
+            input_message_content=has_entries(message_text='text')))
+
+
+class TestAnswerCache:
+    def setup(self):
+        self.now = 0
+        self.cache = AnswerCache(ttl=10, size=2, clock=lambda: self.now)
+
+    def test_it_should_keep_answers_by_version_and_query(self):
+        self.cache.put(1, 'sol', ['sol'])
+
+        assert_that(self.cache.get(1, 'sol'), is_(['sol']))
+        assert_that(self.cache.get(2, 'sol'), is_(none()))
+        assert_that(self.cache.get(1, 'so'), is_(none()))
+
+    def test_it_should_expire_answers(self):
+        self.cache.put(1, 'sol', ['sol'])
+        self.now = 11
+
+        assert_that(self.cache.get(1, 'sol'), is_(none()))
+        assert_that(self.cache, has_length(0))
+
+    def test_it_should_drop_least_recently_used(self):
+        self.cache.put(1, 'sol', ['sol'])
+        self.cache.put(1, 'lava', ['lava'])
+        self.cache.get(1, 'sol')
+
+        self.cache.put(1, 'atocha', ['atocha'])
+
+        assert_that(self.cache.get(1, 'lava'), is_(none()))
+        assert_that(self.cache.get(1, 'sol'), is_(['sol']))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from bicimad.live import LiveSessions, signature, reply_id
+from bicimad.telegram import Update
+
+from hamcrest import (assert_that, is_, none, not_none, not_, has_property,
+                      has_length)
+
+from .messages import MSG_LOCATION, UPDATE_ID
+
+
+def live_update(message_id=21, live_period=900, kind='message'):
+    message = dict(MSG_LOCATION, message_id=message_id,
+                   location=dict(MSG_LOCATION['location'],
+                                 live_period=live_period))
+    return Update.from_response({'update_id': UPDATE_ID, kind: message})
+
+
+class Station:
+    def __init__(self, id, bikes, spaces=0, enabled=True, distance=0):
+        self.id = id
+        self.bikes = bikes
+        self.spaces = spaces
+        self.enabled = enabled
+        self.distance = distance
+
+
+class TestSignature:
+    def test_it_should_ignore_distances(self):
+        assert_that(signature([Station(1, 2, distance=10)]),
+                    is_(signature([Station(1, 2, distance=90)])))
+
+    def test_it_should_change_with_counts(self):
+        assert_that(signature([Station(1, 2)]),
+                    is_(not_(signature([Station(1, 3)]))))
+
+    def test_it_should_change_with_stations(self):
+        assert_that(signature([Station(1, 2), Station(2, 2)]),
+                    is_(not_(signature([Station(2, 2), Station(1, 2)]))))
+
+
+class TestReplyId:
+    def test_it_should_get_sent_message_id(self):
+        assert_that(reply_id({'ok': True, 'result': {'message_id': 7}}),
+                    is_(7))
+
+    def test_it_should_be_none_without_result(self):
+        assert_that(reply_id({'ok': True, 'result': None}), is_(none()))
+
+
+class TestLiveSessions:
+    def setup(self):
+        self.now = MSG_LOCATION['date']
+        self.sessions = LiveSessions(size=2, clock=lambda: self.now)
+
+    def test_it_should_find_session_from_edits(self):
+        self.sessions.start(live_update(), 99, ())
+
+        session = self.sessions.get(live_update(kind='edited_message'))
+
+        assert_that(session, has_property('reply_id', 99))
+
+    def test_it_should_expire_after_live_period(self):
+        self.sessions.start(live_update(live_period=60), 99, ())
+        self.now += 61
+
+        assert_that(self.sessions.get(live_update()), is_(none()))
+        assert_that(self.sessions, has_length(0))
+
+    def test_it_should_drop_least_recently_updated(self):
+        self.sessions.start(live_update(1), 1, ())
+        self.sessions.start(live_update(2), 2, ())
+        self.sessions.get(live_update(1))
+
+        self.sessions.start(live_update(3), 3, ())
+
+        assert_that(self.sessions.get(live_update(1)), is_(not_none()))
+        assert_that(self.sessions.get(live_update(2)), is_(none()))
+
+    def test_it_should_stop(self):
+        self.sessions.start(live_update(), 99, ())
+
+        self.sessions.stop(live_update())
+
+        assert_that(self.sessions.get(live_update()), is_(none()))
@@ -0,0 +1,76 @@
+import json
+import logging
+
+from bicimad.logs import (correlate, current_update, CorrelationFilter,
+                          SamplingFilter, JsonFormatter, parse_rates)
+
+from hamcrest import (assert_that, is_, none, has_entries, calling, raises,
+                      has_entry, has_length, greater_than, less_than, all_of)
+
+
+def record(level=logging.INFO, message='hola %s', args=('mundo',)):
+    return logging.LogRecord('bicimad.telegram', level, __file__, 1,
+                             message, args, None)
+
+
+class TestCorrelate:
+    def test_it_should_set_current_update_inside(self):
+        with correlate(42):
+            assert_that(current_update(), is_(42))
+
+        assert_that(current_update(), is_(none()))
+
+    def test_it_should_tag_records(self):
+        item = record()
+
+        with correlate(42):
+            CorrelationFilter().filter(item)
+
+        assert_that(item.update, is_(42))
+
+
+class TestSamplingFilter:
+    def test_it_should_keep_levels_without_rate(self):
+        sampling = SamplingFilter({logging.INFO: 0})
+
+        assert_that(sampling.filter(record(logging.ERROR)), is_(True))
+
+    def test_it_should_keep_lines_without_update(self):
+        sampling = SamplingFilter({logging.INFO: 0})
+
+        assert_that(sampling.filter(record()), is_(True))
+
+    def test_it_should_keep_all_or_none_of_an_update_lines(self):
+        sampling = SamplingFilter({logging.INFO: 0.5})
+
+        kept = set()
+        for update in range(1000):
+            with correlate(update):
+                first = sampling.filter(record())
+                second = sampling.filter(record())
+            assert_that(first, is_(second))
+            if first:
+                kept.add(update)
+
+        assert_that(kept, has_length(all_of(greater_than(0), less_than(1000))))
+
+
+class TestJsonFormatter:
+    def test_it_should_format_json_lines(self):
+        item = record()
+        item.update = 42
+
+        line = JsonFormatter().format(item)
+
+        assert_that(json.loads(line), has_entries(
+            level='INFO', logger='bicimad.telegram', message='hola mundo',
+            update=42))
+
+
+class TestParseRates:
+    def test_it_should_parse_level_rates(self):
+        assert_that(parse_rates(['info=0.01']), has_entry(logging.INFO, 0.01))
+
+    def test_it_should_reject_unknown_levels(self):
+        assert_that(calling(parse_rates).with_args(['LOUD=1']),
+                    raises(ValueError))
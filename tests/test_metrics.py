@@ -0,0 +1,115 @@
+from bicimad import metrics
+from bicimad.metrics import Registry
+
+from hamcrest import (assert_that, contains_string, is_, all_of, calling,
+                      raises)
+
+
+class TestCounter:
+    def test_it_should_render_values_by_labels(self):
+        counter = self.registry.counter('bmad_things_total', 'Things')
+
+        counter.inc(kind='a')
+        counter.inc(2, kind='a')
+
+        assert_that(self.registry.render(), all_of(
+            contains_string('# TYPE bmad_things_total counter'),
+            contains_string('bmad_things_total{kind="a"} 3')))
+
+    def test_it_should_escape_label_values(self):
+        counter = self.registry.counter('bmad_things_total', 'Things')
+
+        counter.inc(kind='say "hi"')
+
+        assert_that(self.registry.render(), contains_string(
+            'bmad_things_total{kind="say \\"hi\\""} 1'))
+
+    def setup(self):
+        self.registry = Registry()
+
+
+class TestRender:
+    def test_it_should_add_labels_to_every_sample(self):
+        self.registry.counter('bmad_things_total', 'Things').inc(kind='a')
+
+        assert_that(self.registry.render([('worker', 1)]), contains_string(
+            'bmad_things_total{worker="1",kind="a"} 1'))
+
+    def test_it_should_merge_samples_of_each_metric(self):
+        counter = self.registry.counter('bmad_things_total', 'Things')
+        counter.inc(kind='a')
+        first = self.registry.render([('worker', 0)])
+        counter.inc(kind='a')
+        second = self.registry.render([('worker', 1)])
+
+        merged = metrics.merge([first, second])
+
+        assert_that(merged.count('# TYPE bmad_things_total counter'), is_(1))
+        assert_that(merged, contains_string(
+            'bmad_things_total{worker="0",kind="a"} 1\n'
+            'bmad_things_total{worker="1",kind="a"} 2\n'))
+
+    def setup(self):
+        self.registry = Registry()
+
+
+class TestHistogram:
+    def test_it_should_render_cumulative_buckets(self):
+        histogram = self.registry.histogram('bmad_seconds', 'Time', (0.1, 1))
+
+        histogram.observe(0.05, stage='a')
+        histogram.observe(0.5, stage='a')
+
+        assert_that(self.registry.render(), all_of(
+            contains_string('# TYPE bmad_seconds histogram'),
+            contains_string('bmad_seconds_bucket{stage="a",le="0.1"} 1'),
+            contains_string('bmad_seconds_bucket{stage="a",le="1"} 2'),
+            contains_string('bmad_seconds_bucket{stage="a",le="+Inf"} 2'),
+            contains_string('bmad_seconds_sum{stage="a"} 0.55'),
+            contains_string('bmad_seconds_count{stage="a"} 2')))
+
+    def setup(self):
+        self.registry = Registry()
+
+
+class TestTimed:
+    def test_it_should_not_record_when_sampling_is_off(self):
+        metrics.registry.sample_rate = 0
+
+        self.function()
+
+        assert_that(self.count(), is_(0))
+
+    def test_it_should_record_sampled_calls(self):
+        metrics.registry.sample_rate = 1
+
+        self.function()
+
+        assert_that(self.count(), is_(1))
+
+    def test_it_should_count_errors(self):
+        metrics.registry.sample_rate = 1
+
+        assert_that(calling(self.failing), raises(ValueError))
+        assert_that(metrics.registry.errors.get(stage='test-fail'), is_(1))
+
+    def count(self):
+        return metrics.registry.stages.get(stage='test')
+
+    def setup(self):
+        self.registry = metrics.registry
+        metrics.registry = Registry()
+
+        @metrics.timed('test')
+        def function():
+            pass
+
+        @metrics.timed('test-fail')
+        def failing():
+            raise ValueError()
+
+        self.function = function
+        self.failing = failing
+
+    def teardown(self):
+        metrics.registry = self.registry
@@ -0,0 +1,123 @@
+import os
+import json
+import shutil
+import tempfile
+
+from bicimad.offset import OffsetLog, RecentIds
+
+from hamcrest import assert_that, is_, has_entries, contains, has_property
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRecentIds:
+    def test_it_should_remember_added_ids(self):
+        recent = RecentIds(3, [1, 2])
+
+        assert_that(2 in recent, is_(True))
+
+    def test_it_should_forget_oldest_ids_when_full(self):
+        recent = RecentIds(3, [1, 2, 3, 4])
+
+        assert_that(list(recent), contains(2, 3, 4))
+        assert_that(1 in recent, is_(False))
+
+
+class TestOffsetLog:
+    def test_it_should_start_at_zero_without_file(self):
+        assert_that(self.offsets.load(), has_property('offset', 0))
+
+    def test_it_should_advance_past_processed_updates(self):
+        self.offsets.advance(10)
+
+        assert_that(self.offsets, has_property('offset', 11))
+
+    def test_it_should_recognize_processed_updates(self):
+        self.offsets.advance(10)
+
+        assert_that(self.offsets.seen(10), is_(True))
+        assert_that(self.offsets.seen(11), is_(False))
+
+    def test_it_should_not_commit_before_interval(self):
+        self.offsets.advance(10)
+        self.clock.now = 4
+
+        self.offsets.maybe_commit()
+
+        assert_that(os.path.exists(self.path), is_(False))
+
+    def test_it_should_commit_after_interval(self):
+        self.offsets.advance(10)
+        self.clock.now = 5
+
+        self.offsets.maybe_commit()
+
+        assert_that(self.saved, has_entries({'telegram.offset': 11,
+                                             'recent': [10]}))
+
+    def test_it_should_replace_previous_commits(self):
+        self.offsets.advance(10)
+        self.offsets.commit()
+        self.offsets.advance(11)
+        self.offsets.commit()
+
+        assert_that(self.saved, has_entries({'telegram.offset': 12}))
+        assert_that(sorted(os.listdir(self.folder)), contains(
+            'offset.json', 'offset.json.journal'))
+
+    def test_it_should_load_committed_offset_and_recent_ids(self):
+        self.offsets.advance(10)
+        self.offsets.commit()
+
+        offsets = OffsetLog(self.path).load()
+
+        assert_that(offsets, has_property('offset', 11))
+        assert_that(offsets.seen(10), is_(True))
+
+    def test_it_should_skip_updates_processed_after_a_crash(self):
+        self.offsets.advance(10)
+        self.offsets.commit()
+        self.offsets.advance(11)
+        self.offsets.mark(13)
+
+        offsets = OffsetLog(self.path).load()
+
+        assert_that(offsets, has_property('offset', 12))
+        assert_that(offsets.seen(11), is_(True))
+        assert_that(offsets.seen(12), is_(False))
+        assert_that(offsets.seen(13), is_(True))
+
+    def test_it_should_empty_the_journal_on_commit(self):
+        self.offsets.advance(10)
+        self.offsets.commit()
+
+        with open(self.path + '.journal') as stream:
+            assert_that(stream.read(), is_(''))
+
+    def test_it_should_be_configurable(self):
+        offsets = OffsetLog.from_config({'telegram.offset_file': self.path,
+                                         'telegram.offset_interval': '30'})
+
+        assert_that(offsets, has_property('path', self.path))
+        assert_that(offsets, has_property('interval', 30))
+
+    @property
+    def saved(self):
+        with open(self.path) as stream:
+            return json.load(stream)
+
+    def setup(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'offset.json')
+        self.clock = Clock()
+        self.offsets = OffsetLog(self.path, interval=5, clock=self.clock)
+
+    def teardown(self):
+        self.offsets.close()
+        shutil.rmtree(self.folder)
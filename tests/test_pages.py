@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from bicimad.pages import Cursor, Cursors, keyboard, parse_data, PAGE_SIZE
+
+from hamcrest import (assert_that, is_, none, has_length, contains,
+                      has_entries, same_instance)
+
+
+class Station:
+    def __init__(self, id, distance=0):
+        self.id = id
+        self.distance = distance
+
+
+STATIONS = [Station(id, distance=id * 10) for id in range(PAGE_SIZE + 2)]
+
+
+class TestCursor:
+    def test_it_should_give_first_page(self):
+        cursor = Cursor.from_stations(STATIONS, 'with_bikes')
+
+        assert_that(cursor.page(), is_([(id, None)
+                                        for id in range(PAGE_SIZE)]))
+
+    def test_it_should_keep_distances_of_located_results(self):
+        cursor = Cursor.from_stations(STATIONS, 'with_bikes', located=True)
+
+        assert_that(cursor.page()[1], is_((1, 10)))
+
+    def test_it_should_move_to_next_page(self):
+        cursor = Cursor.from_stations(STATIONS, 'with_bikes')
+
+        cursor.next()
+
+        assert_that(cursor.page(), is_([(PAGE_SIZE, None),
+                                        (PAGE_SIZE + 1, None)]))
+        assert_that(cursor.has_next, is_(False))
+
+    def test_it_should_stay_in_last_page(self):
+        cursor = Cursor.from_stations(STATIONS, 'with_bikes')
+
+        cursor.next()
+        cursor.next()
+
+        assert_that(cursor.page(), has_length(2))
+
+
+class TestKeyboard:
+    def test_it_should_offer_more_and_refresh(self):
+        cursor = Cursor.from_stations(STATIONS, 'with_bikes')
+
+        assert_that(keyboard('abc', cursor), contains(contains(
+            has_entries(callback_data='mas:abc'),
+            has_entries(callback_data='actualizar:abc'))))
+
+    def test_it_should_only_refresh_in_last_page(self):
+        cursor = Cursor.from_stations(STATIONS[:2], 'with_bikes')
+
+        assert_that(keyboard('abc', cursor), contains(contains(
+            has_entries(callback_data='actualizar:abc'))))
+
+    def test_it_should_parse_callback_data(self):
+        assert_that(parse_data('mas:abc'), is_(('mas', 'abc')))
+        assert_that(parse_data(None), is_(('', '')))
+
+
+class TestCursors:
+    def setup(self):
+        self.now = 0
+        self.cursors = Cursors(ttl=60, size=2, clock=lambda: self.now)
+        self.cursor = Cursor.from_stations(STATIONS, 'with_bikes')
+
+    def test_it_should_get_cursors_by_chat_and_token(self):
+        token = self.cursors.add(1, self.cursor)
+
+        assert_that(self.cursors.get(1, token), same_instance(self.cursor))
+        assert_that(self.cursors.get(2, token), is_(none()))
+
+    def test_it_should_expire_cursors(self):
+        token = self.cursors.add(1, self.cursor)
+        self.now = 61
+
+        assert_that(self.cursors.get(1, token), is_(none()))
+        assert_that(self.cursors, has_length(0))
+
+    def test_it_should_keep_a_bounded_number_of_cursors(self):
+        first = self.cursors.add(1, self.cursor)
+        self.cursors.add(1, Cursor.from_stations(STATIONS, 'with_bikes'))
+        self.cursors.add(1, Cursor.from_stations(STATIONS, 'with_bikes'))
+
+        assert_that(self.cursors, has_length(2))
+        assert_that(self.cursors.get(1, first), is_(none()))
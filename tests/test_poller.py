@@ -0,0 +1,147 @@
+import os
+import shutil
+import signal
+import tempfile
+from unittest.mock import Mock
+
+from bicimad.poller import Poller, Stopped
+from bicimad.telegram import Telegram
+
+from hamcrest import (assert_that, is_, has_property, same_instance, not_,
+                      calling, raises, has_key, has_length, none)
+
+from .messages import MSG_COMMAND, UPDATE_ID
+
+
+CONFIG = '''
+[telegram]
+token = ab209e3daffa293
+offset_file = {folder}/offset.json
+'''
+
+HISTORY_CONFIG = '''
+[history]
+path = {folder}/history
+'''
+
+THROTTLE_CONFIG = '''
+[throttle]
+search.rate = 0.1
+search.burst = 2
+'''
+
+UPDATE_START = {
+    "update_id": UPDATE_ID,
+    "message": dict(MSG_COMMAND, text='/start')
+}
+
+
+class TestPoller:
+    def test_it_should_process_updates_and_advance_offset(self):
+        self.poll()
+
+        assert_that(self.poller.offsets, has_property('offset', UPDATE_ID + 1))
+
+    def test_it_should_ask_from_current_offset(self):
+        self.poll()
+        self.poll()
+
+        self.poller.telegram.get_updates.assert_called_with(UPDATE_ID + 1)
+
+    def test_it_should_keep_clients_across_iterations(self):
+        bicimad = self.poller.bicimad
+
+        self.poll()
+
+        assert_that(self.poller.bicimad, same_instance(bicimad))
+
+    def test_it_should_keep_conversations_across_iterations(self):
+        self.poll()
+
+        assert_that(self.poller.conversations, has_key(
+            UPDATE_START['message']['from']['id']))
+
+    def test_it_should_reload_when_requested(self):
+        bicimad = self.poller.bicimad
+        self.poller.handle_reload(signal.SIGHUP, None)
+
+        self.poller.maybe_reload()
+
+        assert_that(self.poller.bicimad, is_(not_(same_instance(bicimad))))
+
+    def test_it_should_reload_when_file_changes(self):
+        bicimad = self.poller.bicimad
+        os.utime(self.path, (0, 0))
+
+        self.poller.maybe_reload()
+
+        assert_that(self.poller.bicimad, is_(not_(same_instance(bicimad))))
+
+    def test_it_should_interrupt_when_idle_on_stop(self):
+        assert_that(calling(self.poller.handle_stop).with_args(
+            signal.SIGTERM, None), raises(Stopped))
+
+    def test_it_should_finish_batch_when_busy_on_stop(self):
+        self.poller.busy = True
+
+        self.poller.handle_stop(signal.SIGTERM, None)
+
+        assert_that(self.poller, has_property('running', False))
+
+    def test_it_should_commit_offset_when_stopped(self):
+        self.poller.telegram.get_updates.side_effect = [
+            self.response, Stopped()]
+
+        self.poller.run()
+
+        assert_that(os.path.exists(self.offset_path), is_(True))
+
+    def test_it_should_keep_alerts_across_reloads(self):
+        self.poller.alerts.subscribe(UPDATE_ID, 1)
+        self.poller.handle_reload(signal.SIGHUP, None)
+
+        self.poller.maybe_reload()
+
+        assert_that(self.poller.bicimad.alerts, has_length(1))
+
+    def test_it_should_keep_history_across_reloads(self):
+        with open(self.path, 'a') as stream:
+            stream.write(HISTORY_CONFIG.format(folder=self.folder))
+        self.poller.handle_reload(signal.SIGHUP, None)
+        self.poller.maybe_reload()
+        history = self.poller.bicimad.history
+        assert_that(history, is_(not_(none())))
+
+        self.poller.handle_reload(signal.SIGHUP, None)
+        self.poller.maybe_reload()
+
+        assert_that(self.poller.bicimad.history, same_instance(history))
+
+    def test_it_should_reconfigure_rate_limits_on_reload(self):
+        throttle = self.poller.throttle
+        with open(self.path, 'a') as stream:
+            stream.write(THROTTLE_CONFIG)
+        self.poller.handle_reload(signal.SIGHUP, None)
+
+        self.poller.maybe_reload()
+
+        assert_that(self.poller.throttle, same_instance(throttle))
+        assert_that(throttle.limits['search'], is_((0.1, 2)))
+
+    def poll(self):
+        self.poller.poll_once()
+
+    def setup(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'config.ini')
+        self.offset_path = os.path.join(self.folder, 'offset.json')
+        with open(self.path, 'w') as stream:
+            stream.write(CONFIG.format(folder=self.folder))
+
+        self.response = {'ok': True, 'result': [UPDATE_START]}
+        self.poller = Poller(self.path)
+        self.poller.telegram = Mock(Telegram)
+        self.poller.telegram.get_updates.return_value = self.response
+
+    def teardown(self):
+        shutil.rmtree(self.folder)
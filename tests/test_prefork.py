@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import tempfile
+from unittest.mock import Mock, patch
+
+import requests
+from bottle import Bottle
+
+from bicimad.prefork import (Prefork, PublishingBiciMad, SharedBiciMad,
+                             make_wsgi_server)
+
+from hamcrest import assert_that, is_, has_length, is_not, empty
+
+from .stations import RESPONSE, N_STATIONS, FIRST_STATION
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+
+
+class TestSharedBiciMad:
+    def test_it_should_read_published_stations(self):
+        self.publisher.refresh()
+
+        assert_that(self.shared.stations.stations, has_length(N_STATIONS))
+
+    def test_it_should_not_read_unchanged_snapshots(self):
+        self.publisher.refresh()
+        first = self.shared.stations
+
+        assert_that(self.shared.stations, is_(first))
+
+    def test_it_should_read_replaced_snapshots(self):
+        self.publisher.refresh()
+        first = self.shared.stations
+
+        with patch('bicimad.bicimad.get_locations',
+                   return_value={'estaciones': [FIRST_STATION]}):
+            self.publisher.refresh()
+
+        assert_that(self.shared.stations.stations, has_length(1))
+        assert_that(self.shared.stations, is_not(first))
+
+    def setup(self):
+        path = os.path.join(tempfile.mkdtemp(), 'stations.json')
+        self.publisher = PublishingBiciMad(path, 'http://none', None, None,
+                                           None)
+        self.shared = SharedBiciMad(path)
+        self.patcher = patch('bicimad.bicimad.get_locations',
+                             return_value=RESPONSE)
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+
+
+class TestPrefork:
+    def test_it_should_serve_from_workers(self):
+        app = Bottle()
+        app.route('/', callback=lambda: str(os.getpid()))
+        server = make_wsgi_server(app, '127.0.0.1', 0)
+        self.prefork = Prefork(server, Mock(), self.serve_forever, workers=1)
+        self.prefork.running = True
+        self.prefork.reap()
+
+        response = requests.get('http://127.0.0.1:{}/'.format(
+            server.server_address[1]), timeout=5)
+
+        assert_that(int(response.text), is_(next(iter(self.prefork.pids))))
+
+    def test_it_should_restart_dead_workers_with_their_number(self):
+        self.prefork = Prefork(Mock(), Mock(), lambda server, number: None,
+                               workers=2)
+        self.prefork.running = True
+        self.prefork.reap()
+        first = set(self.prefork.pids)
+
+        wait_for(lambda: self.prefork.reap()
+                 or not first & set(self.prefork.pids))
+
+        assert_that(first & set(self.prefork.pids), is_(empty()))
+        assert_that(sorted(self.prefork.pids.values()), is_([0, 1]))
+
+    def serve_forever(self, server, number):
+        server.serve_forever(poll_interval=0.1)
+
+    def teardown(self):
+        self.prefork.running = False
+        self.prefork.shutdown()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+from bicimad.ratelimit import Throttle, category, throttled
+from bicimad.telegram import Update
+
+from hamcrest import assert_that, is_, has_length
+
+from .messages import (UPDATE_COMMAND, UPDATE_LOCATION, UPDATE_INLINE,
+                       UPDATE_CHAT, MSG_COMMAND, MSG_LOCATION, UPDATE_ID)
+
+
+USER_ID = 1
+
+
+class TestCategory:
+    def test_it_should_tell_searches_from_help(self):
+        help = Update.from_response(dict(
+            UPDATE_COMMAND, message=dict(MSG_COMMAND, text='/help')))
+
+        assert_that(category(Update.from_response(UPDATE_COMMAND)),
+                    is_('search'))
+        assert_that(category(help), is_('help'))
+
+    def test_it_should_tell_locations_from_live_ones(self):
+        edited = Update.from_response({'update_id': UPDATE_ID,
+                                       'edited_message': MSG_LOCATION})
+
+        assert_that(category(Update.from_response(UPDATE_LOCATION)),
+                    is_('location'))
+        assert_that(category(edited), is_('live'))
+
+    def test_it_should_have_other_kinds(self):
+        assert_that(category(Update.from_response(UPDATE_INLINE)),
+                    is_('inline'))
+        assert_that(category(Update.from_response(UPDATE_CHAT)),
+                    is_('other'))
+
+
+class TestThrottle:
+    def setup(self):
+        self.now = 0
+        self.throttle = Throttle({'search': (0.5, 2)}, idle=60, size=3,
+                                 clock=lambda: self.now)
+
+    def take(self, user_id=USER_ID, kind='search'):
+        return self.throttle.take(user_id, kind)
+
+    def test_it_should_allow_bursts(self):
+        assert_that([self.take(), self.take()],
+                    is_([(True, False), (True, False)]))
+
+    def test_it_should_reject_over_the_burst(self):
+        self.take()
+        self.take()
+
+        assert_that(self.take(), is_((False, True)))
+
+    def test_it_should_warn_only_once(self):
+        self.take()
+        self.take()
+        self.take()
+
+        assert_that(self.take(), is_((False, False)))
+
+    def test_it_should_refill_over_time(self):
+        self.take()
+        self.take()
+        self.now = 2
+
+        assert_that(self.take(), is_((True, False)))
+
+    def test_it_should_limit_each_user_and_kind(self):
+        self.take()
+        self.take()
+
+        assert_that(self.take(user_id=2), is_((True, False)))
+        assert_that(self.take(kind='location'), is_((True, False)))
+
+    def test_it_should_count_throttled_updates(self):
+        before = throttled.get(kind='search')
+        self.take()
+        self.take()
+
+        self.take()
+
+        assert_that(throttled.get(kind='search'), is_(before + 1))
+
+    def test_it_should_drop_idle_buckets(self):
+        self.take(user_id=1)
+        self.take(user_id=2)
+        self.now = 61
+
+        self.take(user_id=3)
+
+        assert_that(self.throttle, has_length(1))
+
+    def test_it_should_keep_idle_buckets_until_refilled(self):
+        throttle = Throttle({'search': (0.01, 2)}, idle=60,
+                            clock=lambda: self.now)
+        throttle.take(1, 'search')
+        throttle.take(1, 'search')
+        self.now = 61
+
+        throttle.take(2, 'search')
+
+        assert_that(throttle.take(1, 'search'), is_((False, True)))
+
+    def test_it_should_give_full_buckets_back_past_the_size(self):
+        self.take()
+        self.take()
+
+        for user_id in range(2, 5):
+            self.take(user_id=user_id)
+
+        assert_that(self.take(), is_((True, False)))
+
+    def test_it_should_keep_a_bounded_number_of_buckets(self):
+        for user_id in range(10):
+            self.take(user_id=user_id)
+
+        assert_that(self.throttle, has_length(3))
+
+    def test_it_should_read_limits_from_config(self):
+        throttle = Throttle.from_config({'throttle.location.rate': '2',
+                                         'throttle.location.burst': '10'})
+
+        assert_that(throttle.limits['location'], is_((2.0, 10.0)))
+        assert_that(throttle.limits['search'], is_((0.5, 5)))
@@ -0,0 +1,69 @@
+import os
+import json
+import shutil
+import tempfile
+
+from bicimad.bench import static_bicimad
+from bicimad.bicimad import Stations
+from bicimad.replay import Replayer, RecordingTelegram, read_payloads, fan_out
+
+from hamcrest import (assert_that, has_length, has_entries, contains,
+                      has_entry, greater_than)
+
+from .stations import RESPONSE
+from .messages import UPDATE_LOCATION, UPDATE_ID, CHAT_ID
+
+
+PAYLOAD = {'ok': True, 'result': [UPDATE_LOCATION]}
+
+
+class TestReadPayloads:
+    def test_it_should_read_json_lines(self):
+        self.write('\n'.join([json.dumps(PAYLOAD)] * 3))
+
+        assert_that(read_payloads(self.path), has_length(3))
+
+    def test_it_should_read_a_single_json_document(self):
+        self.write(json.dumps(PAYLOAD, indent=4))
+
+        assert_that(read_payloads(self.path), contains(PAYLOAD))
+
+    def write(self, content):
+        with open(self.path, 'w') as stream:
+            stream.write(content)
+
+    def setup(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'updates.jsonl')
+
+    def teardown(self):
+        shutil.rmtree(self.folder)
+
+
+class TestFanOut:
+    def test_it_should_copy_updates_from_different_users(self):
+        updates = list(fan_out(UPDATE_LOCATION, 3))
+
+        assert_that(set(u['message']['chat']['id'] for u in updates),
+                    has_length(3))
+        assert_that(set(u['update_id'] for u in updates), has_length(3))
+
+    def test_it_should_keep_update_when_not_fanning_out(self):
+        updates = list(fan_out(UPDATE_LOCATION, 1))
+
+        assert_that(updates, contains(has_entries(
+            update_id=UPDATE_ID,
+            message=has_entry('chat', has_entry('id', CHAT_ID)))))
+
+
+class TestReplayer:
+    def test_it_should_report_throughput_and_calls_per_command(self):
+        telegram = RecordingTelegram('http://localhost', 'replay')
+        bicimad = static_bicimad(Stations.from_response(RESPONSE))
+
+        report = Replayer(telegram, bicimad, fanout=4).run([PAYLOAD])
+
+        assert_that(report, has_entries(
+            updates=4, updates_per_s=greater_than(0), p99=greater_than(0),
+            commands=has_entry('location', has_entries(
+                updates=4, calls=has_entry('sendMessage', 4)))))
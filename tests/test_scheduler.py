@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from bicimad.scheduler import classify, schedule, Progress
+from bicimad.telegram import Update
+
+from hamcrest import assert_that, is_, contains, empty
+
+from .messages import (MSG_CHAT, MSG_COMMAND, MSG_LOCATION, INLINE_QUERY,
+                       UPDATE_ID)
+
+
+def update(id, message=MSG_CHAT, kind='message', **fields):
+    return Update.from_response({'update_id': id,
+                                 kind: dict(message, **fields)})
+
+
+def chat(id):
+    return dict(MSG_CHAT['chat'], id=id)
+
+
+def ids(scheduled):
+    return [update.id for update, priority in scheduled]
+
+
+class TestClassify:
+    def test_it_should_put_locations_and_commands_first(self):
+        assert_that(classify(update(1, MSG_LOCATION)), is_('interactive'))
+        assert_that(classify(update(1, MSG_COMMAND)), is_('interactive'))
+        assert_that(classify(update(1, INLINE_QUERY, 'inline_query')),
+                    is_('interactive'))
+
+    def test_it_should_put_live_locations_first(self):
+        assert_that(classify(update(1, MSG_LOCATION, 'edited_message')),
+                    is_('interactive'))
+
+    def test_it_should_put_text_after(self):
+        assert_that(classify(update(1)), is_('text'))
+
+    def test_it_should_put_edits_last(self):
+        assert_that(classify(update(1, kind='edited_message')),
+                    is_('background'))
+
+
+class TestSchedule:
+    def test_it_should_process_interactive_updates_first(self):
+        updates = [update(UPDATE_ID, chat=chat(1)),
+                   update(UPDATE_ID + 1, kind='edited_message', chat=chat(2)),
+                   update(UPDATE_ID + 2, MSG_LOCATION, chat=chat(3))]
+
+        scheduled, dropped = schedule(updates)
+
+        assert_that(ids(scheduled), contains(
+            UPDATE_ID + 2, UPDATE_ID, UPDATE_ID + 1))
+        assert_that(dropped, is_(empty()))
+
+    def test_it_should_keep_the_order_within_a_chat(self):
+        updates = [update(UPDATE_ID, chat=chat(1)),
+                   update(UPDATE_ID + 1, chat=chat(2)),
+                   update(UPDATE_ID + 2, MSG_COMMAND, chat=chat(2))]
+
+        scheduled, dropped = schedule(updates)
+
+        assert_that(ids(scheduled), contains(
+            UPDATE_ID + 1, UPDATE_ID + 2, UPDATE_ID))
+
+    def test_it_should_drop_background_updates_under_overload(self):
+        updates = [update(UPDATE_ID, kind='edited_message', chat=chat(1)),
+                   update(UPDATE_ID + 1, chat=chat(2))]
+
+        scheduled, dropped = schedule(updates, overload=1)
+
+        assert_that(ids(scheduled), contains(UPDATE_ID + 1))
+        assert_that([update.id for update in dropped], contains(UPDATE_ID))
+
+    def test_it_should_keep_live_locations_under_overload(self):
+        updates = [update(UPDATE_ID, MSG_LOCATION, 'edited_message'),
+                   update(UPDATE_ID + 1, chat=chat(2))]
+
+        scheduled, dropped = schedule(updates, overload=1)
+
+        assert_that(ids(scheduled), contains(UPDATE_ID, UPDATE_ID + 1))
+        assert_that(dropped, is_(empty()))
+
+
+class TestProgress:
+    def test_it_should_advance_past_contiguous_updates(self):
+        progress = Progress([3, 1, 2])
+
+        assert_that(progress.complete(2), is_(empty()))
+        assert_that(progress.complete(1), contains(1, 2))
+        assert_that(progress.complete(3), contains(3))
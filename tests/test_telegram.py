@@ -1,14 +1,24 @@
+import os
 import json
 import datetime
+import tempfile
+from unittest.mock import Mock, ANY
+
+import requests
 
 from bicimad.helpers import urljoin
-from bicimad.telegram import Telegram, Update
+from bicimad.telegram import Telegram, Update, process_updates
+from bicimad.bicimad import BiciMad
+from bicimad.offset import OffsetLog
 
 import httpretty
 from hamcrest import (assert_that, has_property, all_of, ends_with,
-                      starts_with, is_, has_entry, has_entries, has_properties)
+                      starts_with, is_, has_entry, has_entries, has_properties,
+                      contains, none, has_length, contains_string)
 
-from .messages import UPDATE_CHAT, UPDATE_COMMAND, UPDATE_LOCATION, LOCATION
+from .messages import (UPDATE_CHAT, UPDATE_COMMAND, UPDATE_LOCATION, LOCATION,
+                       MSG_CHAT, MSG_LOCATION, UPDATE_ID, CHAT_MSG_SENDER,
+                       UPDATE_INLINE, INLINE_QUERY, INLINE_QUERY_ID)
 
 
 HOST = 'https://api.none.com'
@@ -64,6 +74,61 @@ class TestTelegram:
 
         assert_that(self.sent_json, has_entry('selective', True))
 
+    @httpretty.activate
+    def test_it_should_edit_messages(self):
+        self.register('editMessageText')
+
+        self.telegram.edit_message_text(CHAT_ID, 42, TEXT)
+
+        assert_that(self.sent_json, has_entries(
+            {'chat_id': CHAT_ID, 'message_id': 42, 'text': TEXT}))
+
+    @httpretty.activate
+    def test_it_should_answer_inline_queries(self):
+        self.register('answerInlineQuery')
+
+        self.telegram.answer_inline_query('42', [], cache_time=10)
+
+        assert_that(self.sent_json, has_entries(
+            {'inline_query_id': '42', 'results': [], 'cache_time': 10}))
+
+    @httpretty.activate
+    def test_it_should_send_inline_keyboards(self):
+        self.register('sendMessage')
+        keyboard = [[{'text': 'Más', 'callback_data': 'mas:abc'}]]
+
+        self.telegram.send_message(CHAT_ID, TEXT, keyboard=keyboard)
+
+        assert_that(self.sent_json, has_entry(
+            'reply_markup', has_entry('inline_keyboard', keyboard)))
+
+    @httpretty.activate
+    def test_it_should_answer_callback_queries(self):
+        self.register('answerCallbackQuery')
+
+        self.telegram.answer_callback_query('42', TEXT)
+
+        assert_that(self.sent_json, has_entries(
+            {'callback_query_id': '42', 'text': TEXT}))
+
+    def test_it_should_keep_captured_requests(self):
+        with self.telegram.capture() as calls:
+            self.telegram.send_message(CHAT_ID, TEXT)
+
+        assert_that(calls, contains(contains('sendMessage', has_entries(
+            {'chat_id': CHAT_ID, 'text': TEXT}))))
+
+    @httpretty.activate
+    def test_it_should_send_captured_requests(self):
+        self.register('sendMessage')
+        with self.telegram.capture() as calls:
+            self.telegram.send_message(CHAT_ID, TEXT)
+
+        self.telegram.send_captured(calls)
+
+        assert_that(self.sent_json,
+            has_entries({'chat_id': CHAT_ID, 'text': TEXT}))
+
     @property
     def sent_json(self):
         return json.loads(httpretty.last_request().body.decode('utf-8'))
@@ -84,31 +149,36 @@ class TestTelegram:
 
 class UpdateTest:
     type = None
+    kind = 'message'
     response = None
 
+    @property
+    def message(self):
+        return self.response[self.kind]
+
     def test_it_should_have_update_id(self):
         assert_that(self.update, has_property(
             'id', self.response.get('update_id')))
 
     def test_it_should_have_message_id(self):
         assert_that(self.update, has_property(
-            'message_id', self.response['message']['message_id']))
+            'message_id', self.message['message_id']))
 
     def test_it_should_have_sender(self):
         assert_that(self.update, has_property(
-            'sender', has_properties(self.response['message']['from'])))
+            'sender', has_properties(self.message['from'])))
 
     def test_it_should_have_chat(self):
         assert_that(self.update, has_property(
-            'chat', is_(self.response['message']['chat'])))
+            'chat', is_(self.message['chat'])))
 
     def test_it_should_have_chat_id(self):
         assert_that(self.update, has_property(
-            'chat_id', self.response['message']['chat']['id']))
+            'chat_id', self.message['chat']['id']))
 
     def test_it_should_have_date(self):
         assert_that(self.update, has_property('date', is_(
-            datetime.datetime.fromtimestamp(self.response['message']['date']))))
+            datetime.datetime.fromtimestamp(self.message['date']))))
 
     def test_it_should_have_text_type_when_is_text(self):
         assert_that(self.update, has_property('type', is_(self.type)))
@@ -147,3 +217,205 @@ class TestLocationUpdate(UpdateTest):
 
     def test_it_should_have_location(self):
         assert_that(self.update, has_property('location', is_(LOCATION)))
+
+    def test_it_should_not_be_live(self):
+        assert_that(self.update, has_property('live_period', None))
+
+
+class TestLiveLocationUpdate(UpdateTest):
+    type = 'location'
+    response = {"update_id": UPDATE_ID, "message": dict(
+        MSG_LOCATION, location=dict(MSG_LOCATION['location'],
+                                    live_period=900))}
+
+    def test_it_should_have_live_period(self):
+        assert_that(self.update, has_property('live_period', 900))
+
+
+class TestEditedUpdate(UpdateTest):
+    type = 'location'
+    kind = 'edited_message'
+    response = {"update_id": UPDATE_ID, "edited_message": MSG_LOCATION}
+
+    def test_it_should_have_kind(self):
+        assert_that(self.update, has_property('kind', 'edited_message'))
+
+    def test_it_should_have_message(self):
+        assert_that(self.update, has_property('message', MSG_LOCATION))
+
+
+class TestUnknownMessageUpdate:
+    def test_it_should_have_unknown_type(self):
+        message = dict(MSG_CHAT, sticker={'file_id': 'abc'})
+        del message['text']
+
+        update = Update.from_response({'update_id': UPDATE_ID,
+                                       'message': message})
+
+        assert_that(update, has_properties(type='unknown', kind='message'))
+
+
+class TestCallbackUpdate:
+    def test_it_should_have_data_sender_and_chat(self):
+        update = Update.from_response({
+            'update_id': UPDATE_ID,
+            'callback_query': {'id': '42', 'from': CHAT_MSG_SENDER,
+                               'message': MSG_CHAT, 'data': 'more:1'}})
+
+        assert_that(update, has_properties(
+            type='callback', data='more:1', chat_id=MSG_CHAT['chat']['id'],
+            callback_id='42',
+            sender=has_property('id', CHAT_MSG_SENDER['id'])))
+
+
+class TestInlineUpdate:
+    def test_it_should_have_query_and_sender_without_chat(self):
+        update = Update.from_response(UPDATE_INLINE)
+
+        assert_that(update, has_properties(
+            type='inline', kind='inline_query', query=INLINE_QUERY['query'],
+            query_id=INLINE_QUERY_ID, chat_id=none(),
+            sender=has_property('id', CHAT_MSG_SENDER['id'])))
+
+
+class TestUnknownKindUpdate:
+    def test_it_should_have_unknown_kind_without_sender(self):
+        update = Update.from_response({'update_id': UPDATE_ID,
+                                       'poll': {'id': '1'}})
+
+        assert_that(update, has_properties(
+            kind='poll', type='unknown', sender=none(), chat_id=none()))
+
+
+class TestUserWithoutLastName:
+    def test_it_should_have_empty_last_name(self):
+        message = dict(MSG_CHAT, **{'from': {'id': 1, 'first_name': 'Ana'}})
+
+        update = Update.from_response({'update_id': UPDATE_ID,
+                                       'message': message})
+
+        assert_that(update.sender, has_properties(first_name='Ana',
+                                                  last_name=none()))
+
+
+class TestProcessUpdates:
+    def test_it_should_skip_unmanaged_updates(self):
+        config = {}
+        updates = {'ok': True, 'result': [
+            {'update_id': UPDATE_ID, 'edited_message': MSG_CHAT},
+            {'update_id': UPDATE_ID + 1, 'poll': {'id': '1'}},
+        ]}
+
+        process_updates(updates, config, self.telegram, Mock(BiciMad),
+                        conversations={})
+
+        assert_that(config, has_entry('telegram.offset', UPDATE_ID + 2))
+        assert_that(self.telegram.send_message.called, is_(False))
+
+    def test_it_should_answer_unmanaged_messages(self):
+        telegram = Mock(Telegram)
+        photo = dict(MSG_CHAT, photo=[{'file_id': 'abc'}])
+        del photo['text']
+        updates = {'ok': True, 'result': [
+            {'update_id': UPDATE_ID, 'message': photo},
+            {'update_id': UPDATE_ID + 1, 'message': photo},
+            {'update_id': UPDATE_ID + 2,
+             'message': dict(MSG_CHAT, text='/start')},
+        ]}
+
+        process_updates(updates, {}, telegram, Mock(BiciMad),
+                        conversations={})
+
+        texts = [call[0][1] for call in telegram.send_message.call_args_list]
+        assert_that(texts, contains('No te pillo', 'No te pillo',
+                                    contains_string('¡Hola!')))
+
+    def test_it_should_answer_repeated_queries_once(self):
+        telegram = self.capturing_telegram()
+        config = {}
+        bicimad = Mock(BiciMad)
+        bicimad.stations.by_search.return_value = []
+
+        process_updates(self.batch('/bici wwwwww', '/bici wwwwww'), config,
+                        telegram, bicimad, coalesce_chats=True,
+                        conversations={})
+
+        bicimad.stations.by_search.assert_called_once_with(
+            'wwwwww', max=ANY)
+        assert_that(telegram.send_captured.call_args[0][0], has_length(1))
+        assert_that(config, has_entry('telegram.offset', UPDATE_ID + 2))
+
+    def test_it_should_merge_replies_to_a_chat(self):
+        telegram = self.capturing_telegram()
+
+        process_updates(self.batch('/start', '/help'), {}, telegram,
+                        Mock(BiciMad), coalesce_chats=True, conversations={})
+
+        assert_that(telegram.send_captured.call_args[0][0], contains(
+            contains('sendMessage', has_entry('text', all_of(
+                contains_string('¡Hola!'),
+                contains_string('Puedo ayudarte'))))))
+
+    def test_it_should_advance_offsets_of_coalesced_updates(self):
+        offsets = OffsetLog(os.path.join(tempfile.mkdtemp(), 'offset'))
+
+        process_updates(self.batch('/start', '/start'), {},
+                        self.capturing_telegram(), Mock(BiciMad), offsets,
+                        coalesce_chats=True, conversations={})
+
+        assert_that(offsets.offset, is_(UPDATE_ID + 2))
+        assert_that(offsets.seen(UPDATE_ID), is_(True))
+
+    def test_it_should_not_advance_offsets_of_unsent_replies(self):
+        offsets = OffsetLog(os.path.join(tempfile.mkdtemp(), 'offset'))
+        telegram = self.capturing_telegram()
+        telegram.send_captured.side_effect = requests.ConnectionError
+
+        process_updates(self.batch('/start', '/help'), {}, telegram,
+                        Mock(BiciMad), offsets, coalesce_chats=True,
+                        conversations={})
+
+        assert_that(offsets.seen(UPDATE_ID), is_(False))
+        assert_that(offsets.seen(UPDATE_ID + 1), is_(False))
+
+    def test_it_should_answer_commands_before_text(self):
+        telegram = self.capturing_telegram()
+        telegram.send_message = Mock()
+        updates = {'ok': True, 'result': [
+            {'update_id': UPDATE_ID,
+             'message': dict(MSG_CHAT, chat=dict(MSG_CHAT['chat'], id=1))},
+            {'update_id': UPDATE_ID + 1,
+             'message': dict(MSG_CHAT, text='/help')},
+        ]}
+
+        process_updates(updates, {}, telegram, Mock(BiciMad),
+                        conversations={})
+
+        assert_that(telegram.send_message.call_args_list[0][0][1],
+                    contains_string('Puedo ayudarte'))
+
+    def test_it_should_advance_offsets_once_earlier_updates_are_done(self):
+        offsets = OffsetLog(os.path.join(tempfile.mkdtemp(), 'offset'))
+        advanced = []
+        offsets.advance = Mock(side_effect=advanced.append)
+        updates = self.batch('hola', '/help')
+        updates['result'][0]['message']['chat'] = {'id': 1}
+
+        process_updates(updates, {}, Mock(Telegram), Mock(BiciMad), offsets,
+                        conversations={})
+
+        assert_that(advanced, contains(UPDATE_ID, UPDATE_ID + 1))
+
+    def batch(self, *texts):
+        return {'ok': True, 'result': [
+            {'update_id': UPDATE_ID + number,
+             'message': dict(MSG_CHAT, text=text)}
+            for number, text in enumerate(texts)]}
+
+    def capturing_telegram(self):
+        telegram = Telegram(HOST, TOKEN)
+        telegram.send_captured = Mock()
+        return telegram
+
+    def setup(self):
+        self.telegram = Mock(Telegram)
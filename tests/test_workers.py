@@ -0,0 +1,118 @@
+import tempfile
+from unittest.mock import Mock
+
+from bicimad.workers import WorkerPool, Busy, Reply
+from bicimad.telegram import Telegram, Update
+from bicimad.bicimad import BiciMad
+from bicimad.history import History
+
+from hamcrest import (assert_that, calling, raises, contains, contains_string,
+                      is_, none, has_entries, has_key)
+
+from .messages import MSG_COMMAND, UPDATE_ID, CHAT_ID
+
+
+def start_update(update_id=UPDATE_ID, **sender):
+    message = dict(MSG_COMMAND, text='/start')
+    message['from'] = dict(message['from'], **sender)
+    return Update.from_response({'update_id': update_id, 'message': message})
+
+
+class TestWorkerPool:
+    def test_it_should_process_submitted_updates(self):
+        self.pool.start()
+
+        self.pool.submit(start_update())
+        self.pool.stop()
+
+        assert_that(self.telegram.send_message.call_args[0],
+                    contains(CHAT_ID, contains_string('¡Hola!')))
+
+    def test_it_should_reject_updates_when_queue_is_full(self):
+        self.pool.submit(start_update())
+
+        assert_that(calling(self.pool.submit).with_args(start_update()),
+                    raises(Busy))
+
+    def test_it_should_route_same_sender_to_same_worker(self):
+        pool = WorkerPool(self.telegram, self.bicimad, workers=4, queue_size=2)
+
+        pool.submit(start_update(1))
+        pool.submit(start_update(2))
+
+        assert_that(calling(pool.submit).with_args(start_update(3)),
+                    raises(Busy))
+
+    def test_it_should_route_same_chat_to_same_worker(self):
+        pool = WorkerPool(self.telegram, self.bicimad, workers=4, queue_size=1)
+
+        pool.submit(start_update(1, id=1))
+
+        assert_that(calling(pool.submit).with_args(start_update(2, id=2)),
+                    raises(Busy))
+
+    def test_it_should_keep_working_after_errors(self):
+        self.telegram.send_message.side_effect = [ValueError(), None]
+        pool = WorkerPool(self.telegram, self.bicimad, workers=1).start()
+
+        pool.submit(start_update(1))
+        pool.submit(start_update(2, id=1))
+        pool.stop()
+
+        assert_that(self.telegram.send_message.call_count, is_(2))
+
+    def test_it_should_hand_single_replies(self):
+        telegram = Telegram('https://api.none.com', 'ab209e3daffa293')
+        telegram.send_telegram = Mock(wraps=telegram.send_telegram)
+        pool = WorkerPool(telegram, self.bicimad, workers=1).start()
+        reply = Reply()
+
+        pool.submit(start_update(), reply)
+        pool.stop()
+
+        assert_that(reply.wait(0), contains('sendMessage', has_entries(
+            chat_id=CHAT_ID, text=contains_string('¡Hola!'))))
+        telegram.send_telegram.assert_called_once()
+
+    def test_it_should_train_the_forecast_from_recorded_history(self):
+        path = tempfile.mkdtemp()
+        records = History(path)
+        records.record([Mock(id=1, bikes=10, spaces=5)], 1000)
+        records.record([Mock(id=1, bikes=5, spaces=10)], 1600)
+        records.close()
+        shared = BiciMad(None, None, None, None)
+
+        WorkerPool.from_config({'telegram.token': 'ab209e3daffa293',
+                                'history.path': path}, shared)
+
+        assert_that(shared.forecaster.flows, has_key(1))
+
+    def setup(self):
+        self.telegram = Mock(Telegram)
+        self.bicimad = Mock(BiciMad)
+        self.pool = WorkerPool(self.telegram, self.bicimad,
+                               workers=1, queue_size=1)
+
+
+class TestReply:
+    def test_it_should_take_a_single_request(self):
+        taken = self.reply.resolve([('sendMessage', {})])
+
+        assert_that(taken, is_(True))
+        assert_that(self.reply.wait(0), is_(('sendMessage', {})))
+
+    def test_it_should_not_take_several_requests(self):
+        taken = self.reply.resolve([('sendMessage', {}), ('sendMessage', {})])
+
+        assert_that(taken, is_(False))
+        assert_that(self.reply.wait(0), is_(none()))
+
+    def test_it_should_not_take_requests_after_giving_up(self):
+        self.reply.wait(0)
+
+        taken = self.reply.resolve([('sendMessage', {})])
+
+        assert_that(taken, is_(False))
+
+    def setup(self):
+        self.reply = Reply()